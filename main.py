@@ -36,7 +36,7 @@ def run(parsed):
             parsed.subject,
             parsed.session,
             parsed.output,
-            parsed.eyetracking,
+            parsed.eyetracking or parsed.eyetracking_sim,
             parsed.fmri,
             parsed.meg,
             parsed.ctl_win,
@@ -46,6 +46,8 @@ def run(parsed):
             parsed.skip_soundcheck,
             parsed.target_ETcalibration,
             parsed.validate_ET,
+            record_movie_fps=parsed.record_movie_fps,
+            simulate_eyetracker=parsed.eyetracking_sim,
             )
     finally:
         if not parsed.no_force_resolution:
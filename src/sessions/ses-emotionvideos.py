@@ -9,8 +9,8 @@ OUTPUT_RUNS_ORDER_PATH = "design_runs_order"
 def get_tasks(parsed):
     from ..tasks.emotionvideos import EmotionVideos
     from ..tasks import task_base
+    from ..shared.progress import load_savestate
     import pandas as pd
-    import json
 
     sub_design_filename = os.path.join(
         EMOTION_DATA_PATH,
@@ -22,12 +22,10 @@ def get_tasks(parsed):
     bids_sub = "sub-%s" % parsed.subject
     savestate_path = os.path.abspath(os.path.join(parsed.output, "sourcedata",bids_sub, f"{bids_sub}_phase-stable_task-emotionvideos_savestate.json"))
 
-    # check for a "savestate"
-    if os.path.exists(savestate_path):
-        with open(savestate_path) as f:
-            savestate = json.load(f)
-    else:
-        savestate = {"index": 0}
+    # check for a "savestate", the legacy json file is imported in the progress store
+    progress, savestate = load_savestate(
+        parsed.output, bids_sub, "phase-stable_task-emotionvideos", {"index": 0}, savestate_path,
+        dry_run=parsed.dry_run)
 
     for run, design in enumerate(range(savestate['index'], len(sub_design))):
         #load design file for the run according to each participant predefine runs order
@@ -49,8 +47,7 @@ def get_tasks(parsed):
         #only increment if the task was not interrupted. If interrupted, it needs to be rescan
         if task._task_completed:
             savestate['index'] += 1
-            with open(savestate_path, 'w') as f:
-                json.dump(savestate, f)
+            progress.set(bids_sub, "phase-stable_task-emotionvideos", savestate)
 
 
 # Experiment parameters
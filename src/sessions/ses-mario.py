@@ -1,7 +1,6 @@
 import os
 import random
 import retro
-import json
 
 # point to a copy of the whole gym-retro with custom states and scenarii
 retro.data.Integrations.add_custom_path(
@@ -10,6 +9,7 @@ retro.data.Integrations.add_custom_path(
 
 from psychopy import logging
 from ..tasks import images, videogame, memory, task_base
+from ..shared.progress import load_savestate
 
 from .game_questionnaires import flow_ratings
 
@@ -23,12 +23,10 @@ def get_tasks(parsed):
     bids_sub = "sub-%s" % parsed.subject
     savestate_path = os.path.abspath(os.path.join(parsed.output, "sourcedata", bids_sub, f"{bids_sub}_task-mario_savestate.json"))
 
-    # check for a "savestate"
-    if os.path.exists(savestate_path):
-        with open(savestate_path) as f:
-            savestate = json.load(f)
-    else:
-        savestate = {"world": 1, "level":1}
+    # check for a "savestate", the legacy json file is imported in the progress store
+    progress, savestate = load_savestate(
+        parsed.output, bids_sub, "task-mario", {"world": 1, "level":1}, savestate_path,
+        dry_run=parsed.dry_run)
 
     for run in range(10):
         if savestate['world'] == 9:
@@ -58,8 +56,7 @@ def get_tasks(parsed):
                 if savestate['level'] > 3:
                     savestate['world'] +=1
                     savestate['level'] = 1
-            with open(savestate_path, 'w') as f:
-                json.dump(savestate, f)
+            progress.set(bids_sub, "task-mario", savestate)
         else:
             logging.exp(f"{current_level} not completed.")
 
@@ -66,7 +66,7 @@ def get_tasks(parsed):
     from ..tasks import videogame, task_base
     from ..tasks import videogame, task_base
     from .game_questionnaires import flow_ratings, other_ratings
-    import json
+    from ..shared.progress import load_savestate
     import retro
     # point to a copy of the whole gym-retro with custom states and scenarii
     retro.data.Integrations.add_custom_path(
@@ -90,12 +90,10 @@ def get_tasks(parsed):
 
     savestate_path = os.path.abspath(os.path.join(parsed.output, "sourcedata", bids_sub, f"{bids_sub}_phase-stable_task-mario_savestate.json"))
 
-    # check for a "savestate"
-    if os.path.exists(savestate_path):
-        with open(savestate_path) as f:
-            savestate = json.load(f)
-    else:
-        savestate = {"index": 0}
+    # check for a "savestate", the legacy json file is imported in the progress store
+    progress, savestate = load_savestate(
+        parsed.output, bids_sub, "phase-stable_task-mario", {"index": 0}, savestate_path,
+        dry_run=parsed.dry_run)
 
     for run in range(10):
 
@@ -126,8 +124,7 @@ def get_tasks(parsed):
         #only increment if the task was not interrupted, if interrupted, it needs to be rescan
         if task._task_completed:
             savestate['index'] += task._nlevels
-            with open(savestate_path, 'w') as f:
-                json.dump(savestate, f)
+            progress.set(bids_sub, "phase-stable_task-mario", savestate)
 
         yield task_base.Pause(
             text="You can take a short break.\n Press A when ready to continue",
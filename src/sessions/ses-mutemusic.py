@@ -1,6 +1,7 @@
 import os
 import pandas
-from ..tasks.mutemusic import Playlist
+from ..tasks.mutemusic import Playlist, compile_playlists
+from ..shared.progress import ProgressStore
 
 STIMULI_PATH  = 'data/mutemusic'
 
@@ -10,25 +11,47 @@ def get_tasks(parsed):
     playlists_order_path = os.path.join(STIMULI_PATH, sub, f'{sub}_Playlist_order.tsv')
     playlist_order = pandas.read_csv(playlists_order_path, sep=' ')
 
+    # progress is kept in the dataset store, initialized from the order file,
+    # rows added to the order file later are seeded on the next start
+    bids_sub = f'sub-{parsed.subject}'
+    progress = ProgressStore.for_dataset(parsed.output, dry_run=parsed.dry_run)
+    progress.seed(bids_sub, 'task-mutemusic',
+        {f'run-{i}': int(row['done']) for i, row in playlist_order.iterrows()})
+    done = progress.get(bids_sub, 'task-mutemusic')
+
     current_playlist = len(playlist_order)
     for i, row in playlist_order.iterrows():
-        if not row['done']:
+        if not done.get(f'run-{i}', False):
             current_playlist = i
             break
 
     playlist_sequence = playlist_order[current_playlist:]
+    playlist_paths = {
+        i: os.path.join(STIMULI_PATH, sub, f"{sub}_Playlist_{row['playlist']}.tsv")
+        for i, row in playlist_sequence.iterrows()}
+
+    # validate all the remaining playlists before starting, using the cached manifest
+    manifest = compile_playlists(STIMULI_PATH, save=not parsed.dry_run)
+    errors = []
+    for path in sorted(set(playlist_paths.values())):
+        entry = manifest.get(path)
+        if entry is None:
+            errors.append(f"{path}: playlist does not exist")
+        else:
+            errors += entry['errors']
+    if errors:
+        raise ValueError("invalid playlists:\n" + "\n".join(errors))
+
     for i, row in playlist_sequence.iterrows():
-        pli = row['playlist']
-        playlist_file = f'{sub}_Playlist_{pli}.tsv'
-        playlist_path = os.path.join(STIMULI_PATH, sub, playlist_file)
+        playlist_path = playlist_paths[i]
         playlist = Playlist(
             tsv_path=playlist_path,
+            track_durations=manifest[playlist_path]['durations'],
             use_eyetracking=True,
             et_calibrate=i==current_playlist,
             name=f"task-mutemusic_run-{i}")
         yield playlist
         
         if playlist._task_completed:
-            playlist_order['done'].iloc[i] = 1
-            playlist_order.to_csv(playlists_order_path, sep=' ', index=False)
+            progress.set(bids_sub, 'task-mutemusic', {f'run-{i}': 1})
 
@@ -4,23 +4,21 @@ from termcolor import colored, cprint
 def get_tasks(parsed):
     from ..tasks import language, task_base
     from psychopy import logging
-    import json
+    from ..shared.progress import load_savestate
     bids_sub = "sub-%s" % parsed.subject
     savestate_path = os.path.abspath(os.path.join(parsed.output, "sourcedata", bids_sub, f"{bids_sub}_task-triplet_savestate.json"))
 
-    # check for a "savestate"
-    if os.path.exists(savestate_path):
-        with open(savestate_path) as f:
-            savestate = json.load(f)
-    else:
-        savestate = {"session": 1}
+    # check for a "savestate", the legacy json file is imported in the progress store
+    progress, savestate = load_savestate(
+        parsed.output, bids_sub, "task-triplet", {"session": 1}, savestate_path,
+        dry_run=parsed.dry_run)
     session = savestate['session']
     if parsed.force:
         cprint('WARNING: you are overriding the savestate, ensure that you know what you are doing.', 'red', attrs=['blink'])
         session = int(parsed.session)
     elif session != int(parsed.session):
         cprint('ERROR: the savestate do not match the session ID entered on the command line.', 'red', attrs=['blink'])
-        cprint(f'modify savestate file: {savestate_path} if you know what you are doing', 'red')
+        cprint(f'use --force, or update task-triplet of {bids_sub} in {progress.path} if you know what you are doing', 'red')
         exit(1)
     logging.exp(f"loading savestate: currently on session {savestate['session']:03d}")
 
@@ -53,8 +51,7 @@ def get_tasks(parsed):
     if tasks_completed:
         savestate['session'] += 1
         logging.exp(f"saving savestate: next session {savestate['session']:03d}")
-        with open(savestate_path, 'w') as f:
-            json.dump(savestate, f)
+        progress.set(bids_sub, "task-triplet", savestate)
     else:
         print('ERROR: not all tasks were completed. This might be due to relaunching the task and skipping tasks.')
 
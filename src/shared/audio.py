@@ -0,0 +1,168 @@
+# Audio stimuli analysis helpers: read WAV files with numpy, without psychopy,
+# so that they can be used offline or before any window is opened.
+
+import os, glob, json, hashlib, wave
+import numpy as np
+
+CHUNK_FRAMES = 2 ** 16
+# digital silence shorter than this is part of the music, not an imagery window
+SILENCE_MIN_DURATION = .5
+
+MUTEMUSIC_STIMULI_PATH = os.path.join('data', 'mutemusic', 'stimuli')
+MUTEMUSIC_SILENCE_INDEX = os.path.join('data', 'mutemusic', 'silence_index.json')
+
+
+def _frames_to_array(raw, sampwidth, nchannels):
+    if sampwidth == 1:
+        samples = np.frombuffer(raw, dtype=np.uint8).astype(np.int16) - 128
+    elif sampwidth == 2:
+        samples = np.frombuffer(raw, dtype='<i2')
+    elif sampwidth == 3:
+        # 24-bit: pad each sample to 32-bit little endian, sign is kept by the shift
+        packed = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3)
+        padded = np.zeros((packed.shape[0], 4), dtype=np.uint8)
+        padded[:, 1:] = packed
+        samples = padded.view('<i4').ravel() >> 8
+    elif sampwidth == 4:
+        samples = np.frombuffer(raw, dtype='<i4')
+    else:
+        raise ValueError(f"unsupported sample width: {sampwidth}")
+    return samples.reshape(-1, nchannels)
+
+
+def _array_to_frames(samples, sampwidth):
+    samples = np.asarray(samples).ravel()
+    if sampwidth == 1:
+        return (samples + 128).astype(np.uint8).tobytes()
+    elif sampwidth == 2:
+        return samples.astype('<i2').tobytes()
+    elif sampwidth == 3:
+        # keep the 3 low bytes of each little endian 32-bit sample
+        return samples.astype('<i4').view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    elif sampwidth == 4:
+        return samples.astype('<i4').tobytes()
+    raise ValueError(f"unsupported sample width: {sampwidth}")
+
+
+def iter_wav_chunks(path, chunk_frames=CHUNK_FRAMES):
+    """Yield (frames, channels) integer arrays without loading the whole file."""
+    with wave.open(path, 'rb') as wav:
+        sampwidth, nchannels = wav.getsampwidth(), wav.getnchannels()
+        while True:
+            raw = wav.readframes(chunk_frames)
+            if not raw:
+                break
+            yield _frames_to_array(raw, sampwidth, nchannels)
+
+
+def get_wav_info(path):
+    """Read sample rate, channels and duration from the header only."""
+    with wave.open(path, 'rb') as wav:
+        return {
+            'sample_rate': wav.getframerate(),
+            'channels': wav.getnchannels(),
+            'sampwidth': wav.getsampwidth(),
+            'nframes': wav.getnframes(),
+            'duration': wav.getnframes() / wav.getframerate(),
+        }
+
+
+def file_hash(path, chunk_size=2 ** 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def find_runs(mask):
+    """Return (starts, stops) sample indices of the True runs of a boolean array."""
+    edges = np.diff(np.concatenate(([False], mask, [False])).astype(np.int8))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def find_silences(path, min_duration=SILENCE_MIN_DURATION, threshold=0):
+    """Detect zero-energy runs (all channels <= threshold) with sample precision.
+
+    Returns a list of (onset, duration) in seconds from the start of the file.
+    """
+    sample_rate = get_wav_info(path)['sample_rate']
+    # bounds instead of np.abs, which overflows on the most negative integer sample
+    silent = np.concatenate([
+        np.all((chunk >= -threshold) & (chunk <= threshold), axis=1)
+        for chunk in iter_wav_chunks(path)] or [np.zeros(0, dtype=bool)])
+    starts, stops = find_runs(silent)
+    keep = (stops - starts) >= min_duration * sample_rate
+    return [
+        (float(start / sample_rate), float((stop - start) / sample_rate))
+        for start, stop in zip(starts[keep], stops[keep])]
+
+
+class SilenceIndex(object):
+    """Silence gaps of audio files, cached in a json sidecar keyed by file hash.
+
+    Path size and mtime are stored along with the hash so that unchanged files
+    are neither hashed nor scanned again.
+    """
+
+    # 2: full-scale negative samples are no longer detected as silence
+    VERSION = 2
+
+    def __init__(self, index_path=MUTEMUSIC_SILENCE_INDEX, min_duration=SILENCE_MIN_DURATION):
+        self.index_path = index_path
+        self.min_duration = min_duration
+        self._changed = False
+        self._index = {'version': self.VERSION, 'min_duration': min_duration, 'files': {}, 'paths': {}}
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            if index.get('version') == self.VERSION and index.get('min_duration') == min_duration:
+                self._index = index
+
+    def _hash(self, path):
+        stat = os.stat(path)
+        cached = self._index['paths'].get(path)
+        if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+            return cached['sha1']
+        sha1 = file_hash(path)
+        self._index['paths'][path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1}
+        self._changed = True
+        return sha1
+
+    def get(self, path):
+        sha1 = self._hash(path)
+        if sha1 not in self._index['files']:
+            self._index['files'][sha1] = find_silences(path, self.min_duration)
+            self._changed = True
+        return [tuple(gap) for gap in self._index['files'][sha1]]
+
+    def save(self):
+        if self._changed:
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self._index, f, indent=1)
+            os.replace(tmp_path, self.index_path)
+            self._changed = False
+
+
+def get_silence_gaps(paths, index_path=MUTEMUSIC_SILENCE_INDEX):
+    index = SilenceIndex(index_path)
+    gaps = {path: index.get(path) for path in paths}
+    index.save()
+    return gaps
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="build the silence gaps index of all the mutemusic stimuli",
+    )
+    parser.add_argument("--stimuli", default=MUTEMUSIC_STIMULI_PATH, help="stimuli folder")
+    parser.add_argument("--index", default=MUTEMUSIC_SILENCE_INDEX, help="index json file")
+    parsed = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(parsed.stimuli, '**', '*.wav'), recursive=True))
+    for path, gaps in get_silence_gaps(paths, parsed.index).items():
+        print(f"{path}: {len(gaps)} gaps, {sum(g[1] for g in gaps):.3f}s")
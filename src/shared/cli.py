@@ -3,29 +3,102 @@
 import os, datetime, traceback, glob, time
 from collections.abc import Iterable, Iterator
 from psychopy import core, visual, logging, event
+import pyglet
 import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 visual.window.reportNDroppedFrames = 10e10
 
 TIMEOUT = 5
 DELAY_BETWEEN_TASK = 2
+# saves and movie encodings queued in the background before the main loop waits
+MAX_PENDING_WRITES = 2
 
 globalClock = core.MonotonicClock(0)
 logging.setDefaultClock(globalClock)
 
 from . import config  # import first separately
-from . import fmri, eyetracking, utils, meg, config
+from . import fmri, eyetracking, utils, meg, movie, plan, config
+from .events import recover_journal, JOURNAL_EXT
+from .logfile import AsyncLogFile
 from ..tasks import task_base, video
 
 
+class ShortcutHandler(object):
+    """pyglet key handler catching the global Ctrl+N/C/Q shortcuts.
+
+    Pushed on top of the windows handlers, it sees keys before psychopy and the
+    custom handlers of tasks (eg. videogame) and does not pass the shortcuts
+    down to their key buffers. The last shortcut pressed is kept in a flag.
+    """
+
+    KEYS = {pyglet.window.key.N: "n", pyglet.window.key.C: "c", pyglet.window.key.Q: "q"}
+
+    def __init__(self):
+        self.pending = None
+
+    def on_key_press(self, symbol, modifiers):
+        if modifiers & pyglet.window.key.MOD_CTRL and symbol in self.KEYS:
+            self.pending = self.KEYS[symbol]
+            return pyglet.event.EVENT_HANDLED
+
+    def install(self, win):
+        win.winHandle.push_handlers(self)
+
+    def pop(self):
+        shortcut, self.pending = self.pending, None
+        return shortcut
+
+
+shortcuts = ShortcutHandler()
+
+
 def listen_shortcuts():
-    if any([k[1] & event.MOD_CTRL for k in event._keyBuffer]):
-        allKeys = event.getKeys(["n", "c", "q"], modifiers=True)
-        ctrl_pressed = any([k[1]["ctrl"] for k in allKeys])
-        all_keys_only = [k[0] for k in allKeys]
-        if len(allKeys) and ctrl_pressed:
-            return all_keys_only[0]
-    return False
+    # keys are dispatched to the handler when windows are flipped or polled
+    return shortcuts.pop() or False
+
+
+class BackgroundWriter(object):
+    """Run the task saves and movie encodings one at a time in a worker thread.
+
+    At most `max_pending` jobs are queued, submitting more waits for the oldest.
+    Failures are logged to the session log, `wait_all` is the barrier to call
+    before the session ends.
+    """
+
+    def __init__(self, max_pending=MAX_PENDING_WRITES):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer")
+        self._pending = []
+
+    def submit(self, description, fn, *args):
+        self._pending = [f for f in self._pending if not f.done()]
+        while len(self._pending) >= self.max_pending:
+            wait(self._pending, return_when=FIRST_COMPLETED)
+            self._pending = [f for f in self._pending if not f.done()]
+        future = self._executor.submit(self._run, description, fn, *args)
+        self._pending.append(future)
+        return future
+
+    @staticmethod
+    def _run(description, fn, *args):
+        start = time.monotonic()
+        try:
+            fn(*args)
+        except Exception:
+            logging.error("%s failed:\n%s" % (description, traceback.format_exc()))
+            raise
+        logging.exp(msg="%s done in %.3fs" % (description, time.monotonic() - start))
+
+    def wait_all(self):
+        if self._pending:
+            print("waiting for %d pending writes" % len(self._pending))
+        wait(self._pending)
+        self._pending = []
+
+    def shutdown(self):
+        self.wait_all()
+        self._executor.shutdown(wait=True)
 
 
 def run_task_loop(loop, eyetracker=None, gaze_drawer=None, record_movie=False):
@@ -34,13 +107,13 @@ def run_task_loop(loop, eyetracker=None, gaze_drawer=None, record_movie=False):
             gaze = eyetracker.get_gaze()
             if not gaze is None:
                 gaze_drawer.draw_gazepoint(gaze)
-        if record_movie and frameN % 6 == 0:
-            record_movie.getMovieFrame(buffer="back")
+        if record_movie and frameN % record_movie.capture_every == 0:
+            record_movie.capture()
         # check for global event keys
         shortcut_evt = listen_shortcuts()
         if shortcut_evt:
             return shortcut_evt
-        # force regular flushing to keep log in case of hard crash
+        # force regular flushing to keep log in case of hard crash (written by the log thread)
         if frameN % config.FRAME_RATE == 0:
             logging.flush()
 
@@ -55,7 +128,7 @@ def run_task(
         task.instructions(exp_win, ctl_win),
         eyetracker,
         gaze_drawer,
-        record_movie=exp_win if record_movie else False,
+        record_movie=record_movie,
     )
 
     if task.use_fmri and not shortcut_evt:
@@ -76,7 +149,7 @@ def run_task(
             task.run(exp_win, ctl_win),
             eyetracker,
             gaze_drawer,
-            record_movie=exp_win if record_movie else False,
+            record_movie=record_movie,
         )
 
     # send stop trigger/marker to MEG + Biopac (or anything else on parallel port)
@@ -90,12 +163,9 @@ def run_task(
         task.stop(exp_win, ctl_win),
         eyetracker,
         gaze_drawer,
-        record_movie=exp_win if record_movie else False,
+        record_movie=record_movie,
     )
 
-    # now that time is less sensitive: save files
-    task.save()
-
     return shortcut_evt
 
 
@@ -114,6 +184,8 @@ def main_loop(
     skip_soundcheck=False,
     calibration_targets=False,
     validate_eyetrack=False,
+    record_movie_fps=movie.MOVIE_FPS,
+    simulate_eyetracker=False,
 ):
 
     # force screen resolution to solve issues with video splitter at scanner
@@ -124,6 +196,17 @@ def main_loop(
         '--rate', str(config.FRAME_RATE)])
     time.sleep(5)"""
 
+    # tasks listed in advance are preloaded while the previous task runs,
+    # tasks from a session generator only once the previous one has run,
+    # as the session can depend on its outcome
+    lookahead = not isinstance(all_tasks, Iterator)
+
+    if lookahead:
+        # list of tasks to be ran in a session, a session generator can only be
+        # expanded in advance by the planner: python -m src.shared.plan
+        plans = plan.plan_tasks(all_tasks)
+        plan.print_plan(plans, plan.summarize(plans, config.INSTRUCTION_DURATION + DELAY_BETWEEN_TASK))
+
     if not utils.check_power_plugged():
         print("*" * 25 + "WARNING: the power cord is not connected" + "*" * 25)
         if not allow_run_on_battery:
@@ -139,14 +222,26 @@ def main_loop(
         datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),
     )
     logfile_path = os.path.join(log_path, log_name_prefix + ".log")
-    log_file = logging.LogFile(logfile_path, level=logging.INFO, filemode="w")
+    # written by a background thread, flushes in the frame loop only queue the text
+    log_file = AsyncLogFile(logfile_path, level=logging.INFO, filemode="w")
+
+    # events journals left by a crashed or killed session
+    for journal_path in sorted(glob.glob(os.path.join(log_path, "*." + JOURNAL_EXT))):
+        events_path = recover_journal(journal_path)
+        logging.warning(f"recovered events of an interrupted task: {events_path}")
+        print(f"recovered events of an interrupted task: {events_path}")
+
+    # margin of the waits before their deadline, measured before any task runs
+    utils.calibrate_sleep()
 
     exp_win = visual.Window(**config.EXP_WINDOW, monitor=config.EXP_MONITOR)
     exp_win.mouseVisible = False
+    shortcuts.install(exp_win)
 
     if show_ctl_win:
         ctl_win = visual.Window(**config.CTL_WINDOW)
         ctl_win.name = "Stimuli"
+        shortcuts.install(ctl_win)
     else:
         ctl_win = None
 
@@ -167,6 +262,7 @@ def main_loop(
             debug=False,
             use_targets = calibration_targets,
             validate_calib = validate_eyetrack,
+            simulate = simulate_eyetracker,
         )
         print("starting et client")
         eyetracker_client.start()
@@ -217,25 +313,32 @@ Thanks for your participation!"""
             )],
         )
 
-    if not isinstance(all_tasks, Iterator):
-
-        # list of tasks to be ran in a session
-
-        print("Here are the stimuli planned for today\n" + "_" * 50)
-        for task in all_tasks:
-            print(f"- {task.name} {getattr(task,'duration','')}" )
-        print("_" * 50)
+    preload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preload")
+    writer = BackgroundWriter()
+    preload_future = None
+    previous_task_end = None
+    inter_task_gaps = []
+    tasks_iter = iter(all_tasks)
+    next_task = next(tasks_iter, None)
 
     try:
-        for task in all_tasks:
+        while next_task is not None:
+            task, next_task = next_task, None
 
             # clear events buffer in case the user pressed a lot of buttoons
             event.clearEvents()
+            shortcuts.pop()
 
             use_eyetracking = False
             if enable_eyetracker and task.use_eyetracking:
                 use_eyetracking = True
 
+            preload_wait = 0
+            if preload_future is not None:
+                preload_wait = time.monotonic()
+                preload_future.result()
+                preload_wait = time.monotonic() - preload_wait
+
             # setup task files (eg. video)
             task.setup(
                 exp_win,
@@ -244,8 +347,25 @@ Thanks for your participation!"""
                 use_fmri=use_fmri,
                 use_meg=use_meg,
             )
+            if previous_task_end is not None:
+                inter_task_gaps.append(time.monotonic() - previous_task_end)
+                logging.exp(
+                    msg="inter-task gap before %s: %.3fs (waited %.3fs for preload)"
+                    % (task.name, inter_task_gaps[-1], preload_wait))
             print("READY")
 
+            movie_recorder = None
+            if record_movie:
+                out_fname = os.path.join(
+                    task.output_path, "%s_%s.mp4" % (task.output_fname_base, task.name)
+                )
+                print(f"recording movie as {out_fname}")
+                movie_recorder = movie.MovieRecorder(exp_win, out_fname, fps=record_movie_fps)
+
+            if lookahead:
+                next_task = next(tasks_iter, None)
+                preload_future = preload_executor.submit(next_task.preload) if next_task else None
+
             while True:
                 # force focus on the task window to ensure getting keys, TTL, ...
                 exp_win.winHandle.activate()
@@ -257,13 +377,18 @@ Thanks for your participation!"""
                     ctl_win,
                     eyetracker_client,
                     gaze_drawer,
-                    record_movie=record_movie,
+                    record_movie=movie_recorder,
                 )
                 logging.flush()
 
+                # now that time is less sensitive: save files, while the next task starts
+                save_future = writer.submit("task - %s: save" % str(task), task.save)
+
                 if shortcut_evt == "n":
                     # restart the task
                     logging.exp(msg="task - %s: restart" % str(task))
+                    # the restarted task appends to the events being saved
+                    wait([save_future])
                     task.restart()
                     continue
                 elif shortcut_evt:
@@ -275,13 +400,22 @@ Thanks for your participation!"""
                     # send stop trigger/marker to MEG + Biopac (or anything else on parallel port)
                     break
 
-
-            if record_movie:
-                out_fname = os.path.join(
-                    task.output_path, "%s_%s.mp4" % (task.output_fname_base, task.name)
-                )
-                print(f"saving movie as {out_fname}")
-                exp_win.saveMovieFrames(out_fname, fps=10)
+            previous_task_end = time.monotonic()
+            if not lookahead and shortcut_evt != "q":
+                # generator sessions commit the subject progress when resumed,
+                # so only once the files of the run are written
+                if save_future.exception() is not None:
+                    print("ERROR: %s could not be saved, stopping the session" % task)
+                    shortcut_evt = "q"
+                else:
+                    next_task = next(tasks_iter, None)
+                    preload_future = preload_executor.submit(next_task.preload) if next_task else None
+
+            if movie_recorder:
+                # the last readback needs GL, the encoder is then waited in background
+                movie_recorder.finish_capture()
+                writer.submit("movie %s" % movie_recorder.out_fname, movie_recorder.close)
+            # `unload` must keep what `save` uses, the save may still be running
             task.unload()
 
             if shortcut_evt == "q":
@@ -294,6 +428,16 @@ Thanks for your participation!"""
                 for i in range(DELAY_BETWEEN_TASK * config.FRAME_RATE):
                     exp_win.flip(clearBuffer=i<2)
 
+        if inter_task_gaps:
+            msg = "inter-task gaps: mean %.3fs, max %.3fs over %d transitions" % (
+                sum(inter_task_gaps) / len(inter_task_gaps), max(inter_task_gaps), len(inter_task_gaps))
+            logging.exp(msg=msg)
+            print(msg)
+        utils.log_wake_errors()
+
+        # all files are written before the session ends
+        writer.wait_all()
+
         exp_win.saveFrameIntervals("exp_win_frame_intervals.txt")
         if ctl_win:
             ctl_win.saveFrameIntervals("ctl_win_frame_intervals.txt")
@@ -304,5 +448,10 @@ Thanks for your participation!"""
         logging.flush()
         print("you killing me!")
     finally:
+        preload_executor.shutdown(wait=False, cancel_futures=True)
+        # on quit or interruption too
+        writer.shutdown()
+        logging.flush()
+        log_file.close()
         if enable_eyetracker:
             eyetracker_client.join(TIMEOUT)
@@ -0,0 +1,380 @@
+# Columnar store of the task events: values are appended to typed arrays
+# (one per key) instead of keeping a dict per event, and the DataFrame is only
+# built when saving.
+# Frequent events (eg. one per flip) are logged through an EventWriter with
+# their values in a fixed key order: the values are queued in a flat list and
+# moved to the columns by chunks (one strided slice per key), so that no dict is
+# built per event.
+# Events are also streamed to an append-only journal by a background thread,
+# so that they can be recovered if the process is killed before saving.
+
+import os, sys, math, numbers, json, queue, threading
+from array import array
+import numpy as np
+import pandas
+
+JOURNAL_EXT = "jsonl.part"
+# max delay between logging an event and writing it to the journal file
+JOURNAL_FLUSH_INTERVAL = .2
+JOURNAL_MAX_BATCH = 256
+# rows queued by the writers before being moved to the columns
+PENDING_MAX_ROWS = 1024
+
+
+def _typecode(value):
+    """array typecode of a column: 'q' for ints, 'd' for floats, None for objects."""
+    if value.__class__ is bool or isinstance(value, np.bool_):
+        return None
+    if isinstance(value, numbers.Integral):
+        return 'q'
+    if isinstance(value, numbers.Real):
+        return 'd'
+    return None
+
+
+def _dtype_typecode(dtype):
+    kind = np.dtype(dtype).kind
+    return 'q' if kind in 'iu' else 'd' if kind == 'f' else None
+
+
+class _Column(object):
+    """Values of one key, in a typed array (ints, floats) or a list (other objects).
+
+    Rows without a value hold NaN (floats) or None (objects). Int columns with
+    missing rows are promoted to floats, as pandas does for a list of dicts.
+    A column created from a bool holds objects, but bools later stored in a
+    numeric column are kept as numbers.
+    """
+
+    __slots__ = ('typecode', 'values')
+
+    def __init__(self, typecode, length=0):
+        self.typecode = typecode
+        self.values = [] if typecode is None else array(typecode)
+        self.pad(length)
+
+    def pad(self, length):
+        missing = length - len(self.values)
+        if missing > 0:
+            if self.typecode == 'q':
+                self.promote('d')
+            self.values.extend([math.nan if self.typecode else None] * missing)
+
+    def promote(self, typecode):
+        if typecode is None:
+            self.values = [None if v != v else v for v in self.values]
+        else:
+            self.values = array(typecode, self.values)
+        self.typecode = typecode
+
+    def set(self, idx, value):
+        self.pad(idx)
+        try:
+            if idx == len(self.values):
+                self.values.append(value)
+            else:
+                self.values[idx] = value
+        except (TypeError, OverflowError):
+            # value does not fit the column type: ints -> floats -> objects
+            self.promote('d' if self.typecode == 'q' and _typecode(value) == 'd' else None)
+            self.set(idx, value)
+
+    def has(self, idx):
+        if idx >= len(self.values):
+            return False
+        value = self.values[idx]
+        return value is not None and value == value
+
+    def to_array(self, length):
+        self.pad(length)
+        if self.typecode is None:
+            return self.values
+        return np.frombuffer(self.values, dtype=np.int64 if self.typecode == 'q' else np.float64)
+
+
+class EventRow(object):
+    """dict-like view of one event, writes go to the buffer."""
+
+    __slots__ = ('_buffer', '_idx')
+
+    def __init__(self, buffer, idx):
+        self._buffer = buffer
+        self._idx = idx
+
+    def __getitem__(self, key):
+        column = self._buffer._columns.get(key)
+        if column is None or not column.has(self._idx):
+            raise KeyError(key)
+        return column.values[self._idx]
+
+    def __setitem__(self, key, value):
+        self._buffer._set(self._idx, key, value)
+        self._buffer._journal_write(self._idx, {key: value})
+
+    def __contains__(self, key):
+        column = self._buffer._columns.get(key)
+        return column is not None and column.has(self._idx)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def update(self, values=(), **kwargs):
+        values = dict(values, **kwargs)
+        for key, value in values.items():
+            self._buffer._set(self._idx, key, value)
+        self._buffer._journal_write(self._idx, values)
+
+    def keys(self):
+        return [key for key in self._buffer._order if self._buffer._columns[key].has(self._idx)]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return "EventRow(%r)" % self.to_dict()
+
+
+class EventWriter(object):
+    """Appends events with fixed keys to an EventBuffer, from their values in key order."""
+
+    __slots__ = ('_buffer', 'keys', '_max_pending')
+
+    def __init__(self, buffer, keys):
+        self._buffer = buffer
+        self.keys = tuple(keys)
+        self._max_pending = PENDING_MAX_ROWS * len(self.keys)
+
+    def write(self, *values):
+        buffer = self._buffer
+        pending = buffer._pending
+        if buffer._pending_keys is not self.keys or len(pending) >= self._max_pending:
+            buffer._flush_pending()
+            buffer._pending_keys = self.keys
+            pending = buffer._pending
+        pending.extend(values)
+        idx = buffer._len
+        buffer._len = idx + 1
+        if buffer._journal_path is not None:
+            buffer._journal_write(idx, values, self.keys)
+
+
+class EventBuffer(object):
+    """Append-only event table stored by columns.
+
+    `schema` maps the keys known in advance to their dtype, other keys get a
+    column on first use, typed from their first value (int, float or object)
+    and promoted if a later value does not fit.
+    Supports the subset of the list of dicts interface used by tasks:
+    append, len, indexing (with dict-like rows) and iteration.
+    If `journal_path` is set, events and row updates are also streamed to an
+    EventJournal opened on first write.
+    """
+
+    def __init__(self, schema=None, journal_path=None):
+        self._columns = {}
+        self._len = 0
+        self._order = []
+        # values of the rows of the last used writer, not yet in the columns
+        self._pending = []
+        self._pending_keys = None
+        self._schema = {key: _dtype_typecode(dtype) for key, dtype in (schema or {}).items()}
+        self._journal_path = journal_path
+        self._journal = None
+
+    def _journal_write(self, idx, values, keys=None):
+        if self._journal_path is None:
+            return
+        if self._journal is None:
+            self._journal = EventJournal(self._journal_path)
+        self._journal.write(idx, values, keys)
+
+    def writer(self, keys):
+        """Function appending an event from its values in the order of `keys`.
+
+        It is the write method of an EventWriter, cheaper to call than the writer itself.
+        """
+        return EventWriter(self, keys).write
+
+    def _flush_pending(self):
+        """Move the rows queued by the last writer to the columns."""
+        pending = self._pending
+        if not pending:
+            return
+        self._pending = []
+        n_keys = len(self._pending_keys)
+        start = self._len - len(pending) // n_keys
+        for k, key in enumerate(self._pending_keys):
+            idx = start
+            values = pending[k::n_keys]
+            column = self._columns.get(key)
+            if column is None or len(column.values) != idx:
+                # new or incomplete column, the first value sets it up
+                self._set(idx, key, values[0])
+                column = self._columns[key]
+                values = values[1:]
+                idx += 1
+            try:
+                if column.typecode is None:
+                    column.values.extend(values)
+                else:
+                    # the array is unchanged if a value does not fit
+                    column.values.fromlist(values)
+            except (TypeError, OverflowError):
+                # set one by one to promote the column
+                for i, value in enumerate(values, idx):
+                    self._set(i, key, value)
+
+    def close_journal(self, remove=False):
+        """Write the pending events and close the journal, removing it once saved."""
+        if self._journal is not None:
+            self._journal.close(remove)
+            self._journal = None
+
+    def _set(self, idx, key, value):
+        column = self._columns.get(key)
+        if column is None:
+            typecode = self._schema[key] if key in self._schema else _typecode(value)
+            column = self._columns[key] = _Column(typecode)
+            # columns are saved in order of first use, as pandas does for dicts
+            self._order.append(key)
+        column.set(idx, value)
+
+    def append(self, event):
+        if self._pending:
+            self._flush_pending()
+        idx = self._len
+        self._len = idx + 1
+        if self._journal_path is not None:
+            self._journal_write(idx, event)
+        columns = self._columns
+        for key, value in event.items():
+            column = columns.get(key)
+            # fast path: the column is up to date and the value fits its type
+            if column is not None:
+                values = column.values
+                if len(values) == idx:
+                    try:
+                        values.append(value)
+                        continue
+                    except (TypeError, OverflowError):
+                        pass
+            self._set(idx, key, value)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, idx):
+        self._flush_pending()
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError("event index out of range")
+        return EventRow(self, idx)
+
+    def __iter__(self):
+        self._flush_pending()
+        for idx in range(self._len):
+            yield EventRow(self, idx)
+
+    def to_dataframe(self):
+        self._flush_pending()
+        if not self._len:
+            return pandas.DataFrame()
+        return pandas.DataFrame({
+            key: self._columns[key].to_array(self._len) for key in self._order})
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+class EventJournal(object):
+    """Append-only jsonl file of `[event index, values]` lines.
+
+    Lines are queued without any formatting in the caller thread (values with
+    their keys for the rows of EventWriters), and written
+    by a daemon thread which flushes to the OS at least every
+    JOURNAL_FLUSH_INTERVAL, so a killed process loses at most that window.
+    """
+
+    def __init__(self, path, flush_interval=JOURNAL_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._queue = queue.SimpleQueue()
+        self._file = open(path, "a", encoding="utf-8")
+        self._thread = threading.Thread(target=self._write_loop, name="event-journal", daemon=True)
+        self._thread.start()
+
+    def write(self, idx, values, keys=None):
+        self._queue.put((idx, values, keys))
+
+    def _write_loop(self):
+        closing = False
+        while not closing:
+            try:
+                items = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            # drain what is queued (in bounded batches to not hold the GIL), then flush once
+            while len(items) < JOURNAL_MAX_BATCH:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for item in items:
+                if item is None:
+                    closing = True
+                    continue
+                idx, values, keys = item
+                if keys is not None:
+                    values = dict(zip(keys, values))
+                lines.append(json.dumps([idx, values], default=_json_default) + "\n")
+            self._file.write("".join(lines))
+            self._file.flush()
+        self._file.close()
+
+    def close(self, remove=False):
+        self._queue.put(None)
+        self._thread.join()
+        if remove:
+            os.remove(self.path)
+
+
+def read_journal(path):
+    """Rebuild the events DataFrame of a journal, ignoring a truncated last line."""
+    rows = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                idx, values = json.loads(line)
+            except ValueError:
+                break
+            rows.setdefault(idx, {}).update(values)
+    return pandas.DataFrame([rows[idx] for idx in sorted(rows)])
+
+
+def recover_journal(path):
+    """Save the events of a leftover journal as a tsv and remove the journal."""
+    base = path[:-len("." + JOURNAL_EXT)]
+    out_fname = base + ".tsv"
+    fi = 1
+    while os.path.exists(out_fname):
+        out_fname = f"{base}-{fi:03d}.tsv"
+        fi += 1
+    read_journal(path).to_csv(out_fname, sep="\t", index=False)
+    os.remove(path)
+    return out_fname
+
+
+if __name__ == "__main__":
+    # python -m src.shared.events <journal.jsonl.part>...
+    for path in sys.argv[1:]:
+        print(f"{path} recovered as {recover_journal(path)}")
@@ -0,0 +1,225 @@
+# Eyetracker samples received from Pupil Capture, kept in preallocated ring
+# buffers of typed records instead of the decoded msgpack dicts.
+# The listener thread drains all the pending messages of its SUB socket at
+# once and appends them per batch; the render thread reads the latest sample
+# or a time range without taking any lock.
+# Gaze payloads embed the pupil data they were mapped from (`base_data`), that
+# is already received on the pupil topic: they are decoded without it.
+# Calibration and validation captures are also typed arrays, saved without
+# pickled objects in an uncompressed npz, so that its members are memory-mapped
+# in place for analysis.
+
+import struct, zipfile
+import numpy as np
+import msgpack
+import zmq
+
+# keys of the gaze data decoded when no callback needs the whole datum
+GAZE_SAMPLE_KEYS = frozenset(("timestamp", "norm_pos", "confidence"))
+# fields kept from the pupil and gaze data, diameter is nan for gaze
+SAMPLE_DTYPE = np.dtype([
+    ("timestamp", np.float64),
+    ("norm_pos", np.float64, (2,)),
+    ("confidence", np.float64),
+    ("diameter", np.float64),
+])
+# id of the marker displayed when the sample was captured, -1 if none
+CAPTURE_DTYPE = np.dtype(SAMPLE_DTYPE.descr + [("marker", np.int16)])
+# calibration reference of a flip, sent to pupil as a dict
+REF_DTYPE = np.dtype([
+    ("timestamp", np.float64),
+    ("norm_pos", np.float64, (2,)),
+    ("screen_pos", np.float64, (2,)),
+    ("marker", np.int16),
+])
+# ~2min of samples at 250Hz
+SAMPLE_RING_CAPACITY = 2 ** 15
+# ~16s at 250Hz, doubled as needed
+CAPTURE_INITIAL_CAPACITY = 2 ** 12
+# ms, also bounds the time the listener takes to notice a pause or stop request
+DRAIN_POLL_TIMEOUT = 10
+# messages received per pass, so that a flood cannot starve the batch dispatch
+DRAIN_MAX_MESSAGES = 1024
+# topics that never have raw data frames (only sent for payloads with `__raw_data__`)
+SINGLE_FRAME_TOPICS = (b"pupil", b"gaze")
+
+
+def drain(socket, timeout=DRAIN_POLL_TIMEOUT, max_messages=DRAIN_MAX_MESSAGES):
+    """Wait up to `timeout` ms for a message, then receive all the pending ones as (topic, payload)."""
+    messages = []
+    # Socket.poll builds a Poller per call
+    if zmq.zmq_poll([(socket, zmq.POLLIN)], timeout):
+        recv = socket.recv
+        try:
+            while len(messages) < max_messages:
+                # one zmq.Again per batch is cheaper than querying the socket options per message
+                topic = recv(zmq.NOBLOCK)
+                # the frames of a message are delivered together
+                if topic.startswith(SINGLE_FRAME_TOPICS):
+                    # small payloads, copied faster than wrapped in a zero-copy frame
+                    messages.append((topic, recv()))
+                else:
+                    frame = recv(copy=False)
+                    messages.append((topic, frame.bytes))
+                    while frame.more:
+                        # raw data frames, unused
+                        frame = recv(copy=False)
+        except zmq.Again:
+            pass
+    return messages
+
+
+def gaze_decoder(keys=GAZE_SAMPLE_KEYS):
+    """Function decoding gaze payloads to dicts of `keys`, for use by a single thread.
+
+    The other values (`base_data`) are skipped without being decoded, by an
+    unpacker reused for all the payloads.
+    """
+    unpacker = msgpack.Unpacker()
+    read_map_header, unpack, skip = unpacker.read_map_header, unpacker.unpack, unpacker.skip
+
+    def decode(payload):
+        unpacker.feed(payload)
+        datum = {}
+        for _ in range(read_map_header()):
+            key = unpack()
+            if key in keys:
+                datum[key] = unpack()
+            else:
+                skip()
+        return datum
+
+    return decode
+
+
+def to_sample(datum):
+    return (datum["timestamp"], datum["norm_pos"], datum["confidence"], datum.get("diameter", np.nan))
+
+
+class SampleRing(object):
+    """Ring buffer of samples written by a single thread and read without lock.
+
+    The writer announces the slots it is about to overwrite in `_writing`, and
+    publishes them by setting `n_samples` once written: readers copy the slots
+    they need, then drop the ones that were overwritten meanwhile. The latest
+    datum, read every frame, is published as is, without copy out of the ring.
+    Samples are assumed to be appended by increasing timestamp.
+    """
+
+    def __init__(self, capacity=SAMPLE_RING_CAPACITY):
+        self.capacity = capacity
+        self._samples = np.zeros(capacity, dtype=SAMPLE_DTYPE)
+        self._times = self._samples["timestamp"]
+        self._writing = 0
+        self.n_samples = 0
+        self._latest = None
+
+    def extend(self, data):
+        """Append a list of decoded pupil or gaze data (dicts with the sample fields)."""
+        stop = self.n_samples + len(data)
+        # batches are small, row assignments are cheaper than building an array
+        data = data[-self.capacity:]
+        self._writing = stop
+        for i, datum in enumerate(data, stop - len(data)):
+            self._samples[i % self.capacity] = to_sample(datum)
+        self.n_samples = stop
+        self._latest = data[-1]
+
+    def _copy(self, start, stop):
+        """Samples [start, stop) still in the ring after being copied."""
+        samples = self._samples.take(np.arange(start, stop), mode="wrap")
+        overwritten = self._writing - self.capacity - start
+        return samples[overwritten:] if overwritten > 0 else samples
+
+    def _search(self, t, start, stop):
+        """First index in [start, stop) with a timestamp >= `t`."""
+        while start < stop:
+            mid = (start + stop) // 2
+            if self._times[mid % self.capacity] < t:
+                start = mid + 1
+            else:
+                stop = mid
+        return start
+
+    def latest(self):
+        """The latest datum appended, a dict with at least the sample fields."""
+        return self._latest
+
+    def between(self, t_start, t_stop):
+        """Copy of the samples with t_start <= timestamp < t_stop."""
+        n = self.n_samples
+        first = max(n - self.capacity, 0)
+        start = self._search(t_start, first, n)
+        return self._copy(start, self._search(t_stop, start, n))
+
+
+class Capture(object):
+    """Growable typed array, appended one row at a time by a single thread."""
+
+    def __init__(self, dtype=CAPTURE_DTYPE, capacity=CAPTURE_INITIAL_CAPACITY):
+        self._rows = np.zeros(capacity, dtype=dtype)
+        self._len = 0
+
+    def append(self, row):
+        if self._len == len(self._rows):
+            self._rows = np.concatenate((self._rows, np.zeros_like(self._rows)))
+        self._rows[self._len] = row
+        self._len += 1
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def array(self):
+        return self._rows[:self._len]
+
+
+def capture_row(datum, marker=-1):
+    return to_sample(datum) + (marker,)
+
+
+def assign_markers(captures, refs, max_interval):
+    """Set the marker of each capture to the one of the latest ref, if at most `max_interval` older."""
+    if not len(refs):
+        captures["marker"] = -1
+        return
+    ref_idx = np.searchsorted(refs["timestamp"], captures["timestamp"], side="right") - 1
+    valid = ref_idx >= 0
+    ref_idx = np.maximum(ref_idx, 0)
+    valid &= captures["timestamp"] - refs["timestamp"][ref_idx] <= max_interval
+    captures["marker"] = np.where(valid, refs["marker"][ref_idx], -1)
+
+
+def load_capture(path, mmap_mode="r"):
+    """Arrays of a capture npz, memory-mapped in place from its uncompressed members.
+
+    Members of the captures saved compressed are read in memory. Captures saved
+    before the typed storage hold pickled objects, and are not loaded.
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as npz, open(path, "rb") as f:
+        for info in npz.infolist():
+            key = info.filename[:-len(".npy")]
+            if mmap_mode is None or info.compress_type != zipfile.ZIP_STORED:
+                with npz.open(info) as member:
+                    arrays[key] = np.lib.format.read_array(member, allow_pickle=False)
+                continue
+            # the member data follows its local header, of variable length
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                raise ValueError(f"{path}: {key} holds pickled objects")
+            if not np.prod(shape):
+                # empty files cannot be mapped
+                arrays[key] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[key] = np.memmap(
+                path, dtype=dtype, mode=mmap_mode, shape=shape,
+                order="F" if fortran_order else "C", offset=f.tell())
+    return arrays
@@ -5,12 +5,11 @@ from .zmq_tools import *
 import msgpack
 
 import numpy as np
-from scipy.spatial.distance import pdist
 from psychopy import visual, core, data, logging, event
 from .ellipse import Ellipse
 
 from ..tasks.task_base import Task
-from . import config
+from . import config, eyesamples
 
 INSTRUCTION_DURATION = 2
 STARTCUE_DURATION = 2
@@ -19,6 +18,14 @@ CALIBRATE_HOTKEY = "c"
 
 MARKER_FILL_COLOR = (0.8, 0, 0.5)
 
+# validation: screen size and estimated eye-to-screen distance in pixels,
+# based on the screen size in degrees of visual angle (17.5, 14)
+SCREEN_SIZE_PIX = (1280, 1024)
+EYE_TO_SCREEN_PIX = 4164
+# resamples of the bootstrap interval of the median distance of each marker, 0 to skip
+QC_BOOTSTRAP_SAMPLES = 1000
+QC_CI = 95
+
 # 10-pt calibration
 MARKER_POSITIONS_10 = np.asarray(
     [
@@ -127,14 +134,17 @@ class EyetrackerCalibration_targets(Task):
             self.eyetracker.unset_pupil_cb()
             return
         if pupil["timestamp"] > self.task_start:
-            self._pupils_list.append(pupil)
+            self._pupils.append(eyesamples.capture_row(pupil))
+            # pupil calibrates on the full pupil data
+            if not self.validation:
+                self._pupils_list.append(pupil)
 
     def _gaze_cb(self, gaze):
         if gaze["timestamp"] > self.task_stop:
             self.eyetracker.unset_gaze_cb()
             return
         if gaze["timestamp"] > self.task_start:
-            self._gaze_list.append(gaze)
+            self._gaze.append(eyesamples.capture_row(gaze))
 
     def _run(self, exp_win, ctl_win):
 
@@ -173,15 +183,17 @@ class EyetrackerCalibration_targets(Task):
                 markers_order = np.random.permutation(markers_order)
 
             self.all_refs_per_flip = []
+            self._refs = eyesamples.Capture(eyesamples.REF_DTYPE)
             self._pupils_list = []
-            self._gaze_list = []
+            self._pupils = eyesamples.Capture()
+            self._gaze = eyesamples.Capture()
 
             self.task_start = time.monotonic()
             self.task_stop = np.inf
             self.eyetracker.set_pupil_cb(self._pupil_cb)
             self.eyetracker.set_gaze_cb(self._gaze_cb)
 
-            while not len(self._pupils_list):  # wait until we get at least a pupil
+            while not len(self._pupils):  # wait until we get at least a pupil
                 yield False
 
             if self.validation:
@@ -236,6 +248,7 @@ class EyetrackerCalibration_targets(Task):
                             "timestamp": time.monotonic(),  # =pupil frame timestamp on same computer
                         }
                         self.all_refs_per_flip.append(ref)  # accumulate all refs
+                        self._refs.append((ref["timestamp"], norm_pos, screen_pos, site_id))
                     yield True
             yield True
             print("completed markers")
@@ -245,11 +258,11 @@ class EyetrackerCalibration_targets(Task):
 
             if self.validation:
                 logging.info(
-                    f"validating on {len(self._pupils_list)} pupils and {len(self.all_refs_per_flip)} markers"
+                    f"validating on {len(self._pupils)} pupils and {len(self.all_refs_per_flip)} markers"
                 )
 
-                print('Ǹumber of received gaze: ', str(len(self._gaze_list)))
-                val_qc = self.eyetracker.validate(self._gaze_list,
+                print('Ǹumber of received gaze: ', str(len(self._gaze)))
+                val_qc = self.eyetracker.validate(self._gaze.array,
                                                   self.all_refs_per_flip,
                                                   self.marker_duration_frames - (self.calibration_lead_in + self.calibration_lead_out),
                                                   )
@@ -289,7 +302,7 @@ class EyetrackerCalibration_targets(Task):
 
             else:
                 logging.info(
-                    f"calibrating on {len(self._pupils_list)} pupils and {len(self.all_refs_per_flip)} markers"
+                    f"calibrating on {len(self._pupils)} pupils and {len(self.all_refs_per_flip)} markers"
                 )
                 logging.flush()
 
@@ -319,17 +332,16 @@ class EyetrackerCalibration_targets(Task):
     def stop(self, exp_win, ctl_win):
         self.eyetracker.unset_pupil_cb()
         self.eyetracker.unset_gaze_cb()
+        self._disarm_flip_time(exp_win)
         yield
 
     def _save(self):
-        if hasattr(self, "_pupils_list"):
+        if hasattr(self, "_pupils"):
             if self.validation:
                 fname = self._generate_unique_filename("valid-data", "npz")
             else:
                 fname = self._generate_unique_filename("calib-data", "npz")
-            np.savez(fname, pupils=self._pupils_list,
-                            gaze=self._gaze_list,
-                            markers=self.all_refs_per_flip)
+            save_captures(fname, self._refs.array, pupils=self._pupils.array, gaze=self._gaze.array)
 
 
 class EyetrackerCalibration(Task):
@@ -382,6 +394,8 @@ While awaiting for the calibration to start you will be asked to roll your eyes.
             self.eyetracker.unset_pupil_cb()
             return
         if pupil["timestamp"] > self.task_start:
+            self._pupils.append(eyesamples.capture_row(pupil))
+            # pupil calibrates on the full pupil data
             self._pupils_list.append(pupil)
 
     def _run(self, exp_win, ctl_win):
@@ -428,7 +442,9 @@ While awaiting for the calibration to start you will be asked to roll your eyes.
                 markers_order = np.random.permutation(markers_order)
 
             self.all_refs_per_flip = []
+            self._refs = eyesamples.Capture(eyesamples.REF_DTYPE)
             self._pupils_list = []
+            self._pupils = eyesamples.Capture()
 
             radius_anim = np.hstack(
                 [
@@ -445,7 +461,7 @@ While awaiting for the calibration to start you will be asked to roll your eyes.
             for _ in range(2):
                 instructions.draw(exp_win)
                 yield True
-            while not len(self._pupils_list):  # wait until we get at least a pupil
+            while not len(self._pupils):  # wait until we get at least a pupil
                 yield False
 
             exp_win.logOnFlip(
@@ -480,11 +496,12 @@ While awaiting for the calibration to start you will be asked to roll your eyes.
                             "timestamp": time.monotonic(),  # =pupil frame timestamp on same computer
                         }
                         self.all_refs_per_flip.append(ref)  # accumulate all refs
+                        self._refs.append((ref["timestamp"], norm_pos, screen_pos, site_id))
                     yield True
             yield True
             self.task_stop = time.monotonic()
             logging.info(
-                f"calibrating on {len(self._pupils_list)} pupils and {len(self.all_refs_per_flip)} markers"
+                f"calibrating on {len(self._pupils)} pupils and {len(self.all_refs_per_flip)} markers"
             )
             self.eyetracker.calibrate(self._pupils_list, self.all_refs_per_flip)
             while True:
@@ -500,12 +517,13 @@ While awaiting for the calibration to start you will be asked to roll your eyes.
     def stop(self, exp_win, ctl_win):
         self.eyetracker.unset_pupil_cb()
         self.eyetracker.pause()
+        self._disarm_flip_time(exp_win)
         yield
 
     def _save(self):
-        if hasattr(self, "_pupils_list"):
+        if hasattr(self, "_pupils"):
             fname = self._generate_unique_filename("calib-data", "npz")
-            np.savez(fname, pupils=self._pupils_list, markers=self.all_refs_per_flip)
+            save_captures(fname, self._refs.array, pupils=self._pupils.array)
 
 
 class EyetrackerSetup(Task):
@@ -553,37 +571,26 @@ class EyetrackerSetup(Task):
 
 from subprocess import Popen
 
-from contextlib import contextmanager
-
-
-@contextmanager
-def nonblocking(lock):
-    locked = lock.acquire(False)
-    try:
-        yield locked
-    finally:
-        if locked:
-            lock.release()
-
-
 class EyeTrackerClient(threading.Thread):
 
     EYE = "eye0"
 
     def __init__(self, output_path, output_fname_base, profile=False,
-                 debug=False, use_targets=False, validate_calib=False):
+                 debug=False, use_targets=False, validate_calib=False,
+                 simulate=False, simulator_args=()):
         super(EyeTrackerClient, self).__init__()
         self.stoprequest = threading.Event()
         self.paused = True
         self.pause_cond = threading.Condition(threading.Lock())
         self.pause_cond.acquire()
-        self.lock = threading.Lock()
         self._pupil_cb = self._gaze_cb = self._fix_cb = None
 
         self.pupil_monitor = None
 
-        self.pupil = None
-        self.gaze = None
+        # written by the listener thread only, read lock-free by the tasks
+        self.pupil_samples = eyesamples.SampleRing()
+        self.gaze_samples = eyesamples.SampleRing()
+        self._decode_gaze = eyesamples.gaze_decoder()
         self.unset_pupil_cb()
         self.unset_gaze_cb()
 
@@ -609,15 +616,24 @@ class EyeTrackerClient(threading.Thread):
         pupil_env = os.environ.copy()
         pupil_env.update({'ARV_DEBUG':'all:2'})
 
-        self._pupil_process = Popen(
-            [
+        if simulate:
+            # local stand-in publishing synthetic data, see pupil_sim.py
+            pupil_cmd = [
+                "python3",
+                os.path.join(os.path.dirname(__file__), "pupil_sim.py"),
+                "--port",
+                str(PUPIL_REMOTE_PORT),
+            ] + list(simulator_args)
+        else:
+            pupil_cmd = [
                 "python3",
                 os.path.join(os.environ["PUPIL_PATH"], "pupil_src", "main.py"),
                 "capture",
                 "--port",
                 str(PUPIL_REMOTE_PORT),
             ]
-            + dev_opts,
+        self._pupil_process = Popen(
+            pupil_cmd + dev_opts,
             env=pupil_env,
             stdout=pupil_logfile,
             stderr=pupil_logfile,
@@ -788,30 +804,44 @@ class EyeTrackerClient(threading.Thread):
                 time.sleep(1e-3)
                 continue
             with self.pause_cond:
-                msg = self.pupil_monitor.recv()
-                if not msg is None:
-                    topic, tmp = msg
-                    with self.lock:
-                        if topic.startswith("pupil"):
-                            self.pupil = tmp
-                            if self._pupil_cb:
-                                self._pupil_cb(tmp)
-                        elif topic.startswith("gaze"):
-                            self.gaze = tmp
-                            if self._gaze_cb:
-                                self._gaze_cb(tmp)
-                        elif topic.startswith("fixations"):
-                            self.fixation = tmp
-                            if self._fix_cb:
-                                self._fix_cb(tmp)
-                        elif topic.startswith("notify.calibration"):
-                            self._last_calibration_notification = tmp
-                        elif topic.startswith("notify.aravis.start_capture"):
-                            self._aravis_notification = tmp
+                # paused while waiting for the condition: the monitor is gone
+                messages = [] if self.paused else eyesamples.drain(self.pupil_monitor.socket)
+            if messages:
+                self._dispatch(messages)
         logging.info("eyetracker listener: stopping")
 
-
-
+    def _dispatch(self, messages):
+        pupils, gazes = [], []
+        # the gaze callbacks get the whole datum, otherwise only the sample fields are decoded
+        gaze_cb = self._gaze_cb
+        decode_gaze = msgpack.loads if gaze_cb else self._decode_gaze
+        for topic, payload in messages:
+            if topic.startswith(b"pupil"):
+                pupils.append(msgpack.loads(payload))
+            elif topic.startswith(b"gaze"):
+                gazes.append(decode_gaze(payload))
+            elif topic.startswith(b"fixations"):
+                self.fixation = msgpack.loads(payload)
+                if self._fix_cb:
+                    self._fix_cb(self.fixation)
+            elif topic.startswith(b"notify.calibration"):
+                self._last_calibration_notification = msgpack.loads(payload)
+            elif topic.startswith(b"notify.aravis.start_capture"):
+                self._aravis_notification = msgpack.loads(payload)
+        # samples are readable before the callbacks of the batch run
+        if pupils:
+            self.pupil_samples.extend(pupils)
+        if gazes:
+            self.gaze_samples.extend(gazes)
+        # callbacks can be unset meanwhile
+        for pupil in pupils:
+            if self._pupil_cb:
+                self._pupil_cb(pupil)
+        if gaze_cb:
+            # not a callback set after the batch was decoded
+            for gaze in gazes:
+                if self._gaze_cb:
+                    self._gaze_cb(gaze)
 
     def set_pupil_cb(self, pupil_cb):
         self._pupil_cb = pupil_cb
@@ -826,133 +856,148 @@ class EyeTrackerClient(threading.Thread):
         self._gaze_cb = None
 
     def get_pupil(self):
-        with nonblocking(self.lock) as locked:
-            if locked:
-                return self.pupil
+        return self.pupil_samples.latest()
 
     def get_gaze(self):
-        with nonblocking(self.lock) as locked:
-            if locked:
-                return self.gaze
+        return self.gaze_samples.latest()
 
 
     def get_marker_dictionary(self, ref_list):
-        position_list = []
         markers_dict = {}
-        count = 0
-
-        for i in range(len(ref_list)):
-            m = ref_list[i]
-            if not (m['norm_pos']) in position_list:
+        # marker of each position, refs of a marker are not always contiguous
+        marker_ids = {}
+
+        for m in ref_list:
+            pos = tuple(m['norm_pos'])
+            count = marker_ids.get(pos)
+            if count is None:
+                count = marker_ids[pos] = len(markers_dict)
                 markers_dict[count] = {
                     'norm_pos': m['norm_pos'],
                     'screen_pos': m['screen_pos'],
                     'onset': m['timestamp'],
                     'offset': -1.0,
                 }
-                count += 1
-                position_list.append(m['norm_pos'])
-            elif m['timestamp'] > markers_dict[count-1]['offset']:
-                markers_dict[count-1]['offset'] = m['timestamp']
+            elif m['timestamp'] > markers_dict[count]['offset']:
+                markers_dict[count]['offset'] = m['timestamp']
 
         return markers_dict
 
 
     def assign_gaze_to_markers(self, gaze_list, markers_dict):
         '''
-        Assign gaze to markers based on their timestamp
+        Assign gaze to markers based on their timestamp, from a list of gaze
+        dicts or an array of samples (eyesamples.SAMPLE_DTYPE)
         '''
-        i = 0
-        #print(markers_dict[0]['onset'], fixation_list[0]['timestamp'])
-        for count in range(len(markers_dict.keys())):
-            marker = markers_dict[count]
-            gaze_data = {'timestamps': [],
-                         'norm_pos': [],
-                         'confidence': [],
-                        }
-
-            while i < len(gaze_list) and gaze_list[i]['timestamp'] < marker['onset']:
-                i += 1
-
-            while i < len(gaze_list) and gaze_list[i]['timestamp'] < marker['offset']:
-                gaze = gaze_list[i]
-                gaze_data['timestamps'].append(gaze['timestamp'])
-                gaze_data['norm_pos'].append(gaze['norm_pos'])
-                gaze_data['confidence'].append(gaze['confidence'])
-                i += 1
-
-            markers_dict[count]['gaze_data'] = gaze_data
+        if isinstance(gaze_list, np.ndarray):
+            timestamps = gaze_list['timestamp']
+        else:
+            timestamps = np.fromiter((g['timestamp'] for g in gaze_list), dtype=float, count=len(gaze_list))
+        if np.any(timestamps[1:] < timestamps[:-1]):
+            order = np.argsort(timestamps, kind='stable')
+            timestamps = timestamps[order]
+            gaze_list = gaze_list[order] if isinstance(gaze_list, np.ndarray) else [gaze_list[i] for i in order]
+
+        n_markers = len(markers_dict)
+        onsets = np.array([markers_dict[count]['onset'] for count in range(n_markers)], dtype=float)
+        offsets = np.array([markers_dict[count]['offset'] for count in range(n_markers)], dtype=float)
+        starts = np.searchsorted(timestamps, onsets)
+        stops = np.searchsorted(timestamps, offsets)
+        # a gaze is assigned to one marker at most, in order of the markers
+        if n_markers:
+            ends = np.maximum.accumulate(np.maximum(starts, stops))
+            starts = np.maximum(starts, np.concatenate(([0], ends[:-1])))
+        stops = np.maximum(starts, stops)
+
+        # only the gaze during the markers are converted
+        first = starts.min() if n_markers else 0
+        last = stops.max() if n_markers else 0
+        if isinstance(gaze_list, np.ndarray):
+            norm_pos = gaze_list['norm_pos'][first:last]
+            confidence = gaze_list['confidence'][first:last]
+        else:
+            gaze = gaze_list[first:last]
+            norm_pos = np.fromiter(
+                (v for g in gaze for v in g['norm_pos']), dtype=float, count=2 * len(gaze)).reshape(-1, 2)
+            confidence = np.fromiter((g['confidence'] for g in gaze), dtype=float, count=len(gaze))
+        timestamps = timestamps[first:last]
+
+        for count in range(n_markers):
+            marker_gaze = slice(starts[count] - first, stops[count] - first)
+            markers_dict[count]['gaze_data'] = {
+                'timestamps': timestamps[marker_gaze],
+                'norm_pos': norm_pos[marker_gaze],
+                'confidence': confidence[marker_gaze],
+            }
 
         return markers_dict
 
 
-    def gaze_qc_per_marker(self, markers_dict, frames_per_marker, conf_thresh = 0.80):
+    def gaze_qc_per_marker(self, markers_dict, frames_per_marker, conf_thresh=0.80,
+                           n_bootstrap=QC_BOOTSTRAP_SAMPLES, ci=QC_CI, seed=None):
         '''
-        estimated eye-to-screen distance in pixels
-        based on screen dim in pixels ((1280, 1024)) and screen deg of visual angle (17.5, 14)
+        Visual angle between each marker and its gaze, all computed at once.
+        `conf_thresh` is one confidence threshold for all markers, or one per marker.
+        The median distance of each marker gets a bootstrap `ci`% confidence interval.
         '''
-        dist_in_pix = 4164 # in pixels
-
+        n_markers = len(markers_dict)
+        conf_thresh = np.broadcast_to(np.asarray(conf_thresh, dtype=float), (n_markers,))
+        gaze_data = [markers_dict[count]['gaze_data'] for count in range(n_markers)]
+        num_gzs = np.array([len(g['timestamps']) for g in gaze_data], dtype=int)
+        bounds = np.concatenate(([0], np.cumsum(num_gzs)))
+        marker_ids = np.repeat(np.arange(n_markers), num_gzs)
+
+        g_pos = np.concatenate([np.asarray(g['norm_pos'], dtype=float).reshape(-1, 2) for g in gaze_data])
+        g_conf = np.concatenate([np.asarray(g['confidence'], dtype=float) for g in gaze_data])
+        g_times = np.concatenate([np.asarray(g['timestamps'], dtype=float) for g in gaze_data])
+        m_pos = np.array([markers_dict[count]['norm_pos'] for count in range(n_markers)], dtype=float)
+        all_distances = visual_angles(g_pos, m_pos[marker_ids])
+        # filtrate gaze based on confidence threshold
+        g_filter = g_conf > conf_thresh[marker_ids]
+
+        rng = np.random.default_rng(seed)
+        expected_gz_count = 250*(frames_per_marker/60)
         val_qc = []
-        #print('Distance between gaze and target in degrees of visual angle')
-        #print('Good < 0.5 deg ; Fair = [0.5, 1.5[ deg ; Poor >= 1.5 deg')
-
-        for count in range(len(markers_dict.keys())):
-            m = markers_dict[count]
-            #print(f"Marker {count}, Normalized position: {m['norm_pos']}")
-
-            num_gz = len(m['gaze_data']['timestamps'])
-            expected_gz_count = 250*(frames_per_marker/60)
-
-            if num_gz:
-                # transform marker's normalized position into dim = (3,) vector in pixel space
-                m_vecpos = np.concatenate(((np.array(m['norm_pos']) - 0.5)*(1280, 1024), np.array([dist_in_pix])), axis=0)
-
-                g_conf = np.array(m['gaze_data']['confidence'])
-                # filtrate gaze based on confidence threshold
-                g_filter = g_conf > conf_thresh
-                g_pos = np.array(m['gaze_data']['norm_pos'])[g_filter]
-                g_times = np.array(m['gaze_data']['timestamps'])[g_filter]
-
-                gaze = (g_pos - 0.5)*(1280, 1024)
-                gaze_vecpos = np.concatenate((gaze, np.repeat(dist_in_pix, len(gaze)).reshape((-1, 1))), axis=1)
-
-                distances = []
-                for gz_vec in gaze_vecpos:
-                    vectors = np.stack((m_vecpos, gz_vec), axis=0)
-                    distance = np.rad2deg(np.arccos(1.0 - pdist(vectors, metric='cosine')))
-                    distances.append(distance[0])
-
-                distances = np.array(distances)
-                markers_dict[count]['gaze_data']['distances'] = {'distances': distances,
-                                                                 'timestamps': g_times,
-                                                                 }
-
-                num_dist = len(distances)
-                good = np.sum(distances < 0.5) / num_dist
-                fair = np.sum((distances >= 0.5)*(distances < 1.5)) / num_dist
-                poor = np.sum(distances >= 1.5) / num_dist
-
-                #print('Total gaze:' + str(num_gz) + ' , Good:' + str(good) + ' , Fair:' + str(fair) + ' , Poor:' + str(poor))
-                val_qc.append({
-                    'marker': count,
-                    'norm_pos': m['norm_pos'],
-                    'num_gz': num_gz,
-                    'gz_count_ratio': num_gz/expected_gz_count,
-                    'above_70conf_ratio': np.sum(g_conf > 0.7)/num_gz,
-                    'above_80conf_ratio': np.sum(g_conf > 0.8)/num_gz,
-                    'above_90conf_ratio': np.sum(g_conf > 0.9)/num_gz,
-                    'median_distance': np.median(distances),
-                    'good': good,
-                    'fair': fair,
-                    'poor': poor,
-                })
-            else:
+        for count in range(n_markers):
+            num_gz = num_gzs[count]
+            if not num_gz:
                 val_qc.append({
                     'marker': count,
-                    'norm_pos': m['norm_pos'],
+                    'norm_pos': markers_dict[count]['norm_pos'],
                     'num_gz': 0,
                 })
+                continue
+
+            marker_gaze = slice(bounds[count], bounds[count + 1])
+            m_conf = g_conf[marker_gaze]
+            m_filter = g_filter[marker_gaze]
+            distances = all_distances[marker_gaze][m_filter]
+            markers_dict[count]['gaze_data']['distances'] = {'distances': distances,
+                                                             'timestamps': g_times[marker_gaze][m_filter],
+                                                             }
+
+            num_dist = len(distances)
+            qc = {
+                'marker': count,
+                'norm_pos': markers_dict[count]['norm_pos'],
+                'num_gz': int(num_gz),
+                'conf_thresh': conf_thresh[count],
+                'gz_count_ratio': num_gz/expected_gz_count,
+                'above_70conf_ratio': np.sum(m_conf > 0.7)/num_gz,
+                'above_80conf_ratio': np.sum(m_conf > 0.8)/num_gz,
+                'above_90conf_ratio': np.sum(m_conf > 0.9)/num_gz,
+            }
+            if num_dist:
+                qc.update({
+                    'median_distance': np.median(distances),
+                    'good': np.sum(distances < 0.5) / num_dist,
+                    'fair': np.sum((distances >= 0.5)*(distances < 1.5)) / num_dist,
+                    'poor': np.sum(distances >= 1.5) / num_dist,
+                })
+                if n_bootstrap:
+                    qc['median_distance_ci_low'], qc['median_distance_ci_high'] = bootstrap_median_ci(
+                        distances, n_bootstrap, ci, rng)
+            val_qc.append(qc)
 
         def abc_mapping(val_num, cutoff_vals):
             if val_num > cutoff_vals[0]:
@@ -968,6 +1013,7 @@ class EyeTrackerClient(threading.Thread):
         print(f"CONFIDENCE >0.8 RATIO: {[round(x['above_80conf_ratio'], 3) for x in val_qc if 'above_80conf_ratio' in x]}")
         print(f"CONFIDENCE >0.9 RATIO: {[round(x['above_90conf_ratio'], 3) for x in val_qc if 'above_90conf_ratio' in x]}")
         print(f"MEDIAN DISTANCE 2 TARGET (deg of visual angle): {[round(x['median_distance'], 3) for x in val_qc if 'median_distance' in x]}")
+        print(f"MEDIAN DISTANCE {ci}% CI: {[(round(x['median_distance_ci_low'], 3), round(x['median_distance_ci_high'], 3)) for x in val_qc if 'median_distance_ci_low' in x]}")
         print('****************QUICK SUMMARY*********************')
         print(f"PUPIL DETECTION: {[abc_mapping(x['gz_count_ratio'], [0.97, 0.95]) for x in val_qc if 'gz_count_ratio' in x]}")
         print(f">70% CONF: {[abc_mapping(x['above_70conf_ratio'], [0.90, 0.80]) for x in val_qc if 'above_70conf_ratio' in x]}")
@@ -1028,13 +1074,13 @@ class EyeTrackerClient(threading.Thread):
         logging.info("calibration data sent to pupil")
         logging.flush()
 
-    def validate(self, gaze_list, ref_list, frames_per_marker):
+    def validate(self, gaze_list, ref_list, frames_per_marker, conf_thresh=0.80):
 
         markers_dict = self.get_marker_dictionary(ref_list)
         markers_dict = self.assign_gaze_to_markers(gaze_list, markers_dict)
         markers_dict, val_qc = self.gaze_qc_per_marker(markers_dict,
                                                        frames_per_marker,
-                                                       conf_thresh = 0.80,
+                                                       conf_thresh = conf_thresh,
                                                        )
 
         return val_qc
@@ -1064,6 +1110,39 @@ class GazeDrawer:
         self._gazepoint_stim.draw(self.win)
 
 
+def visual_angles(gaze_norm_pos, marker_norm_pos):
+    """Angles (deg) between gaze and marker normalized positions, as (n, 2) arrays."""
+    def eye_vectors(norm_pos):
+        # screen position in pixels, from the eye at the center of the screen
+        return np.concatenate(
+            ((norm_pos - 0.5) * SCREEN_SIZE_PIX, np.full((len(norm_pos), 1), EYE_TO_SCREEN_PIX)), axis=1)
+
+    gaze_vecs = eye_vectors(gaze_norm_pos)
+    marker_vecs = eye_vectors(marker_norm_pos)
+    cos = np.einsum('ij,ij->i', gaze_vecs, marker_vecs) / (
+        np.linalg.norm(gaze_vecs, axis=1) * np.linalg.norm(marker_vecs, axis=1))
+    return np.rad2deg(np.arccos(np.clip(cos, -1., 1.)))
+
+
+def bootstrap_median_ci(values, n_bootstrap=QC_BOOTSTRAP_SAMPLES, ci=QC_CI, rng=None):
+    """Percentile bootstrap confidence interval of the median of `values`."""
+    rng = rng or np.random.default_rng()
+    values = np.sort(values)
+    n = len(values)
+    # the middle resampled indices of the sorted values give the median of each resample
+    resamples = np.sort(rng.integers(n, size=(n_bootstrap, n)), axis=1)
+    medians = (values[resamples[:, (n - 1) // 2]] + values[resamples[:, n // 2]]) / 2
+    return tuple(np.percentile(medians, [(100 - ci) / 2, (100 + ci) / 2]))
+
+
+def save_captures(fname, refs, **captures):
+    """Save the captures of a calibration/validation as typed arrays, with the marker of each sample."""
+    for capture in captures.values():
+        eyesamples.assign_markers(capture, refs, 1.5 / config.FRAME_RATE)
+    # uncompressed, to be memory-mapped by eyesamples.load_capture
+    np.savez(fname, markers=refs, **captures)
+
+
 def read_pl_data(fname):
     with open(fname, "rb") as fh:
         for data in msgpack.Unpacker(fh, raw=False, use_list=False):
@@ -0,0 +1,127 @@
+# Per task record of the experiment window flip times, fed by the timeOnFlip
+# callbacks of Task._flip_all_windows, to account for dropped frames.
+# Lateness is measured from the flip request: with vsync, a flip returns at the
+# latest one frame period after it was requested, unless the frame missed the
+# retrace. Pauses between flips (static screen, waiting for a sound or
+# with wait_until_yield) are thus never counted as dropped frames, while the
+# flips following them are still timed.
+
+import json
+import numpy as np
+
+from . import config
+
+# ~18min at 60Hz, older flips are overwritten but still counted in the summary
+RING_CAPACITY = 2 ** 16
+# a flip is late if it returns more than this many frame periods after its request
+LATE_FLIP_RATIO = 1.2
+
+
+def generator_step(gen):
+    """Name and line where a (possibly delegating) generator is suspended."""
+    while getattr(gen, "gi_yieldfrom", None) is not None and hasattr(gen.gi_yieldfrom, "gi_frame"):
+        gen = gen.gi_yieldfrom
+    frame = getattr(gen, "gi_frame", None)
+    if frame is None:
+        return None
+    return f"{frame.f_code.co_name}:{frame.f_lineno}"
+
+
+class FrameTimer(object):
+    """Preallocated ring buffer of flip times and of the generator step preceding each flip.
+
+    `step` is set and `request` called before each flip, the latency of a flip
+    is the time from its request to its flip time (nan for flips not requested
+    through `request`).
+    """
+
+    def __init__(self, capacity=RING_CAPACITY, frame_rate=config.FRAME_RATE):
+        self.capacity = capacity
+        self.frame_period = 1. / frame_rate
+        self._times = np.empty(capacity, dtype=np.float64)
+        self._latencies = np.empty(capacity, dtype=np.float64)
+        self._steps = np.empty(capacity, dtype=np.int32)
+        self._step_names = []
+        self._step_ids = {}
+        self.step = None
+        self._requested = None
+        self.n_flips = 0
+        # running stats over all the flips, including the ones overwritten
+        self.n_late = 0
+        self.n_dropped = 0
+        self.max_latency = 0.
+
+    def _step_id(self, step):
+        step_id = self._step_ids.get(step)
+        if step_id is None:
+            step_id = self._step_ids[step] = len(self._step_names)
+            self._step_names.append(step)
+        return step_id
+
+    def request(self, request_time):
+        self._requested = request_time
+
+    def record(self, flip_time):
+        idx = self.n_flips % self.capacity
+        latency = np.nan
+        if self._requested is not None:
+            latency = flip_time - self._requested
+            self._requested = None
+            if latency > self.max_latency:
+                self.max_latency = latency
+            if latency > LATE_FLIP_RATIO * self.frame_period:
+                # each retrace missed after the one the flip was requested for
+                self.n_late += 1
+                self.n_dropped += max(int(latency / self.frame_period - (LATE_FLIP_RATIO - 1)), 1)
+        self._times[idx] = flip_time
+        self._latencies[idx] = latency
+        self._steps[idx] = self._step_id(self.step)
+        self.n_flips += 1
+
+    def _ordered(self):
+        if self.n_flips <= self.capacity:
+            n = self.n_flips
+            return self._times[:n], self._latencies[:n], self._steps[:n]
+        start = self.n_flips % self.capacity
+        return np.roll(self._times, -start), np.roll(self._latencies, -start), np.roll(self._steps, -start)
+
+    def summary(self):
+        _, latencies, steps = self._ordered()
+        measured = ~np.isnan(latencies)
+        latencies, steps = latencies[measured], steps[measured]
+        summary = {
+            "n_flips": self.n_flips,
+            "n_late_flips": self.n_late,
+            "n_dropped_frames": self.n_dropped,
+            "max_latency": float(self.max_latency),
+        }
+        if len(latencies):
+            summary.update({
+                "p50_latency": float(np.percentile(latencies, 50)),
+                "p99_latency": float(np.percentile(latencies, 99)),
+            })
+            late = latencies > LATE_FLIP_RATIO * self.frame_period
+            late_steps, counts = np.unique(steps[late], return_counts=True)
+            summary["late_flips_steps"] = {
+                str(self._step_names[s]): int(c) for s, c in zip(late_steps, counts)}
+        return summary
+
+    def save(self, fname, first_flip_time=None):
+        """Write the buffered flips to a tsv and the summary to its json sidecar."""
+        times, latencies, steps = self._ordered()
+        if not len(times):
+            return None
+        offset = times[0] if first_flip_time is None else first_flip_time
+        intervals = np.diff(times, prepend=np.nan)
+        with open(fname, "w") as f:
+            f.write("flip\tonset\tinterval\tlatency\tlate\tstep\n")
+            first_idx = self.n_flips - len(times)
+            for i, (t, interval, latency, step) in enumerate(zip(times, intervals, latencies, steps)):
+                f.write("%d\t%.6f\t%.6f\t%.6f\t%d\t%s\n" % (
+                    first_idx + i, t - offset, interval, latency,
+                    latency > LATE_FLIP_RATIO * self.frame_period,
+                    self._step_names[step]))
+        summary = self.summary()
+        with open(fname.rsplit(".", 1)[0] + ".json", "w") as f:
+            json.dump(summary, f, indent=1)
+        return summary
@@ -0,0 +1,123 @@
+# Session log file written by a background thread. On `logging.flush()`,
+# psychopy formats the log entries and writes them one by one to its targets,
+# then flushes the target stream: this target only buffers the entries, and
+# its stream is a stub whose flush wakes up the writer thread, so that the
+# frame loop never waits for the disk nor for the file lock.
+# Crash safety is measured rather than assumed: the writer tracks how long
+# logged entries stayed out of the OS (lost if the process is killed) and out
+# of the disk (lost if the system crashes).
+
+import os, time, queue, threading, collections
+from psychopy import logging
+
+# logging.flush signals queued before the caller blocks
+LOG_QUEUE_SIZE = 1024
+# max delay between writing to the OS and syncing to disk,
+# 0 to sync after every write, None to leave it to the OS
+LOG_FSYNC_INTERVAL = 1.
+
+
+class _FlushSignal(object):
+    """`stream` of the target as seen by psychopy, flushed once per logging.flush."""
+
+    def __init__(self, log_file):
+        self._log_file = log_file
+
+    def flush(self):
+        self._log_file._signal()
+
+
+class AsyncLogFile(logging.LogFile):
+    """psychopy LogFile whose entries are written by a writer thread at each logging.flush."""
+
+    def __init__(self, f, fsync_interval=LOG_FSYNC_INTERVAL, queue_size=LOG_QUEUE_SIZE, **kwargs):
+        super().__init__(f, **kwargs)
+        self._file = self.stream
+        self.stream = _FlushSignal(self)
+        self.fsync_interval = fsync_interval
+        # entries written since the last drain, appended and popped without lock
+        self._entries = collections.deque()
+        self._queue = queue.Queue(maxsize=queue_size)
+        # entries of a flush were logged after the previous flush was signaled
+        self._last_queued = time.monotonic()
+        self.n_stalls = 0
+        self.max_write_window = 0.
+        self.max_sync_window = 0.
+        self._thread = threading.Thread(target=self._write_loop, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, txt):
+        if not self._thread.is_alive():
+            # closed: eg. flush at exit
+            self._file.write(txt)
+            self._file.flush()
+            return
+        self._entries.append(txt)
+
+    def _signal(self):
+        now = time.monotonic()
+        logged_since, self._last_queued = self._last_queued, now
+        if not self._entries or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put_nowait(logged_since)
+        except queue.Full:
+            # never drop entries, wait for the writer instead
+            self.n_stalls += 1
+            self._queue.put(logged_since)
+
+    def _sync(self, unsynced_since):
+        os.fsync(self._file.fileno())
+        self.max_sync_window = max(self.max_sync_window, time.monotonic() - unsynced_since)
+
+    def _drain(self):
+        entries = self._entries
+        # only the entries present now, later ones are left to the next drain
+        txt = "".join([entries.popleft() for _ in range(len(entries))])
+        if txt:
+            self._file.write(txt)
+            self._file.flush()
+        return bool(txt)
+
+    def _write_loop(self):
+        last_sync = last_drain = time.monotonic()
+        unsynced_since = None
+        while True:
+            try:
+                logged_since = self._queue.get(timeout=self.fsync_interval or None)
+            except queue.Empty:
+                # entries written without logging.flush
+                logged_since = last_drain
+            if logged_since is None:
+                break
+            if self._drain():
+                self.max_write_window = max(self.max_write_window, time.monotonic() - logged_since)
+                if unsynced_since is None:
+                    unsynced_since = logged_since
+            last_drain = time.monotonic()
+            if (unsynced_since is not None and self.fsync_interval is not None and
+                    time.monotonic() - last_sync >= self.fsync_interval):
+                self._sync(unsynced_since)
+                last_sync = time.monotonic()
+                unsynced_since = None
+        if self._drain() and unsynced_since is None:
+            unsynced_since = last_drain
+        if unsynced_since is not None:
+            self._sync(unsynced_since)
+
+    def summary(self):
+        return {
+            "max_write_window": self.max_write_window,
+            "max_sync_window": self.max_sync_window,
+            "n_stalls": self.n_stalls,
+        }
+
+    def close(self):
+        """Write and sync the queued entries, later writes are synchronous."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        logging.exp(
+            "log file: max data-loss window %.3fs on process crash, %.3fs on system crash, "
+            "%d writer stalls" % (self.max_write_window, self.max_sync_window, self.n_stalls))
+        logging.flush()
@@ -0,0 +1,240 @@
+# Loudness analysis and normalization of audio stimuli (ITU-R BS.1770 style
+# K-weighted gated loudness), streamed by chunks so that long tracks are never
+# fully loaded, and batched over a process pool.
+
+import os, glob, json, wave
+import numpy as np
+from scipy.signal import lfilter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from . import audio
+
+TARGET_LUFS = -23.
+PEAK_CEILING_DB = -1.
+
+MUTEMUSIC_NORMALIZED_PATH = os.path.join('data', 'mutemusic', 'stimuli_normalized')
+MUTEMUSIC_LOUDNESS_MANIFEST = os.path.join('data', 'mutemusic', 'loudness_manifest.json')
+
+# gating blocks of 400ms with 75% overlap, computed from 100ms steps
+STEP_DURATION = .1
+STEPS_PER_BLOCK = 4
+ABSOLUTE_GATE = -70.
+RELATIVE_GATE = -10.
+
+
+def k_weighting(sample_rate):
+    """Return (b, a) of the K-weighting filter (high shelf + high pass) for any rate.
+
+    Bilinear transform parameters matching the BS.1770 48kHz coefficients.
+    """
+    # high shelf
+    gain_db, q, fc = 3.999843853973347, 0.7071752369554196, 1681.974450955533
+    K = np.tan(np.pi * fc / sample_rate)
+    Vh = 10 ** (gain_db / 20)
+    Vb = Vh ** 0.4996667741545416
+    a0 = 1 + K / q + K * K
+    b_shelf = np.array([Vh + Vb * K / q + K * K, 2 * (K * K - Vh), Vh - Vb * K / q + K * K]) / a0
+    a_shelf = np.array([a0, 2 * (K * K - 1), 1 - K / q + K * K]) / a0
+    # high pass
+    q, fc = 0.5003270373238773, 38.13547087602444
+    K = np.tan(np.pi * fc / sample_rate)
+    a0 = 1 + K / q + K * K
+    b_hp = np.array([1., -2., 1.])
+    a_hp = np.array([a0, 2 * (K * K - 1), 1 - K / q + K * K]) / a0
+
+    return np.convolve(b_shelf, b_hp), np.convolve(a_shelf, a_hp)
+
+
+def _to_db(value):
+    with np.errstate(divide='ignore'):
+        return float(10 * np.log10(value))
+
+
+def gated_loudness(block_energies):
+    """Integrated loudness (LUFS) from the mean square of each gating block."""
+    block_energies = np.asarray(block_energies)
+    with np.errstate(divide='ignore'):
+        block_loudness = -0.691 + 10 * np.log10(block_energies)
+    above_absolute = block_energies[block_loudness > ABSOLUTE_GATE]
+    if not len(above_absolute):
+        return -np.inf
+    relative_gate = -0.691 + _to_db(above_absolute.mean()) + RELATIVE_GATE
+    gated = block_energies[(block_loudness > ABSOLUTE_GATE) & (block_loudness > relative_gate)]
+    return -0.691 + _to_db(gated.mean())
+
+
+def measure(path, chunk_frames=audio.CHUNK_FRAMES):
+    """Measure integrated loudness, RMS and sample peak of a wav file in one pass.
+
+    Returns a dict with `lufs`, `rms_db` and `peak_db` (dBFS).
+    """
+    info = audio.get_wav_info(path)
+    full_scale = 2 ** (8 * info['sampwidth'] - 1)
+    step = int(round(STEP_DURATION * info['sample_rate']))
+    b, a = k_weighting(info['sample_rate'])
+    zi = np.zeros((len(a) - 1, info['channels']))
+
+    peak, sum_squares, n_frames = 0., 0., 0
+    steps_energy, remainder = [], np.zeros(0)
+    for chunk in audio.iter_wav_chunks(path, chunk_frames):
+        samples = chunk / full_scale
+        peak = max(peak, float(np.abs(samples).max()))
+        sum_squares += float(np.square(samples).sum())
+        n_frames += len(samples)
+        # channels are summed with unit weights (mono/stereo stimuli)
+        weighted, zi = lfilter(b, a, samples, axis=0, zi=zi)
+        squares = np.concatenate((remainder, np.square(weighted).sum(axis=1)))
+        n_steps = len(squares) // step
+        steps_energy.append(squares[:n_steps * step].reshape(n_steps, step).sum(axis=1))
+        remainder = squares[n_steps * step:]
+
+    steps_energy = np.concatenate(steps_energy or [np.zeros(0)])
+    if len(steps_energy) >= STEPS_PER_BLOCK:
+        block_sums = np.convolve(steps_energy, np.ones(STEPS_PER_BLOCK), mode='valid')
+        lufs = gated_loudness(block_sums / (STEPS_PER_BLOCK * step))
+    elif n_frames:
+        # shorter than a gating block: ungated loudness of the whole file
+        lufs = -0.691 + _to_db((steps_energy.sum() + remainder.sum()) / n_frames)
+    else:
+        lufs = -np.inf
+
+    return {
+        'lufs': lufs,
+        'rms_db': _to_db(sum_squares / max(n_frames * info['channels'], 1)),
+        'peak_db': 2 * _to_db(peak),
+    }
+
+
+def normalization_gain(loudness, target_lufs=TARGET_LUFS, peak_ceiling=PEAK_CEILING_DB):
+    """Gain (dB) to reach the target loudness, reduced so that peaks stay below the ceiling."""
+    if not np.isfinite(loudness['lufs']):
+        return 0., False
+    gain_db = target_lufs - loudness['lufs']
+    if loudness['peak_db'] + gain_db > peak_ceiling:
+        return peak_ceiling - loudness['peak_db'], True
+    return gain_db, False
+
+
+def write_gain(path, output_path, gain_db, chunk_frames=audio.CHUNK_FRAMES):
+    """Write a copy of a wav file with a gain applied, in the same sample format."""
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    gain = 10 ** (gain_db / 20)
+    tmp_path = output_path + '.tmp'
+    with wave.open(path, 'rb') as src, wave.open(tmp_path, 'wb') as dst:
+        dst.setparams(src.getparams())
+        sampwidth, nchannels = src.getsampwidth(), src.getnchannels()
+        full_scale = 2 ** (8 * sampwidth - 1)
+        while True:
+            raw = src.readframes(chunk_frames)
+            if not raw:
+                break
+            samples = audio._frames_to_array(raw, sampwidth, nchannels)
+            scaled = np.clip(np.rint(samples * gain), -full_scale, full_scale - 1)
+            dst.writeframes(audio._array_to_frames(scaled, sampwidth))
+    os.replace(tmp_path, output_path)
+
+
+def process_track(path, output_path, target_lufs=TARGET_LUFS, peak_ceiling=PEAK_CEILING_DB):
+    """Measure a track and write its normalized copy, returns its manifest entry."""
+    loudness = measure(path)
+    gain_db, limited = normalization_gain(loudness, target_lufs, peak_ceiling)
+    write_gain(path, output_path, gain_db)
+    stat = os.stat(path)
+    return dict(
+        loudness,
+        size=stat.st_size,
+        mtime=stat.st_mtime,
+        target_lufs=target_lufs,
+        peak_ceiling=peak_ceiling,
+        gain_db=gain_db,
+        peak_limited=limited,
+        normalized_path=output_path,
+    )
+
+
+class LoudnessManifest(object):
+    """Loudness measures and normalization gain of tracks, keyed by source path."""
+
+    def __init__(self, manifest_path=MUTEMUSIC_LOUDNESS_MANIFEST):
+        self.manifest_path = manifest_path
+        self.tracks = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.tracks = json.load(f)
+
+    def is_current(self, path, target_lufs, peak_ceiling):
+        entry = self.tracks.get(path)
+        if entry is None or not os.path.exists(entry['normalized_path']):
+            return False
+        stat = os.stat(path)
+        return (
+            entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime and
+            entry['target_lufs'] == target_lufs and entry['peak_ceiling'] == peak_ceiling)
+
+    def lookup(self, path):
+        """Return (source entry, gain applied to `path`) for a source or a normalized copy."""
+        if path in self.tracks:
+            return self.tracks[path], 0.
+        for entry in self.tracks.values():
+            if entry['normalized_path'] == path:
+                return entry, entry['gain_db']
+        return None, None
+
+    def save(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.tracks, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+
+def normalize_all(
+    paths,
+    stimuli_path=audio.MUTEMUSIC_STIMULI_PATH,
+    output_path=MUTEMUSIC_NORMALIZED_PATH,
+    manifest_path=MUTEMUSIC_LOUDNESS_MANIFEST,
+    target_lufs=TARGET_LUFS,
+    peak_ceiling=PEAK_CEILING_DB,
+    jobs=None,
+):
+    """Normalize the tracks that changed since the last run, over a process pool."""
+    manifest = LoudnessManifest(manifest_path)
+    todo = [p for p in paths if not manifest.is_current(p, target_lufs, peak_ceiling)]
+    if todo:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(
+                    process_track, path,
+                    os.path.join(output_path, os.path.relpath(path, stimuli_path)),
+                    target_lufs, peak_ceiling): path
+                for path in todo}
+            for future in as_completed(futures):
+                manifest.tracks[futures[future]] = future.result()
+        manifest.save()
+    return manifest, todo
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="measure loudness and write normalized copies of the mutemusic stimuli",
+    )
+    parser.add_argument("--stimuli", default=audio.MUTEMUSIC_STIMULI_PATH, help="stimuli folder")
+    parser.add_argument("--output", default=MUTEMUSIC_NORMALIZED_PATH, help="normalized stimuli folder")
+    parser.add_argument("--manifest", default=MUTEMUSIC_LOUDNESS_MANIFEST, help="manifest json file")
+    parser.add_argument("--target", type=float, default=TARGET_LUFS, help="target loudness (LUFS)")
+    parser.add_argument("--ceiling", type=float, default=PEAK_CEILING_DB, help="max sample peak (dBFS)")
+    parser.add_argument("--jobs", "-j", type=int, default=None, help="number of processes")
+    parsed = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(parsed.stimuli, '**', '*.wav'), recursive=True))
+    manifest, processed = normalize_all(
+        paths, parsed.stimuli, parsed.output, parsed.manifest, parsed.target, parsed.ceiling, parsed.jobs)
+    print(f"{len(processed)} of {len(paths)} tracks processed")
+    for path in paths:
+        entry = manifest.tracks[path]
+        print(
+            f"{path}: {entry['lufs']:.1f} LUFS, "
+            f"rms {entry['rms_db']:.1f}dB, peak {entry['peak_db']:.1f}dB, "
+            f"gain {entry['gain_db']:+.1f}dB{' (peak limited)' if entry['peak_limited'] else ''}")
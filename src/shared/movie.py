@@ -0,0 +1,121 @@
+# Movie recording of the experiment window (--record-movie), streamed to ffmpeg.
+# The back buffer is read into two alternating pixel buffer objects, so that
+# glReadPixels returns without waiting for the GPU, and each readback is only
+# mapped at the next capture, once the transfer is done. Frames are then piped
+# as raw RGB to an ffmpeg process by an encoder thread: each readback is copied
+# into one of a pool of preallocated frames, handed back by the encoder once
+# written, so the frame loop neither allocates nor waits for the encoder.
+
+import ctypes, queue, subprocess, threading
+from pyglet import gl
+from psychopy import logging
+
+from . import config
+
+MOVIE_FPS = 10
+# captured frames waiting for the encoder (~4MB each at 1280x1024), newer ones are dropped
+MOVIE_QUEUE_SIZE = 16
+
+
+class MovieRecorder(object):
+    """Capture frames of a window every `capture_every` flips and encode them as they come."""
+
+    def __init__(self, win, out_fname, fps=MOVIE_FPS, frame_rate=config.FRAME_RATE, codec="libx264"):
+        self.win = win
+        self.out_fname = out_fname
+        self.capture_every = max(int(round(frame_rate / fps)), 1)
+        self.fps = frame_rate / self.capture_every
+        self.width, self.height = [int(v) for v in getattr(win, "frameBufferSize", win.size)]
+        self._frame_bytes = self.width * self.height * 3
+        self.n_captured = 0
+        self.n_dropped = 0
+
+        self._pbos = (gl.GLuint * 2)()
+        gl.glGenBuffers(2, self._pbos)
+        for pbo in self._pbos:
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, pbo)
+            gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER, self._frame_bytes, None, gl.GL_STREAM_READ)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+
+        # the binary shipped with imageio-ffmpeg, as moviepy uses
+        from imageio_ffmpeg import get_ffmpeg_exe
+        self._ffmpeg = subprocess.Popen(
+            [
+                get_ffmpeg_exe(), "-y", "-loglevel", "error",
+                "-f", "rawvideo", "-pix_fmt", "rgb24",
+                "-s", f"{self.width}x{self.height}", "-framerate", f"{self.fps:g}",
+                "-i", "-",
+                # GL rows start from the bottom, x264 needs even sizes
+                "-vf", "vflip,scale=trunc(iw/2)*2:trunc(ih/2)*2",
+                "-c:v", codec, "-pix_fmt", "yuv420p",
+                out_fname,
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        self._queue = queue.Queue()
+        self._free_frames = queue.Queue()
+        for _ in range(MOVIE_QUEUE_SIZE):
+            self._free_frames.put(bytearray(self._frame_bytes))
+        self._thread = threading.Thread(target=self._encode_loop, name="movie-encoder", daemon=True)
+        self._thread.start()
+
+    def capture(self):
+        """Start the readback of the back buffer and queue the previous capture."""
+        if hasattr(self.win, "_setCurrent"):
+            self.win._setCurrent()
+        if self.n_captured:
+            self._queue_readback(self._pbos[(self.n_captured - 1) % 2])
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, self._pbos[self.n_captured % 2])
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+        gl.glReadBuffer(gl.GL_BACK)
+        # with a pack buffer bound, the pointer is an offset in the buffer
+        gl.glReadPixels(0, 0, self.width, self.height, gl.GL_RGB, gl.GL_UNSIGNED_BYTE, None)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        self.n_captured += 1
+
+    def _queue_readback(self, pbo):
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, pbo)
+        ptr = gl.glMapBuffer(gl.GL_PIXEL_PACK_BUFFER, gl.GL_READ_ONLY)
+        if ptr:
+            try:
+                frame = self._free_frames.get_nowait()
+            except queue.Empty:
+                # never stall the frame loop for the encoder
+                self.n_dropped += 1
+            else:
+                ctypes.memmove((ctypes.c_char * self._frame_bytes).from_buffer(frame), ptr, self._frame_bytes)
+                self._queue.put_nowait(frame)
+            gl.glUnmapBuffer(gl.GL_PIXEL_PACK_BUFFER)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+
+    def _encode_loop(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                break
+            try:
+                self._ffmpeg.stdin.write(frame)
+            except (BrokenPipeError, OSError):
+                # ffmpeg exited, its error is reported on close
+                pass
+            self._free_frames.put(frame)
+
+    def finish_capture(self):
+        """Queue the last capture and release the GL buffers, in the GL thread."""
+        if self.n_captured:
+            self._queue_readback(self._pbos[(self.n_captured - 1) % 2])
+        gl.glDeleteBuffers(2, self._pbos)
+
+    def close(self):
+        """Wait for the encoding of the queued frames, can run in another thread."""
+        self._queue.put(None)
+        self._thread.join()
+        _, stderr = self._ffmpeg.communicate()
+        if self._ffmpeg.returncode:
+            raise RuntimeError(
+                f"ffmpeg failed to encode {self.out_fname}: {stderr.decode(errors='replace').strip()}")
+        logging.exp(
+            "movie %s: %d frames at %gfps, %d dropped"
+            % (self.out_fname, self.n_captured, self.fps, self.n_dropped))
@@ -1,7 +1,7 @@
 import argparse
 
 
-def parse_args():
+def get_parser():
     parser = argparse.ArgumentParser(
         prog="main.py",
         description=("Run all tasks in a session"),
@@ -23,6 +23,11 @@ def parse_args():
     parser.add_argument(
         "--eyetracking", "-e", help="Enable eyetracking", action="store_true",
     )
+    parser.add_argument(
+        "--eyetracking-sim",
+        help="Enable eyetracking with a local simulator of pupil capture (src/shared/pupil_sim.py)",
+        action="store_true",
+    )
     parser.add_argument(
         "--target_ETcalibration", help="Use concentric circles for eyetracking calibration", action="store_true", default=True,
     )
@@ -59,4 +64,13 @@ def parse_args():
     parser.add_argument(
         "--record-movie", help="record a movie of each task", action="store_true"
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--record-movie-fps", help="capture rate of the recorded movies", default=10, type=float
+    )
+    # set by the planner (python -m src.shared.plan): sessions must not change the subject progress
+    parser.set_defaults(dry_run=False)
+    return parser
+
+
+def parse_args():
+    return get_parser().parse_args()
@@ -0,0 +1,161 @@
+# Dry-run planner of a session: expands the tasks of a session module (list or
+# generator, assuming no task completes) without opening any window, and
+# reports the expected wall time, stimuli bytes and memory of each task, and
+# whether the session fits the scan slot and the machine RAM.
+# Sessions are expanded with `parsed.dry_run` set, so that they work on a copy of
+# the subject progress and write nothing.
+# Tasks report their run duration in seconds with `Task.plan`, unlike their
+# `duration` attribute used for progress bars (seconds, trials or tracks). The
+# classes that do not implement it are listed, as their duration and memory
+# are unknown.
+# The plan is cached as json next to the session outputs, and reused as long as
+# the session and tasks code, the subject progress and the stimuli are unchanged.
+#
+# run from the repository root, with the same options as main.py:
+#   python -m src.shared.plan -s 01 -ss 001 -t mutemusic -o /data/dataset --slot 60
+
+import os, glob, json, hashlib, importlib, importlib.util, itertools, argparse
+import psutil
+
+from . import config, parser as session_parser
+from .progress import ProgressStore, PROGRESS_DB_NAME
+
+# generator sessions can yield tasks for a long time (eg. game levels)
+MAX_PLANNED_TASKS = 100
+
+
+def _file_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+
+def plan_tasks(tasks, max_tasks=MAX_PLANNED_TASKS):
+    plans = []
+    for task in itertools.islice(tasks, max_tasks):
+        try:
+            plans.append(task.plan())
+        except Exception as e:
+            # eg. missing stimuli, reported in the plan
+            plans.append({
+                "name": task.name, "cls": task.__class__.__name__, "duration": None,
+                "stimuli": [], "stimuli_bytes": 0, "memory": 0, "planned": True, "error": repr(e)})
+    return plans
+
+
+def summarize(plans, task_overhead, slot=None):
+    """Session totals, `task_overhead` (s) being added to each task run duration."""
+    durations = [p["duration"] for p in plans if p["duration"] is not None]
+    memory = [p["memory"] for p in plans]
+    ram = psutil.virtual_memory()
+    # the next task is preloaded while the current one runs
+    peak_memory = max([a + b for a, b in zip(memory, memory[1:])] + memory + [0])
+    summary = {
+        "n_tasks": len(plans),
+        "n_unknown_duration": len(plans) - len(durations),
+        "n_errors": sum("error" in p for p in plans),
+        "unplanned": sorted(set(p["cls"] for p in plans if not p.get("planned", True))),
+        "wall_time": sum(durations) + task_overhead * len(plans),
+        "stimuli_bytes": sum(p["stimuli_bytes"] for p in plans),
+        "peak_memory": peak_memory,
+        "ram_total": ram.total,
+        "ram_available": ram.available,
+        "fits_ram": peak_memory < ram.available,
+    }
+    if slot is not None:
+        summary["slot"] = slot
+        summary["fits_slot"] = summary["wall_time"] <= slot
+    return summary
+
+
+def _format_duration(seconds):
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    return "%d:%02d:%02d" % (minutes // 60, minutes % 60, seconds)
+
+
+def print_plan(plans, summary):
+    print("Here are the stimuli planned for today\n" + "_" * 50)
+    for plan in plans:
+        print("- %-40s %-22s %8s  stimuli %8.1fMB  memory %8.1fMB%s" % (
+            plan["name"], plan["cls"], _format_duration(plan["duration"]),
+            plan["stimuli_bytes"] / 1e6, plan["memory"] / 1e6,
+            "  ERROR %s" % plan["error"] if "error" in plan else ""))
+    print("_" * 50)
+    print("wall time %s%s%s, stimuli %.1fMB, peak memory %.1fMB (%.1fMB available)%s" % (
+        _format_duration(summary["wall_time"]),
+        " + %d tasks of unknown duration" % summary["n_unknown_duration"] if summary["n_unknown_duration"] else "",
+        " for a %s slot" % _format_duration(summary["slot"]) if "slot" in summary else "",
+        summary["stimuli_bytes"] / 1e6, summary["peak_memory"] / 1e6, summary["ram_available"] / 1e6,
+        "" if summary["fits_ram"] else " NOT ENOUGH MEMORY"))
+    if summary["unplanned"]:
+        print("WARNING: unknown duration and memory of %s" % ", ".join(summary["unplanned"]))
+    if not summary.get("fits_slot", True):
+        print("WARNING: the session does not fit the slot")
+
+
+def _cache_key(parsed, session_path):
+    """Hash of what the tasks of a session are generated from, except the stimuli."""
+    key = hashlib.sha1()
+    tasks_path = os.path.join(os.path.dirname(os.path.dirname(session_path)), "tasks")
+    for path in [session_path] + sorted(glob.glob(os.path.join(tasks_path, "*.py"))):
+        with open(path, "rb") as f:
+            key.update(f.read())
+    key.update(json.dumps([parsed.subject, parsed.session, parsed.tasks, parsed.skip_n_tasks]).encode())
+    progress_path = os.path.join(parsed.output, "sourcedata", PROGRESS_DB_NAME)
+    if os.path.exists(progress_path):
+        store = ProgressStore(progress_path, readonly=True)
+        key.update(json.dumps(store.all()).encode())
+        store.close()
+    return key.hexdigest()
+
+
+def load_or_plan(parsed, cache_path, max_tasks=MAX_PLANNED_TASKS, use_cache=True):
+    """Plans of the tasks of a session, from the cache if still valid."""
+    session_name = "src.sessions.ses-%s" % parsed.tasks
+    key = _cache_key(parsed, importlib.util.find_spec(session_name).origin)
+    if use_cache and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+        if cache["key"] == key and all(
+                _file_stat(path) == stat for path, stat in cache["stimuli_stats"].items()):
+            return cache["plans"]
+
+    ses_mod = importlib.import_module(session_name)
+    if hasattr(ses_mod, "get_tasks"):
+        tasks = ses_mod.get_tasks(argparse.Namespace(**dict(vars(parsed), dry_run=True)))
+    else:
+        tasks = ses_mod.TASKS
+    plans = plan_tasks(itertools.islice(tasks, parsed.skip_n_tasks, None), max_tasks)
+    stimuli_stats = {path: _file_stat(path) for plan in plans for path in plan["stimuli"]}
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"key": key, "stimuli_stats": stimuli_stats, "plans": plans}, f, indent=1)
+    os.replace(tmp_path, cache_path)
+    return plans
+
+
+if __name__ == "__main__":
+    from .cli import DELAY_BETWEEN_TASK
+
+    parser = session_parser.get_parser()
+    parser.prog = "python -m src.shared.plan"
+    parser.description = "Plan the tasks of a session without running them"
+    parser.add_argument("--slot", type=float, default=None, help="duration of the scan slot (min)")
+    parser.add_argument("--max-tasks", type=int, default=MAX_PLANNED_TASKS, help="max number of tasks to plan")
+    parser.add_argument("--no-cache", action="store_true", help="plan again even if the cache is valid")
+    parsed = parser.parse_args()
+
+    bids_sub_ses = ("sub-%s" % parsed.subject, "ses-%s" % parsed.session)
+    cache_path = os.path.join(
+        parsed.output, "sourcedata", *bids_sub_ses,
+        "%s_%s_task-%s_plan.json" % (*bids_sub_ses, parsed.tasks))
+    plans = load_or_plan(parsed, cache_path, parsed.max_tasks, not parsed.no_cache)
+    print_plan(plans, summarize(
+        plans,
+        config.INSTRUCTION_DURATION + DELAY_BETWEEN_TASK,
+        parsed.slot * 60 if parsed.slot else None))
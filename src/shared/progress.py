@@ -0,0 +1,119 @@
+# Progress of resumable sessions (which run/level a subject is at), stored in a
+# sqlite file shared by all sessions of a dataset.
+# Each update is a single transaction, so a crash can never leave a half
+# written state, and the WAL journal allows reading it while a session runs.
+# The planner opens it as a dry run: an in-memory copy of the dataset store, so
+# that sessions can seed and update it as usual without changing any subject.
+
+import os, json, time, sqlite3
+
+PROGRESS_DB_NAME = "progress.sqlite"
+
+
+class ProgressStore(object):
+
+    def __init__(self, path, readonly=False, dry_run=False):
+        self.path = path
+        if readonly:
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=10)
+        elif dry_run:
+            self._conn = sqlite3.connect(":memory:", isolation_level=None)
+            if os.path.exists(path):
+                stored = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=10)
+                stored.backup(self._conn)
+                stored.close()
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            # autocommit: every statement is its own transaction unless in `with self._conn`
+            self._conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=FULL")
+        if not readonly:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS progress (
+                    subject TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT,
+                    updated REAL,
+                    PRIMARY KEY (subject, name, key))""")
+
+    @classmethod
+    def for_dataset(cls, output_ds, **kwargs):
+        return cls(os.path.join(output_ds, "sourcedata", PROGRESS_DB_NAME), **kwargs)
+
+    def get(self, subject, name):
+        """Return all the keys of a subject progress as a dict."""
+        rows = self._conn.execute(
+            "SELECT key, value FROM progress WHERE subject=? AND name=?", (subject, name))
+        return {key: json.loads(value) for key, value in rows}
+
+    def set(self, subject, name, values):
+        """Atomically update one or several keys of a subject progress."""
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO progress VALUES (?, ?, ?, ?, ?)",
+                [(subject, name, key, json.dumps(value), now) for key, value in values.items()])
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def seed(self, subject, name, values):
+        """Set initial values, keeping any existing ones (eg. to import legacy state)."""
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO progress VALUES (?, ?, ?, ?, ?)",
+                [(subject, name, key, json.dumps(value), now) for key, value in values.items()])
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def all(self):
+        return self._conn.execute(
+            "SELECT subject, name, key, value, updated FROM progress ORDER BY subject, name, key"
+        ).fetchall()
+
+    def close(self):
+        self._conn.close()
+
+
+def load_savestate(output_ds, subject, name, default, legacy_path=None, dry_run=False):
+    """Load a session savestate dict, importing the legacy json file if any."""
+    store = ProgressStore.for_dataset(output_ds, dry_run=dry_run)
+    if legacy_path and os.path.exists(legacy_path):
+        with open(legacy_path) as f:
+            store.seed(subject, name, json.load(f))
+    savestate = dict(default)
+    savestate.update(store.get(subject, name))
+    return store, savestate
+
+
+def print_progress(output_ds):
+    start = time.perf_counter()
+    store = ProgressStore.for_dataset(output_ds, readonly=True)
+    rows = store.all()
+    store.close()
+    current = None
+    for subject, name, key, value, updated in rows:
+        if (subject, name) != current:
+            current = (subject, name)
+            print(f"{subject} {name}")
+        print(f"    {key}: {value} ({time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(updated))})")
+    print(f"{len(rows)} entries read in {(time.perf_counter() - start) * 1e3:.1f}ms")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="print the progress of all subjects in resumable sessions",
+    )
+    parser.add_argument("--output", "-o", required=True, help="output dataset")
+    parsed = parser.parse_args()
+    print_progress(parsed.output)
@@ -0,0 +1,225 @@
+# Local stand-in for Pupil Capture, to test and benchmark the eyetracking client
+# without the MRI camera stack.
+# Answers the Pupil Remote REQ commands used by the client (`SUB_PORT`,
+# `PUB_PORT`, `t`, `R`/`r` and `notify.*` notifications), and publishes
+# synthetic `pupil`, `gaze` and `fixations` data on its SUB port once the eye
+# source is started, timestamped with time.monotonic() as Pupil does on the same
+# computer. Gaze alternates fixations at random positions.
+# Each frame is published after `--latency` ms plus a half-normal jitter of
+# `--jitter` ms std, and whole frames are dropped during random dropouts, as
+# when the camera loses frames.
+# The `STATS` command (not part of Pupil Remote) replies the msgpack counts of
+# published and dropped data, for the benchmarks.
+#
+# selected in sessions by main.py --eyetracking-sim, or run standalone:
+#   python src/shared/pupil_sim.py --port 50123 --rate 250 --jitter 1
+
+import argparse, time
+import numpy as np
+import msgpack
+import zmq
+
+# default of the eyetracking client
+PUPIL_REMOTE_PORT = 50123
+EYE = "eye0"
+# s, mean and spread of the simulated fixations
+FIXATION_DURATION = (.2, .6)
+GAZE_NOISE = .005
+
+
+class PupilSimulator(object):
+
+    def __init__(self, port=PUPIL_REMOTE_PORT, rate=250., latency=0., jitter=1.,
+                 dropout_rate=0., dropout_duration=20., seed=None):
+        self.period = 1. / rate
+        self.latency = latency / 1e3
+        self.jitter = jitter / 1e3
+        self.dropout_rate = dropout_rate
+        self.dropout_duration = dropout_duration / 1e3
+        self._rng = np.random.default_rng(seed)
+
+        self._ctx = zmq.Context()
+        self._rep = self._ctx.socket(zmq.REP)
+        self._rep.bind(f"tcp://127.0.0.1:{port}")
+        self._pub = self._ctx.socket(zmq.PUB)
+        self.sub_port = self._pub.bind_to_random_port("tcp://127.0.0.1")
+        # Pupil subscribers would publish on this port, unused by the client
+        self._xsub = self._ctx.socket(zmq.XSUB)
+        self.pub_port = self._xsub.bind_to_random_port("tcp://127.0.0.1")
+
+        self.capturing = False
+        self.running = True
+        self.stats = {"pupil": 0, "gaze": 0, "fixations": 0, "dropped_frames": 0}
+        self._dropout_end = 0.
+        self._fixation = None
+
+    # Pupil Remote
+
+    def _reply(self, request):
+        command = request[0].decode()
+        if command == "SUB_PORT":
+            return str(self.sub_port).encode()
+        elif command == "PUB_PORT":
+            return str(self.pub_port).encode()
+        elif command == "t":
+            return repr(time.monotonic()).encode()
+        elif command == "STATS":
+            return msgpack.dumps(self.stats)
+        elif command in ("R", "r"):
+            self.notify({"subject": "recording.should_start" if command == "R" else "recording.should_stop"})
+            return b"OK"
+        elif command.startswith("notify.") and len(request) > 1:
+            self.notify(msgpack.loads(request[1]))
+            return b"Notification received"
+        return b"Unknown command."
+
+    def notify(self, notification):
+        """Echo a notification on the SUB port as Pupil does, and act on it."""
+        self.publish_notification(notification)
+        subject = notification["subject"]
+        name = notification.get("name")
+        if subject == "start_eye_plugin" and name == "Aravis_Source":
+            self.start_capture()
+            self.publish_notification({
+                "subject": "aravis.start_capture.successful", "target": EYE, "name": name})
+        elif subject == "capture.should_start":
+            self.start_capture()
+        elif subject == "capture.should_stop":
+            self.capturing = False
+        elif subject == "start_plugin" and name == "Gazer2D":
+            calib_data = notification.get("args", {}).get("calib_data", {})
+            if calib_data.get("pupil_list") and calib_data.get("ref_list"):
+                self.publish_notification({"subject": "calibration.successful", "method": name})
+            else:
+                self.publish_notification({"subject": "calibration.failed", "reason": "Not enough data"})
+        elif subject == "launcher_process.should_stop":
+            self.running = False
+
+    def publish_notification(self, notification):
+        topic = "notify." + notification["subject"]
+        self._pub.send_multipart((topic.encode(), msgpack.dumps(dict(notification, topic=topic))))
+
+    # eye data
+
+    def start_capture(self):
+        if not self.capturing:
+            self.capturing = True
+            self._next_capture = self._next_publish = time.monotonic()
+
+    def _next_frame(self):
+        """Capture time of the next frame, and when it is published."""
+        capture_time = self._next_capture
+        self._next_capture += self.period
+        delay = self.latency + abs(self._rng.normal(0, self.jitter)) if self.jitter else self.latency
+        # frames are processed in order
+        self._next_publish = max(capture_time + delay, self._next_publish)
+        return capture_time
+
+    def _dropped(self, timestamp):
+        if timestamp < self._dropout_end:
+            return True
+        if self.dropout_rate and self._rng.random() < self.dropout_rate * self.period:
+            self._dropout_end = timestamp + self._rng.exponential(self.dropout_duration)
+            return True
+        return False
+
+    def _gaze_position(self, timestamp):
+        fixation = self._fixation
+        if fixation is None or timestamp >= fixation["end"]:
+            if fixation is not None and fixation["n"]:
+                self.publish_fixation(fixation)
+            self._fixation = fixation = {
+                "norm_pos": self._rng.uniform(.1, .9, 2),
+                "start": timestamp,
+                "end": timestamp + self._rng.uniform(*FIXATION_DURATION),
+                "n": 0,
+            }
+        fixation["n"] += 1
+        return fixation["norm_pos"] + self._rng.normal(0, GAZE_NOISE, 2)
+
+    def publish_frame(self, timestamp):
+        norm_pos = self._gaze_position(timestamp).tolist()
+        confidence = min(1., self._rng.uniform(.6, 1.1))
+        pupil = {
+            "id": 0, "topic": "pupil.0.2d", "method": "2d c++",
+            "norm_pos": norm_pos,
+            "diameter": 40 + self._rng.normal(0, 2),
+            "confidence": confidence,
+            "timestamp": timestamp,
+            "ellipse": {"center": [norm_pos[0] * 640, (1 - norm_pos[1]) * 480], "axes": [40., 42.], "angle": 10.},
+            "location": [norm_pos[0] * 640, (1 - norm_pos[1]) * 480],
+            "model_confidence": 1.,
+        }
+        gaze = {
+            "topic": "gaze.2d.0.", "norm_pos": norm_pos, "confidence": confidence,
+            "timestamp": timestamp, "base_data": [pupil],
+        }
+        self._pub.send_multipart((b"pupil.0.2d", msgpack.dumps(pupil)))
+        self._pub.send_multipart((b"gaze.2d.0.", msgpack.dumps(gaze)))
+        self.stats["pupil"] += 1
+        self.stats["gaze"] += 1
+
+    def publish_fixation(self, fixation):
+        datum = {
+            "topic": "fixations", "id": self.stats["fixations"],
+            "norm_pos": fixation["norm_pos"].tolist(),
+            "dispersion": GAZE_NOISE * 100,
+            "duration": (fixation["end"] - fixation["start"]) * 1e3,
+            "confidence": 1., "method": "2d gaze",
+            "timestamp": fixation["start"],
+        }
+        self._pub.send_multipart((b"fixations", msgpack.dumps(datum)))
+        self.stats["fixations"] += 1
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self._rep, zmq.POLLIN)
+        capture_time = None
+        while self.running:
+            if self.capturing and capture_time is None:
+                capture_time = self._next_frame()
+            # ms resolution: frames due within the same ms are published together
+            timeout = None if capture_time is None else max(int(np.ceil((self._next_publish - time.monotonic()) * 1e3)), 0)
+            if poller.poll(timeout):
+                self._rep.send(self._reply(self._rep.recv_multipart()))
+            now = time.monotonic()
+            while self.capturing and capture_time is not None and self._next_publish <= now:
+                if self._dropped(capture_time):
+                    self.stats["dropped_frames"] += 1
+                else:
+                    self.publish_frame(capture_time)
+                capture_time = self._next_frame()
+            if not self.capturing:
+                capture_time = None
+        self.close()
+
+    def close(self):
+        for socket in (self._rep, self._pub, self._xsub):
+            socket.close(linger=100)
+        self._ctx.term()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for Pupil Capture, publishing synthetic eyetracking data",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--port", type=int, default=PUPIL_REMOTE_PORT, help="Pupil Remote port")
+    parser.add_argument("--rate", type=float, default=250., help="eye camera frame rate (Hz)")
+    parser.add_argument("--latency", type=float, default=0., help="processing latency of each frame (ms)")
+    parser.add_argument("--jitter", type=float, default=1., help="std of the half-normal latency jitter (ms)")
+    parser.add_argument("--dropout-rate", type=float, default=0., help="frame dropouts per second")
+    parser.add_argument("--dropout-duration", type=float, default=20., help="mean duration of the dropouts (ms)")
+    parser.add_argument("--seed", type=int, default=None)
+    # options of pupil_src/main.py passed by the client, ignored
+    parser.add_argument("--debug", action="store_true")
+    parser.add_argument("--profile", action="store_true")
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    PupilSimulator(
+        port=args.port, rate=args.rate, latency=args.latency, jitter=args.jitter,
+        dropout_rate=args.dropout_rate, dropout_duration=args.dropout_duration, seed=args.seed,
+    ).run()
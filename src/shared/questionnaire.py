@@ -0,0 +1,211 @@
+import time
+import numpy as np
+from psychopy import visual, logging
+
+ACTIVE_LINE_COLOR = (0, -1, -1)
+LINE_COLOR = (-1, -1, -1)
+SELECTED_FILL_COLOR = (1, 1, 1)
+FILL_COLOR = (-1, -1, -1)
+
+
+class LikertQuestionnaire(object):
+    """Likert scales built once, with their text rendered once.
+
+    Only bullets fill color, active line color and question bold style are
+    mutated when answering, so showing the questionnaire again is cheap.
+
+    questions: list of (key, question, n_pts)
+    point_labels: a label per point, for a single question with labelled points
+        (layout of mutemusic), otherwise questions are stacked with their text
+        on the left and `legends` above the scales.
+    """
+
+    def __init__(
+        self,
+        win,
+        questions,
+        point_labels=None,
+        legends=('Disagree', 'Agree'),
+        legends_y_ratio=1.4,
+        y_spacing=80,
+    ):
+        self.win = win
+        self.questions = questions
+        self._highlight_active = point_labels is None
+        self.lines, self.bullets, self.texts, self.legends = [], [], [], []
+
+        if point_labels is None:
+            self._build_stacked(legends, legends_y_ratio, y_spacing)
+        else:
+            self._build_labelled(point_labels, y_spacing)
+        self._stims = self.lines + sum(self.bullets, []) + self.texts + self.legends
+        self._bold = [False] * len(self.texts)
+        self.draw_durations = []
+        self.reset()
+
+    def _build_stacked(self, legends, legends_y_ratio, y_spacing):
+        win_width = self.win.size[0]
+        scales_block_x = win_width * 0.25
+        scales_block_y = len(self.questions) // 2 * y_spacing
+        extent = win_width * 0.2
+
+        for text, x in zip(legends, (scales_block_x - extent*0.75, scales_block_x + extent*1.15)):
+            self.legends.append(visual.TextStim(
+                self.win,
+                text=text,
+                units="pix",
+                pos=(x, scales_block_y*legends_y_ratio),
+                wrapWidth=win_width * 0.5,
+                height=y_spacing / 3,
+                anchorHoriz="right",
+                alignText="right",
+                bold=True
+            ))
+
+        for q_n, (key, question, n_pts) in enumerate(self.questions):
+            y_pos = scales_block_y - q_n * y_spacing
+            self._add_scale(scales_block_x - extent, scales_block_x + extent, y_pos, n_pts)
+            self.texts.append(visual.TextStim(
+                self.win,
+                text=question,
+                units="pix",
+                pos=(0, y_pos),
+                wrapWidth=win_width * 0.5,
+                height=y_spacing / 3,
+                anchorHoriz="right",
+                alignText="right"
+            ))
+
+    def _build_labelled(self, point_labels, y_spacing):
+        win_width, win_height = self.win.size
+        scales_block_x = win_width * 0.25
+        scales_block_y = win_height * 0.1
+        extent = win_width * 0.2
+        y_pos = scales_block_y - y_spacing
+        key, question, n_pts = self.questions[0]
+        x_start, x_spacing = self._add_scale(-(scales_block_x + extent), scales_block_x + extent, y_pos, n_pts)
+
+        self.legends.extend([
+            visual.TextStim(
+                self.win,
+                text=label,
+                units="pix",
+                pos=(x_start + i * x_spacing, win_height * 0.1),
+                wrapWidth=win_width * 0.12,
+                height=y_spacing / 4.5,
+                anchorHoriz="center",
+                alignText="center",
+                bold=True
+            )
+            for i, label in enumerate(point_labels)
+        ])
+        self.texts.append(visual.TextStim(
+            self.win,
+            text=question,
+            units="pix",
+            pos=(x_start, y_pos + win_height * 0.30),
+            wrapWidth=win_width - (win_width*0.1),
+            height=y_spacing / 3,
+            anchorHoriz="left",
+            alignText="left"
+        ))
+
+    def _add_scale(self, x_start, x_stop, y_pos, n_pts):
+        x_spacing = (x_stop - x_start) / (n_pts - 1)
+        self.lines.append(visual.Line(
+            self.win,
+            (x_start, y_pos),
+            (x_stop, y_pos),
+            units="pix",
+            lineWidth=6,
+            autoLog=False,
+            lineColor=LINE_COLOR,
+        ))
+        self.bullets.append([
+            visual.Circle(
+                self.win,
+                units="pix",
+                radius=10,
+                pos=(x_start + i * x_spacing, y_pos),
+                fillColor=FILL_COLOR,
+                lineColor=LINE_COLOR,
+                lineWidth=10,
+                autoLog=False,
+            )
+            for i in range(n_pts)
+        ])
+        return x_start, x_spacing
+
+    def reset(self):
+        self.active_question = 0
+        self.responses = [n_pts // 2 for key, question, n_pts in self.questions]
+        self._displayed = [None] * len(self.questions)
+        self._displayed_active = None
+        self._update_stims()
+
+    def handle_keys(self, keys):
+        """Update the state from pressed keys (u/d/l/r/a).
+
+        Returns 'a' when answers are confirmed, True if a value or the active
+        question changed, False otherwise.
+        """
+        n_pts = self.questions[self.active_question][2]
+        if "u" in keys and self.active_question > 0:
+            self.active_question -= 1
+        elif "d" in keys and self.active_question < len(self.questions) - 1:
+            self.active_question += 1
+        elif "r" in keys and self.responses[self.active_question] < n_pts - 1:
+            self.responses[self.active_question] += 1
+        elif "l" in keys and self.responses[self.active_question] > 0:
+            self.responses[self.active_question] -= 1
+        elif "a" in keys:
+            return "a"
+        else:
+            return False
+        self._update_stims()
+        return True
+
+    def _update_stims(self):
+        # only mutate the stimuli that changed since last display
+        for q_n, (bullets, response) in enumerate(zip(self.bullets, self.responses)):
+            if self._displayed[q_n] != response:
+                if self._displayed[q_n] is not None:
+                    bullets[self._displayed[q_n]].fillColor = FILL_COLOR
+                bullets[response].fillColor = SELECTED_FILL_COLOR
+                self._displayed[q_n] = response
+        if self._highlight_active and self._displayed_active != self.active_question:
+            for q_n, (txt, line) in enumerate(zip(self.texts, self.lines)):
+                active = q_n == self.active_question
+                line.lineColor = ACTIVE_LINE_COLOR if active else LINE_COLOR
+                if self._bold[q_n] != active:
+                    txt._pygletTextObj.set_style('bold', active)
+                    self._bold[q_n] = active
+            self._displayed_active = self.active_question
+
+    def draw(self, win=None):
+        draw_start = time.perf_counter()
+        win = win or self.win
+        for stim in self._stims:
+            stim.draw(win)
+        self.draw_durations.append(time.perf_counter() - draw_start)
+
+    def draw_stats(self, reset=True):
+        """Summary of the per-frame draw cost (in ms) since last reset."""
+        durations = np.asarray(self.draw_durations) * 1e3
+        if reset:
+            self.draw_durations = []
+        if not len(durations):
+            return {'n_draws': 0}
+        return {
+            'n_draws': len(durations),
+            'mean_ms': durations.mean(),
+            'p99_ms': np.percentile(durations, 99),
+            'max_ms': durations.max(),
+        }
+
+    def log_draw_stats(self, name):
+        stats = self.draw_stats()
+        if stats['n_draws']:
+            logging.exp(
+                "questionnaire %s draw cost: %d draws, mean %.3fms, p99 %.3fms, max %.3fms"
+                % (name, stats['n_draws'], stats['mean_ms'], stats['p99_ms'], stats['max_ms']))
@@ -0,0 +1,303 @@
+# Headless simulation of a session, to benchmark the tasks code without a
+# screen, scanner or eyetracker.
+# The real tasks run in an offscreen window (pyglet headless, software GL is
+# enough), whose flips are paced at the frame rate. Psychopy clocks and sleeps
+# can be sped up to fast-forward through long tasks. Scanner TTLs and button
+# presses are injected as window key events, so they go through the same
+# handlers as real keys. Audio and movie playback are not sped up.
+#
+# Reports, for each task: setup time, CPU time and net allocated blocks of each
+# generator step (where the task code was suspended), save time and frame
+# timing, to the console and to a json file next to the task outputs.
+#
+# run from the repository root, with the same options as main.py:
+#   python -m src.shared.simulate -s 01 -ss 001 -t retino -o /tmp/sim --fmri --speed 10
+
+import os, sys, json, time, random, datetime, importlib, itertools, tracemalloc
+import numpy as np
+import pyglet
+
+if "--display" not in sys.argv:
+    pyglet.options["headless"] = True
+
+from psychopy import clock, core, visual, logging
+
+from . import config, fmri, frametiming, parser as session_parser
+
+TTL_KEY = fmri.MR_settings["sync"][0]
+# steps listed in the report of each task, by total CPU time
+REPORT_TOP_STEPS = 10
+
+
+class ScaledTime(object):
+    """Make psychopy clocks and time.sleep run `speed` times faster."""
+
+    def __init__(self, speed):
+        self.speed = speed
+        self._get_time = clock.getTime
+        self._sleep = time.sleep
+        self._origin = self._get_time()
+
+    def get_time(self, *args, **kwargs):
+        return self._origin + (self._get_time(*args, **kwargs) - self._origin) * self.speed
+
+    def sleep(self, secs):
+        self._sleep(max(secs, 0) / self.speed)
+
+    def __enter__(self):
+        if self.speed != 1:
+            clock.getTime = core.getTime = self.get_time
+            time.sleep = self.sleep
+        return self
+
+    def __exit__(self, *exc):
+        clock.getTime = core.getTime = self._get_time
+        time.sleep = self._sleep
+
+
+def _key_symbol(name):
+    return getattr(pyglet.window.key, name.upper(), None) or getattr(pyglet.window.key, "_" + name)
+
+
+class SimulatedInputs(object):
+    """Scanner TTLs every TR and random button presses, sent as window key events."""
+
+    def __init__(self, win, tr=None, keys=(), key_interval=2., seed=0):
+        self.win = win
+        self.tr = tr
+        self.keys = list(keys)
+        self.key_interval = key_interval
+        self._rng = random.Random(seed)
+        self._released = []
+        self.n_ttls = 0
+        self.n_presses = 0
+        self.start()
+
+    def start(self):
+        now = core.getTime()
+        self._next_ttl = now
+        self._next_press = now + self._rng.expovariate(1. / self.key_interval)
+
+    def _dispatch(self, event_type, name):
+        self.win.winHandle.dispatch_event(event_type, _key_symbol(name), 0)
+
+    def update(self):
+        now = core.getTime()
+        # keys are released one update after being pressed
+        for name in self._released:
+            self._dispatch("on_key_release", name)
+        self._released = []
+        while self.tr and now >= self._next_ttl:
+            self._dispatch("on_key_press", TTL_KEY)
+            self._released.append(TTL_KEY)
+            self._next_ttl += self.tr
+            self.n_ttls += 1
+        if self.keys and now >= self._next_press:
+            name = self._rng.choice(self.keys)
+            self._dispatch("on_key_press", name)
+            self._released.append(name)
+            self._next_press = now + self._rng.expovariate(1. / self.key_interval)
+            self.n_presses += 1
+
+
+class PacedFlip(object):
+    """Replace a window flip, to flip at most at the frame rate (in psychopy time)."""
+
+    def __init__(self, win, frame_rate=config.FRAME_RATE):
+        self._flip = win.flip
+        self.period = 1. / frame_rate
+        self._last = core.getTime()
+
+    def __call__(self, *args, **kwargs):
+        remaining = self._last + self.period - core.getTime()
+        if remaining > 0:
+            time.sleep(remaining)
+        self._last = max(self._last + self.period, core.getTime() - self.period)
+        return self._flip(*args, **kwargs)
+
+
+def _current_step(gen):
+    """Step of the task generator wrapped by Task.instructions/run/stop, or of `gen`."""
+    frame = gen.gi_frame
+    if frame is not None:
+        for name in ("instructions_gen", "run_gen", "stop_gen"):
+            inner = frame.f_locals.get(name)
+            if inner is not None:
+                return frametiming.generator_step(inner)
+    return frametiming.generator_step(gen)
+
+
+class StepStats(object):
+    """CPU time and net allocated blocks of each generator step, grouped by step name."""
+
+    def __init__(self):
+        self.cpu = {}
+        self.blocks = {}
+
+    def add(self, step, cpu_ns, blocks):
+        if step not in self.cpu:
+            self.cpu[step] = []
+            self.blocks[step] = []
+        self.cpu[step].append(cpu_ns)
+        self.blocks[step].append(blocks)
+
+    def summary(self):
+        steps = {}
+        for step, cpu in self.cpu.items():
+            cpu = np.asarray(cpu) / 1e9
+            blocks = np.asarray(self.blocks[step])
+            steps[str(step)] = {
+                "n": len(cpu),
+                "cpu_total": float(cpu.sum()),
+                "cpu_mean": float(cpu.mean()),
+                "cpu_p99": float(np.percentile(cpu, 99)),
+                "cpu_max": float(cpu.max()),
+                "blocks_mean": float(blocks.mean()),
+                "blocks_max": int(blocks.max()),
+            }
+        return dict(sorted(steps.items(), key=lambda s: -s[1]["cpu_total"]))
+
+
+def drive(gen, stats, inputs, max_duration=None):
+    """Run a task generator to completion (or `max_duration` psychopy seconds), timing each step."""
+    start = core.getTime()
+    while True:
+        inputs.update()
+        blocks = sys.getallocatedblocks()
+        cpu = time.thread_time_ns()
+        try:
+            next(gen)
+        except StopIteration:
+            return True
+        cpu = time.thread_time_ns() - cpu
+        stats.add(_current_step(gen), cpu, sys.getallocatedblocks() - blocks)
+        if max_duration and core.getTime() - start > max_duration:
+            gen.close()
+            return False
+
+
+def simulate_task(task, win, output_path, output_fname_base, inputs, use_fmri=False,
+                  max_duration=None, trace_malloc=False):
+    report = {"name": task.name, "class": type(task).__name__}
+    if trace_malloc:
+        tracemalloc.start()
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    task.setup(win, output_path, output_fname_base, use_fmri=use_fmri, use_meg=False)
+    report["setup_time"] = time.perf_counter() - wall
+    report["setup_cpu"] = time.process_time() - cpu
+
+    stats = StepStats()
+    wall, cpu = time.perf_counter(), time.process_time()
+    drive(task.instructions(win, None), stats, inputs)
+    if use_fmri:
+        drive(fmri.wait_for_ttl(), stats, inputs)
+    report["completed"] = drive(task.run(win, None), stats, inputs, max_duration)
+    drive(task.stop(win, None), stats, inputs)
+    report["run_time"] = time.perf_counter() - wall
+    report["run_cpu"] = time.process_time() - cpu
+
+    wall = time.perf_counter()
+    task.save()
+    report["save_time"] = time.perf_counter() - wall
+    task.unload()
+
+    if trace_malloc:
+        report["traced_memory_peak"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    report["frame_timing"] = task._frame_timer.summary() if task._frame_timer else None
+    report["steps"] = stats.summary()
+    return report
+
+
+def print_report(report):
+    print(
+        "%s (%s): setup %.3fs (cpu %.3fs), run %.1fs (cpu %.1fs)%s, save %.3fs"
+        % (report["name"], report["class"], report["setup_time"], report["setup_cpu"],
+           report["run_time"], report["run_cpu"], "" if report["completed"] else " [cut]",
+           report["save_time"]))
+    timing = report["frame_timing"]
+    if timing:
+        print("    %d flips, %d late, %d dropped frames" % (
+            timing["n_flips"], timing["n_late_flips"], timing["n_dropped_frames"]))
+    if "traced_memory_peak" in report:
+        print("    traced memory peak %.1fMB" % (report["traced_memory_peak"] / 1e6))
+    for step, stats in list(report["steps"].items())[:REPORT_TOP_STEPS]:
+        print(
+            "    %-40s n %6d  cpu total %7.3fs  mean %7.3fms  p99 %7.3fms  max %7.3fms  blocks mean %+.1f max %+d"
+            % (step, stats["n"], stats["cpu_total"], stats["cpu_mean"] * 1e3, stats["cpu_p99"] * 1e3,
+               stats["cpu_max"] * 1e3, stats["blocks_mean"], stats["blocks_max"]))
+
+
+def main(parsed):
+    ses_mod = importlib.import_module("src.sessions.ses-%s" % parsed.tasks)
+    tasks = ses_mod.get_tasks(parsed) if hasattr(ses_mod, "get_tasks") else ses_mod.TASKS
+    if parsed.skip_n_tasks:
+        tasks = itertools.islice(tasks, parsed.skip_n_tasks, None)
+
+    bids_sub_ses = ("sub-%s" % parsed.subject, "ses-%s" % parsed.session)
+    log_path = os.path.abspath(os.path.join(parsed.output, "sourcedata", *bids_sub_ses))
+    os.makedirs(log_path, exist_ok=True)
+    log_name_prefix = "sub-%s_ses-%s_%s" % (
+        parsed.subject, parsed.session, datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+    logging.console.setLevel(logging.WARNING)
+    logging.LogFile(os.path.join(log_path, log_name_prefix + ".log"), level=logging.INFO, filemode="w")
+
+    reports = []
+    with ScaledTime(parsed.speed):
+        logging.setDefaultClock(core.MonotonicClock(0))
+        exp_win = visual.Window(
+            **dict(config.EXP_WINDOW, fullscr=False, screen=0, waitBlanking=False),
+            monitor=config.EXP_MONITOR)
+        exp_win.flip = PacedFlip(exp_win)
+        inputs = SimulatedInputs(
+            exp_win,
+            tr=fmri.MR_settings["TR"] if parsed.fmri else None,
+            keys=parsed.keys.split(",") if parsed.keys else (),
+            key_interval=parsed.key_interval,
+            seed=parsed.seed,
+        )
+        try:
+            for task in tasks:
+                print("simulating %s" % task)
+                try:
+                    report = simulate_task(
+                        task, exp_win, log_path, log_name_prefix, inputs,
+                        use_fmri=parsed.fmri, max_duration=parsed.max_duration,
+                        trace_malloc=parsed.trace_malloc)
+                except Exception as e:
+                    # eg. missing stimuli or audio device, reported and skipped
+                    logging.error("simulation of %s failed: %r" % (task, e))
+                    report = {"name": task.name, "class": type(task).__name__, "error": repr(e)}
+                    print("    failed: %r" % e)
+                else:
+                    print_report(report)
+                reports.append(report)
+                logging.flush()
+        finally:
+            exp_win.close()
+
+    report_path = os.path.join(log_path, log_name_prefix + "_simulation.json")
+    with open(report_path, "w") as f:
+        json.dump({
+            "speed": parsed.speed,
+            "n_ttls": inputs.n_ttls,
+            "n_presses": inputs.n_presses,
+            "tasks": reports,
+        }, f, indent=1)
+    print("report saved in %s" % report_path)
+    return reports
+
+
+if __name__ == "__main__":
+    parser = session_parser.get_parser()
+    parser.prog = "python -m src.shared.simulate"
+    parser.description = "Simulate a session headless and report the CPU cost of each task"
+    parser.add_argument("--speed", type=float, default=1., help="psychopy time speed factor, >1 to fast-forward")
+    parser.add_argument("--max-duration", type=float, default=None, help="cut each task run after that many seconds")
+    parser.add_argument("--keys", default="", help="comma separated keys pressed at random")
+    parser.add_argument("--key-interval", type=float, default=2., help="mean interval between key presses (s)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the key presses")
+    parser.add_argument("--trace-malloc", action="store_true", help="report the peak traced memory of each task")
+    parser.add_argument("--display", action="store_true", help="show the window instead of rendering offscreen")
+    main(parser.parse_args())
@@ -1,8 +1,9 @@
 import psutil
 import time
+import numpy as np
+from array import array
 from psychopy import core, logging
-import os, glob
-from inspect import getframeinfo, stack
+import os, sys, glob, zipfile
 
 def check_power_plugged():
     battery = psutil.sensors_battery()
@@ -11,19 +12,114 @@ def check_power_plugged():
     else:
         return True
 
-def wait_until(clock, deadline, hogCPUperiod=0.1, keyboard_accuracy=.0005):
-    if deadline < clock.getTime():
-        caller = getframeinfo(stack()[1][0])
-        logging.error(f'wait_until called after deadline: {deadline} < {clock.getTime()} {caller.filename}:{caller.lineno}')
-    sleep_until = deadline - hogCPUperiod
+# Waits sleep until a margin before the deadline then spin until it. The margin
+# is a high percentile of the recent OS sleep overshoots, measured at startup
+# and from every sleep, so that a single outlier does not keep it high.
+SLEEP_CALIBRATION_SAMPLES = 50
+SLEEP_CALIBRATION_DURATION = .001
+# ring of the latest overshoots, of which those of the last seconds are used
+SLEEP_OVERSHOOT_WINDOW = 256
+SLEEP_MARGIN_HORIZON = 10.
+SLEEP_MARGIN_PERCENTILE = 95
+# below that many recent overshoots, the calibrated margin is used
+MIN_SLEEP_OVERSHOOTS = 10
+MIN_SLEEP_MARGIN = .0002
+MAX_SLEEP_MARGIN = .002
+# fastest rate of window events pumping while spinning
+MIN_POLL_INTERVAL = .0001
+# wake-ups later than this after the deadline are counted as late
+LATE_WAKE_THRESHOLD = .001
+
+_calibrated_margin = None
+_overshoots = np.zeros(SLEEP_OVERSHOOT_WINDOW)
+_overshoot_times = np.full(SLEEP_OVERSHOOT_WINDOW, -np.inf)
+_n_overshoots = 0
+# wake-up errors (seconds after the deadline) per call site
+_wake_errors = {}
+
+
+def _margin_from(overshoots):
+    margin = np.percentile(overshoots, SLEEP_MARGIN_PERCENTILE)
+    return min(max(margin, MIN_SLEEP_MARGIN), MAX_SLEEP_MARGIN)
+
+
+def calibrate_sleep(n_samples=SLEEP_CALIBRATION_SAMPLES, duration=SLEEP_CALIBRATION_DURATION):
+    """Measure the overshoot of short sleeps, used as margin until enough recent sleeps."""
+    global _calibrated_margin
+    overshoots = []
+    for _ in range(n_samples):
+        start = time.perf_counter()
+        time.sleep(duration)
+        overshoots.append(time.perf_counter() - start - duration)
+    _calibrated_margin = _margin_from(overshoots)
+    logging.exp(f"sleep overshoot calibrated: {_calibrated_margin * 1e6:.0f}us")
+    return _calibrated_margin
+
+
+def sleep_margin():
+    """Margin to spin before a deadline, from the overshoots of the last `SLEEP_MARGIN_HORIZON` seconds."""
+    if _calibrated_margin is None:
+        calibrate_sleep()
+    recent = _overshoots[_overshoot_times > time.perf_counter() - SLEEP_MARGIN_HORIZON]
+    if len(recent) < MIN_SLEEP_OVERSHOOTS:
+        return _calibrated_margin
+    return _margin_from(recent)
+
+
+def _sleep(duration):
+    global _n_overshoots
+    start = time.perf_counter()
+    time.sleep(duration)
+    end = time.perf_counter()
+    i = _n_overshoots % SLEEP_OVERSHOOT_WINDOW
+    _overshoots[i] = end - start - duration
+    _overshoot_times[i] = end
+    _n_overshoots += 1
+
+
+def _call_site(frame):
+    return (frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+
+def _wait_steps(clock, deadline, hogCPUperiod, keyboard_accuracy, call_site):
+    """Sleep by steps of at most `keyboard_accuracy`, yielding after each, then spin.
+
+    The spin starts `hogCPUperiod` before the deadline, or the sleep margin
+    estimated at the start of the wait if None.
+    """
+    current_time = clock.getTime()
+    if deadline < current_time:
+        logging.error(
+            f'wait_until called after deadline: {deadline} < {current_time} {call_site[0]}:{call_site[1]}')
+    margin = sleep_margin() if hogCPUperiod is None else hogCPUperiod
     poll_windows()
+    while True:
+        remaining = deadline - margin - clock.getTime()
+        if remaining <= 0:
+            break
+        _sleep(min(keyboard_accuracy, remaining))
+        yield
+        poll_windows()
+
+    poll_interval = max(keyboard_accuracy, MIN_POLL_INTERVAL)
     current_time = clock.getTime()
+    next_poll = current_time + poll_interval
     while current_time < deadline:
-        if current_time < sleep_until:
-            time.sleep(keyboard_accuracy)
-        poll_windows()
+        if current_time >= next_poll:
+            poll_windows()
+            next_poll = current_time + poll_interval
         current_time = clock.getTime()
 
+    errors = _wake_errors.get(call_site)
+    if errors is None:
+        errors = _wake_errors[call_site] = array('d')
+    errors.append(current_time - deadline)
+
+
+def wait_until(clock, deadline, hogCPUperiod=None, keyboard_accuracy=.0005):
+    for _ in _wait_steps(clock, deadline, hogCPUperiod, keyboard_accuracy, _call_site(sys._getframe(1))):
+        pass
+
 def poll_windows():
     for winWeakRef in core.openWindows:
         win = winWeakRef()
@@ -31,20 +127,41 @@ def poll_windows():
                 hasattr(win.winHandle, "dispatch_events")):
             win.winHandle.dispatch_events()  # pump events
 
-def wait_until_yield(clock, deadline, hogCPUperiod=0.1, keyboard_accuracy=.0005):
-    if deadline < clock.getTime():
-        caller = getframeinfo(stack()[1][0])
-        logging.error(f'wait_until called after deadline: {deadline} < {clock.getTime()} {caller.filename}:{caller.lineno}')
-    sleep_until = deadline - hogCPUperiod
-    poll_windows()
-    current_time = clock.getTime()
-    while current_time < deadline:
-        if current_time < sleep_until:
-            time.sleep(keyboard_accuracy)
-            yield
+def wait_until_yield(clock, deadline, hogCPUperiod=None, keyboard_accuracy=.0005):
+    # frame 1 is the consumer of the generator (loop or `yield from`), ie. the call site
+    yield from _wait_steps(clock, deadline, hogCPUperiod, keyboard_accuracy, _call_site(sys._getframe(1)))
 
-        poll_windows()
-        current_time = clock.getTime()
+def wake_error_summary():
+    """Distribution of the wake-up errors of each wait call site."""
+    summary = {}
+    for (filename, lineno, name), errors in _wake_errors.items():
+        errors = np.frombuffer(errors, dtype=np.float64)
+        summary[f"{os.path.relpath(filename)}:{lineno} ({name})"] = {
+            "n_waits": len(errors),
+            "p50_error": float(np.percentile(errors, 50)),
+            "p99_error": float(np.percentile(errors, 99)),
+            "max_error": float(errors.max()),
+            "n_late": int((errors > LATE_WAKE_THRESHOLD).sum()),
+        }
+    return summary
+
+def log_wake_errors():
+    for site, stats in sorted(wake_error_summary().items()):
+        msg = "wait wake-up error at %s: %d waits, p50 %.0fus, p99 %.0fus, max %.0fus, %d late" % (
+            site, stats["n_waits"], stats["p50_error"] * 1e6, stats["p99_error"] * 1e6,
+            stats["max_error"] * 1e6, stats["n_late"])
+        logging.exp(msg=msg)
+        print(msg)
+
+def npz_array_size(path, key):
+    """Number of elements of an array in a npz file, read from its header only."""
+    with zipfile.ZipFile(path) as npz, npz.open(key + ".npy") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, _ = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, _ = np.lib.format.read_array_header_2_0(f)
+    return int(np.prod(shape))
 
 def get_subject_soundcheck_video(subject):
     setup_video_path = glob.glob(
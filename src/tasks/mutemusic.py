@@ -1,12 +1,14 @@
-import os, time, pandas
+import os, glob, json, time, threading, wave, pandas
+from concurrent.futures import ThreadPoolExecutor
 
 from psychopy import prefs
 prefs.hardware['audioLib'] = ['sounddevice']
 from psychopy import visual, sound, event, core, logging
 
 from .task_base import Task
-from ..shared import config, utils
+from ..shared import config, utils, audio, loudness
 from ..shared.eyetracking import fixation_dot
+from ..shared.questionnaire import LikertQuestionnaire
 
 #task : 1 run = 1 playlist = around 10 audio tracks
 #repeat for n songs in subXX_runXX.csv :
@@ -18,6 +20,8 @@ from ..shared.eyetracking import fixation_dot
 #Global Variables if multiples tasks
 QUESTION_DURATION = 7 #5
 INSTRUCTION_DURATION = 25
+# s after the expected end of a track without end of stream before moving on
+TRACK_END_MARGIN = 1
 DEFAULT_INSTRUCTION = '''Please listen to the following songs. Try to stay as still as possible and avoid nodding your head or tapping your finger to the music rhythm.\n
 During each musical track, small segments will be silenced. During the silenced portion, try to imagine the missing part. \n
 Following each, you will be presented the rating scale below and asked to rate how well you were able to imagine the music during silences. You will have a limited time to answer so please answer as quickly as possible, and press the “a” button when ready to start the next track. \n
@@ -39,12 +43,155 @@ Not at all                           Partially                 I clearly imagine
 
 Press A when ready'''
 
+STIMULI_PATH = os.path.join('data', 'mutemusic')
+PLAYLISTS_MANIFEST = os.path.join(STIMULI_PATH, 'playlists_manifest.json')
+
 AUDITORY_IMAGERY_ASSESSMENT = ("Please rate how well you were able to imagine the music during the pauses of the music clips.",
                                ['Not at all', '', 'Partially', '', 'I clearly imagined it'])
 
+def _file_stat(path):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def _compile_playlist(tsv_path):
+    playlist = pandas.read_table(tsv_path, sep='\t')
+    entry = {'stat': _file_stat(tsv_path), 'track_stats': {}, 'durations': [], 'errors': []}
+    if 'path' not in playlist.columns:
+        entry['errors'].append(f"{tsv_path}: no path column")
+        return entry
+    total_durations = playlist.get('total_duration', [None] * len(playlist))
+    for path, total_duration in zip(playlist['path'], total_durations):
+        entry['track_stats'][path] = _file_stat(path)
+        if entry['track_stats'][path] is None:
+            entry['errors'].append(f"{path}: file does not exist")
+            continue
+        try:
+            # header only, no decoding
+            duration = audio.get_wav_info(path)['duration']
+        except (wave.Error, EOFError) as e:
+            entry['errors'].append(f"{path}: {e}")
+            continue
+        if duration <= 0:
+            entry['errors'].append(f"{path}: empty audio")
+        elif total_duration is not None and abs(duration - total_duration) > 1:
+            logging.warning(f"{path}: duration {duration:.2f}s differs from playlist total_duration {total_duration}s")
+        entry['durations'].append(duration)
+    return entry
+
+
+def compile_playlists(stimuli_path=STIMULI_PATH, manifest_path=PLAYLISTS_MANIFEST, save=True):
+    """Validate the playlists of all subjects and cache the duration of their tracks.
+
+    A playlist is only compiled again if its tsv or one of its tracks changed
+    (size/mtime), so that loading the manifest is instantaneous. Playlists
+    that no longer exist are dropped from the manifest. The updated
+    manifest is not written if `save` is False (dry runs).
+    """
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    changed = False
+    tsv_paths = sorted(
+        p for p in glob.glob(os.path.join(stimuli_path, 'Sub-*', 'Sub-*_Playlist_*.tsv'))
+        if not p.endswith('_order.tsv'))
+    for tsv_path in tsv_paths:
+        entry = manifest.get(tsv_path)
+        if (entry is None or entry['stat'] != _file_stat(tsv_path) or
+                any(_file_stat(path) != stat for path, stat in entry['track_stats'].items())):
+            manifest[tsv_path] = _compile_playlist(tsv_path)
+            changed = True
+    # playlists removed since, reported as missing rather than validated from the cache
+    for tsv_path in set(manifest) - set(tsv_paths):
+        del manifest[tsv_path]
+        changed = True
+    if changed and save:
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+
+def run_duration(track_durations, initial_wait, final_wait, question_duration, isi):
+    """Expected (max) duration of a run, following Playlist._run timing."""
+    return (
+        initial_wait
+        + sum(duration + initial_wait + question_duration for duration in track_durations)
+        + isi * max(len(track_durations) - 1, 0)
+        + final_wait)
+
+
+class TrackClock(object):
+    """Timestamps a track start and end from the audio backend stream callbacks.
+
+    The start is when the first block is requested plus the output latency of
+    the stream (time to reach the DAC), the played duration is the number of
+    frames delivered to the stream. If the backend Sound has no such callbacks
+    to hook, `hooked` is False and the track end is taken from its duration.
+    """
+
+    def __init__(self, track_sound):
+        self.finished = threading.Event()
+        self.start_time = None
+        self.played = None
+        self.frames = 0
+        self.sample_rate = float(track_sound.sampleRate)
+        self._latency = getattr(getattr(track_sound, 'stream', None), 'latency', 0.) or 0.
+        self._in_next_block = False
+        self._eos_called = False
+        self._sound = track_sound
+        # private callbacks of the ptb backend Sound
+        self.hooked = hasattr(track_sound, '_nextBlock') and hasattr(track_sound, '_EOS')
+        if not self.hooked:
+            logging.warning(
+                f"{type(track_sound).__name__} has no stream callbacks, track end timed from its duration")
+            return
+        self._next_block = track_sound._nextBlock
+        self._eos = track_sound._EOS
+        track_sound._nextBlock = self._on_next_block
+        track_sound._EOS = self._on_eos
+
+    @property
+    def delivered(self):
+        """Duration of the frames delivered so far (s)."""
+        return self.frames / self.sample_rate
+
+    def _on_next_block(self):
+        # called from the audio stream thread for each block
+        self._in_next_block = True
+        try:
+            block = self._next_block()
+        finally:
+            self._in_next_block = False
+        if block is not None:
+            if self.start_time is None:
+                self.start_time = core.getTime() + self._latency
+            self.frames += len(block)
+        if self._eos_called:
+            self._finish()
+        return block
+
+    def _on_eos(self, *args, **kwargs):
+        # called from the audio stream thread, by _nextBlock before its last
+        # block is counted, and again by the stream callback after a short block
+        self._eos(*args, **kwargs)
+        self._eos_called = True
+        if not self._in_next_block:
+            self._finish()
+
+    def _finish(self):
+        if self.played is None:
+            self.played = self.delivered
+            self.finished.set()
+
+
 class Playlist(Task):
 #Derived from SoundTaskBase (Narratives task)
-    def __init__(self, tsv_path, initial_wait=6, final_wait=9, question_duration = 5, isi=2, **kwargs):
+    def __init__(self, tsv_path, initial_wait=6, final_wait=9, question_duration = 5, isi=2, track_durations=None,
+                 loudness_manifest_path=loudness.MUTEMUSIC_LOUDNESS_MANIFEST, **kwargs):
         super().__init__(**kwargs)
 
         if not os.path.exists(tsv_path):
@@ -54,6 +201,14 @@ class Playlist(Task):
             file = open(tsv_path, "r")
             self.playlist = pandas.read_table(file, sep='\t')
             file.close()
+            if 'offset' not in self.playlist:
+                self.playlist.insert(self.playlist.columns.get_loc('onset') + 1, 'offset', None)
+
+        # loudness of the source track and gain of the played file, from the normalization manifest
+        loudness_manifest = loudness.LoudnessManifest(loudness_manifest_path)
+        tracks_loudness = [loudness_manifest.lookup(path) for path in self.playlist['path']]
+        self.playlist['loudness_lufs'] = [entry['lufs'] if entry else None for entry, gain in tracks_loudness]
+        self.playlist['gain_db'] = [gain for entry, gain in tracks_loudness]
 
         self.initial_wait = initial_wait
         self.final_wait = final_wait
@@ -61,9 +216,29 @@ class Playlist(Task):
         self.question_duration = question_duration
         self.instruction = DEFAULT_INSTRUCTION
 
-        self.duration = self.playlist.shape[0]
+        # durations read from the compiled manifest or from the wav headers
+        if track_durations is None:
+            track_durations = [audio.get_wav_info(path)['duration'] for path in self.playlist['path']]
+        self.duration = run_duration(
+            track_durations, self.initial_wait, self.final_wait, self.question_duration, self.isi)
         self._progress_bar_refresh_rate = None
 
+    def _plan(self):
+        sizes = [os.path.getsize(path) for path in self.playlist['path'] if os.path.exists(path)]
+        # the playing track and the prefetched one, decoded as float32 (2x 16-bit wav)
+        return {
+            "duration": self.duration,
+            "stimuli": list(self.playlist['path']),
+            "memory": 2 * sum(sorted(sizes)[-2:]),
+        }
+
+    def _update_progress_bar(self):
+        # time-based progress, refreshed once per second
+        progress = min(int(self.task_timer.getTime()), self.progress_bar.total)
+        if progress != self.progress_bar.n:
+            self.progress_bar.n = progress
+            self.progress_bar.refresh()
+
     def _instructions(self, exp_win, ctl_win):
         screen_text = visual.TextStim(
             exp_win,
@@ -90,84 +265,42 @@ class Playlist(Task):
             yield
         yield True
 
+    def _preload(self):
+        # silenced segments of each track, from the cached index
+        self._silence_gaps = audio.get_silence_gaps(self.playlist['path'].unique())
+
     def _setup(self, exp_win):
         super()._setup(exp_win)
         self.fixation = fixation_dot(exp_win)
+        question, answers = AUDITORY_IMAGERY_ASSESSMENT
+        self.questionnaire = LikertQuestionnaire(
+            exp_win, [(0, question, len(answers))], point_labels=answers)
+        # tracks are decoded on a worker thread, off the timing-critical path
+        self._prefetch_executor = ThreadPoolExecutor(max_workers=1)
+        self._prefetched = {}
+        self._prefetch(0)
+
+    def _load_track(self, track_path):
+        load_start = core.getTime()
+        # preBuffer=-1: the whole file is decoded and kept in memory
+        track_sound = sound.Sound(track_path, preBuffer=-1)
+        return track_sound, TrackClock(track_sound), load_start, core.getTime()
+
+    def _prefetch(self, track_n):
+        if track_n < len(self.playlist) and track_n not in self._prefetched:
+            self._prefetched[track_n] = self._prefetch_executor.submit(
+                self._load_track, self.playlist['path'].iloc[track_n])
 
     def _handle_controller_presses(self):
         self._new_key_pressed = event.getKeys('lra')
 
-    def _questionnaire(self, exp_win, ctl_win, question, answers):
+    def _questionnaire(self, exp_win, ctl_win):
         event.getKeys('lra') # flush keys
-        n_pts = len(answers)
-        legends = []
-        default_response = n_pts // 2
-        response = default_response
+        question = self.questionnaire.questions[0][1]
+        self.questionnaire.reset()
 
         exp_win.setColor([0] * 3, colorSpace='rgb')
-        win_width = exp_win.size[0]
-        y_spacing=80
-        scales_block_x = win_width * 0.25
-        scales_block_y = exp_win.size[1] * 0.1
-        extent = win_width * 0.2
-        x_spacing= (scales_block_x  + extent) * 2 / (n_pts - 1)
-        y_pos = scales_block_y - y_spacing
-
-        #----------setup-Questionnaire-------------------------
-        line = visual.Line(
-                exp_win,
-                (-(scales_block_x + extent), y_pos),
-                (scales_block_x + extent, y_pos),
-                units="pix",
-                lineWidth=6,
-                autoLog=False,
-                lineColor=(-1, -1, -1)
-            )
-
-        bullets = [
-                visual.Circle(
-                    exp_win,
-                    units="pix",
-                    radius=10,
-                    pos=(
-                        - (scales_block_x + extent) + i * x_spacing,
-                        y_pos,
-                        ),
-                    fillColor= (1, 1, 1) if default_response == i else (-1, -1, -1),
-                    lineColor=(-1, -1, -1),
-                    lineWidth=10,
-                    autoLog=False,
-                )
-                for i in range(n_pts)
-            ]
-
-        legends = [
-            visual.TextStim(
-                exp_win,
-                text = answer,
-                units="pix",
-                pos=(-(scales_block_x + extent) + i * x_spacing, exp_win.size[1] * 0.1),
-                wrapWidth= win_width * 0.12,
-                height= y_spacing / 4.5,
-                anchorHoriz="center",
-                alignText="center",
-                bold=True
-            )
-            for i, answer in enumerate(answers)
-        ]
 
-        text = visual.TextStim(
-            exp_win,
-            text = question,
-            units="pix",
-
-            pos=(-(scales_block_x + extent),
-                    y_pos + exp_win.size[1] * 0.30),
-            wrapWidth= win_width-(win_width*0.1),
-            height= y_spacing / 3,
-            anchorHoriz="left",
-            alignText="left"
-        )
         #---run-Questionnaire--------------------------------------
         n_flips = 0
         for _ in utils.wait_until_yield(
@@ -177,36 +310,26 @@ class Playlist(Task):
 
             self._handle_controller_presses()
             new_key_pressed = [k[0] for k in self._new_key_pressed]
+            changed = self.questionnaire.handle_keys(new_key_pressed)
 
-            if "r" in new_key_pressed and response < n_pts - 1:
-                response += 1
-            elif "l" in new_key_pressed and response > 0:
-                response -= 1
-            elif "a" in new_key_pressed:
+            if changed == "a":
                 self._events.append({
                     "track": self.track_name,
                     "question": question,
-                    "value": response,
+                    "value": self.questionnaire.responses[0],
                     "confirmation": "yes"
                 })
                 break
 
-            elif n_flips > 1:
+            elif not changed and n_flips > 1:
                 time.sleep(.01)
                 continue
 
             exp_win.logOnFlip(
                 level=logging.EXP,
-                msg="questions %s" % response)
+                msg="questions %s" % self.questionnaire.responses[0])
 
-            for bullet_n, bullet in enumerate(bullets):
-                bullet.fillColor = (1, 1, 1) if response == bullet_n else (-1, -1, -1)
-
-            line.draw(exp_win)
-            text.draw(exp_win)
-            for legend, bullet in zip(legends, bullets):
-                legend.draw(exp_win)
-                bullet.draw(exp_win)
+            self.questionnaire.draw(exp_win)
 
             yield True
             n_flips += 1
@@ -215,9 +338,10 @@ class Playlist(Task):
             self._events.append({
                     "track": self.track_name,
                     "question": question,
-                    "value": response,
+                    "value": self.questionnaire.responses[0],
                     "confirmation": "no"})
             pass
+        self.questionnaire.log_draw_stats(self.track_name)
 
         #Flush questionnaire from screen
         yield True
@@ -230,44 +354,75 @@ class Playlist(Task):
         yield True
         next_onset = self.initial_wait
 
-        for index, track in self.playlist.iterrows():
+        for track_n, (index, track) in enumerate(self.playlist.iterrows()):
             #setup track
             track_path = track['path']
             self.track_name = os.path.split(track_path)[1]
-            self.sound = sound.Sound(track_path)
-            self.duration = self.sound.duration
+            self._prefetch(track_n) # no-op if already prefetched
+            prefetched_track = self._prefetched.pop(track_n)
 
             self.progress_bar.set_description(
                 f"Trial {index}:: {self.track_name}"
             )
-            self.progress_bar.update(1)
 
-            #initial wait (bullseye 2s)
+            #initial wait (bullseye 2s), up to a couple of frames before the scheduled onset
+            onset_target = next_onset
             for _ in utils.wait_until_yield(
                 self.task_timer,
-                next_onset,
+                onset_target - 2/config.FRAME_RATE,
                 keyboard_accuracy=.1):
+                self._update_progress_bar()
                 yield
 
+            # only hand the track to the play loop once fully decoded
+            if not prefetched_track.done():
+                logging.warning(f"track {self.track_name} not decoded at scheduled onset")
+            self.sound, track_clock, load_start, load_stop = prefetched_track.result()
+
             #Flush bullseye from screen before track
             yield True
 
-            #track playing (variable timing)
-            track_onset = self.task_timer.getTime(applyZero=True)
+            #track playing (variable timing), started at the target onset on the task clock,
+            # the onset logged is the one measured by the track clock
+            if self.task_timer.getTime() < onset_target:
+                yield from utils.wait_until_yield(self.task_timer, onset_target, keyboard_accuracy=.001)
             self.sound.play()
-            for _ in utils.wait_until_yield(self.task_timer,
-                                            next_onset + self.initial_wait + self.sound.duration,
-                                            keyboard_accuracy=.1):
-                yield
+            # decode next track while this one plays and its questionnaire runs
+            self._prefetch(track_n + 1)
 
-            #ensure music track has been completely played
-            while self.sound.status > 0:
-                pass
+            #wait for the backend to signal the end of the track, or for its duration if the stream stalls or is not hooked
+            for _ in utils.wait_until_yield(
+                self.task_timer,
+                onset_target + self.sound.duration + TRACK_END_MARGIN,
+                keyboard_accuracy=.001):
+                if track_clock.finished.is_set():
+                    break
+                self._update_progress_bar()
+                yield
+            if not track_clock.finished.is_set():
+                if track_clock.hooked:
+                    logging.warning(f"track {self.track_name}: no end of stream from the audio backend")
+                self.sound.stop()
+            if track_clock.start_time is None:
+                track_onset = onset_target
+            else:
+                track_onset = track_clock.start_time - self.task_timer._timeAtLastReset
+            if not track_clock.hooked:
+                track_offset = track_onset + self.sound.duration
+            else:
+                track_offset = track_onset + (
+                    track_clock.delivered if track_clock.played is None else track_clock.played)
+
+            #post-track wait, as long as the initial wait
+            for _ in utils.wait_until_yield(
+                self.task_timer,
+                onset_target + self.initial_wait + self.sound.duration,
+                keyboard_accuracy=.1):
+                self._update_progress_bar()
+                yield
 
             #display Questionnaire (variable timing, max 5s)
-            yield from self._questionnaire(exp_win, ctl_win,
-                                           question=AUDITORY_IMAGERY_ASSESSMENT[0],
-                                           answers=AUDITORY_IMAGERY_ASSESSMENT[1])
+            yield from self._questionnaire(exp_win, ctl_win)
 
             #display bullseye for netx iteration
             for stim in self.fixation:
@@ -275,6 +430,12 @@ class Playlist(Task):
             yield True
 
             self.playlist.at[index, 'onset']=track_onset
+            self.playlist.at[index, 'offset']=track_offset
+            self.playlist.at[index, 'onset_requested'] = onset_target
+            self.playlist.at[index, 'onset_error'] = track_onset - onset_target
+            # prefetch timing on the task clock, ready should always precede onset
+            self.playlist.at[index, 'prefetch_duration'] = load_stop - load_start
+            self.playlist.at[index, 'prefetch_ready'] = load_stop - self.task_timer._timeAtLastReset
             previous_track_offset = self.task_timer.getTime(applyZero=True)
             next_onset = previous_track_offset + self.isi
         #final wait
@@ -287,5 +448,35 @@ class Playlist(Task):
             self.sound.stop()
         yield True
 
+    def unload(self):
+        if hasattr(self, '_prefetch_executor'):
+            self._prefetch_executor.shutdown(wait=False)
+            self._prefetched.clear()
+
     def _save(self):
-        self.playlist.to_csv(self._generate_unique_filename("events", "tsv"), sep='\t', index=False)
+        # one event per silence gap, relative to the logged track onset
+        silences = [
+            {
+                'trial_type': 'silence',
+                'title': track['title'],
+                'path': track['path'],
+                'onset': track['onset'] + gap_onset,
+                'duration': gap_duration,
+                'track_onset': track['onset'],
+            }
+            for _, track in self.playlist.dropna(subset=['onset']).iterrows()
+            for gap_onset, gap_duration in self._silence_gaps.get(track['path'], [])
+        ]
+        events = pandas.concat(
+            [self.playlist.assign(trial_type='track'), pandas.DataFrame(silences)],
+            ignore_index=True)
+        events = events.sort_values('onset', kind='stable')
+        events.to_csv(self._generate_unique_filename("events", "tsv"), sep='\t', index=False)
+
+
+if __name__ == "__main__":
+    for tsv_path, entry in compile_playlists().items():
+        duration = run_duration(entry['durations'], 6, 9, 5, 2)
+        print(f"{tsv_path}: {len(entry['durations'])} tracks, {duration/60:.1f}min")
+        for error in entry['errors']:
+            print(f"    ERROR {error}")
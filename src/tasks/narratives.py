@@ -4,8 +4,9 @@ import pandas
 from .task_base import Task
 from colorama import Fore
 
-from ..shared import config, utils
+from ..shared import config, utils, audio
 from ..shared.eyetracking import fixation_dot
+from ..shared.questionnaire import LikertQuestionnaire
 
 INSTRUCTION_DURATION = 4
 
@@ -19,6 +20,17 @@ class SoundTaskBase(Task):
         else:
             raise ValueError("File %s does not exists" % sound_file)
 
+    def _plan(self):
+        if not self.sound_file.endswith('.wav'):
+            return {"stimuli": [self.sound_file]}
+        info = audio.get_wav_info(self.sound_file)
+        # decoded as float32
+        return {
+            "duration": self.initial_wait + info['duration'] + self.final_wait,
+            "stimuli": [self.sound_file],
+            "memory": info['nframes'] * info['channels'] * 4,
+        }
+
     def _instructions(self, exp_win, ctl_win):
         screen_text = visual.TextStim(
             exp_win,
@@ -97,6 +109,13 @@ class AudioRecording(Task):
         self.duration = self.max_duration
         self._progress_bar_refresh_rate = None
 
+    def _plan(self):
+        # stopped earlier by the subject, recorded as 16-bit
+        return {
+            "duration": self.max_duration,
+            "memory": int(self.max_duration * self.audio_rate * self.audio_channels * 2),
+        }
+
 
     def _setup(self, exp_win,):
 
@@ -265,6 +284,10 @@ Use up/down buttons to answer.
         self.duration = len(self.design)
         self._progress_bar_refresh_rate = None
 
+    def _plan(self):
+        # trials end on the subject answers
+        return {"stimuli": [self.design_file]}
+
     def _setup(self, exp_win):
 
 
@@ -287,6 +310,8 @@ Use up/down buttons to answer.
         )
 
         self.fixation = fixation_dot(exp_win)
+        self.questionnaire = LikertQuestionnaire(
+            exp_win, [(k, q, 5) for k, q in enumerate(self.QUESTIONS)])
 
         # create trial handler
         self._restart()
@@ -394,7 +419,7 @@ Use up/down buttons to answer.
 
         # display questionnaire
         self.progress_bar.set_description("Questions:")
-        yield from self._questionnaire(exp_win, ctl_win, [(k, q, 5) for k, q in enumerate(self.QUESTIONS)])
+        yield from self._questionnaire(exp_win, ctl_win, self.questionnaire)
 
         # depends if questionnaire was shown
         final_wait = (
@@ -408,155 +433,50 @@ Use up/down buttons to answer.
         print(f"{'#'*25} STOP SCANNER    {'#'*25}")
 
 
-    def _questionnaire(self, exp_win, ctl_win, questions):
+    def _questionnaire(self, exp_win, ctl_win, questionnaire):
         event.getKeys('udlra') # flush keys
 
-        if questions is None:
+        if questionnaire is None:
             return
         exp_win.setColor([0] * 3, colorSpace='rgb')
-        lines = []
-        bullets = []
-        responses = []
-        texts = []
-        legends = []
-        y_spacing = 80
-        win_width = exp_win.size[0]
-        scales_block_x = win_width * 0.25
-        scales_block_y = len(questions) // 2 * y_spacing
-        extent = win_width * 0.2
-
-        # add legends to Likert scale
-        legends.append(visual.TextStim(
-            exp_win,
-            text = 'Disagree',
-            units="pix",
-            pos=(scales_block_x - extent*0.75, scales_block_y*1.4),
-            wrapWidth= win_width * 0.5,
-            height= y_spacing / 3,
-            anchorHoriz="right",
-            alignText="right",
-            bold=True
-        ))
-        legends.append(visual.TextStim(
-            exp_win,
-            text = 'Agree',
-            units="pix",
-            pos=(scales_block_x + extent*1.15, scales_block_y*1.4),
-            wrapWidth= win_width * 0.5,
-            height= y_spacing / 3,
-            anchorHoriz="right",
-            alignText="right",
-            bold=True
-        ))
-
-
-        active_question = 0
-
-        # create all stimuli
-        #all_questions_text = ""
-        for q_n, (key, question, n_pts) in enumerate(questions):
-            default_response = n_pts // 2
-            responses.append(default_response)
-            x_spacing = extent * 2 / (n_pts - 1)
-            #all_questions_text += question + "\n\n"
-
-            y_pos = scales_block_y - q_n * y_spacing
-
-            lines.append(
-                visual.Line(
-                    exp_win,
-                    (scales_block_x - extent, y_pos),
-                    (scales_block_x + extent, y_pos),
-                    units="pix",
-                    lineWidth=6,
-                    autoLog=False,
-                    lineColor=(0, -1, -1) if q_n == 0 else (-1, -1, -1),
-                )
-            )
-            bullets.append(
-                [
-                    visual.Circle(
-                        exp_win,
-                        units="pix",
-                        radius=10,
-                        pos=(
-                            scales_block_x - extent + i * x_spacing,
-                            y_pos,
-                        ),
-                        fillColor= (1, 1, 1) if default_response == i else (-1, -1, -1),
-                        lineColor=(-1, -1, -1),
-                        lineWidth=10,
-                        autoLog=False,
-                    )
-                    for i in range(n_pts)
-                ]
-            )
-            texts.append(visual.TextStim(
-                exp_win,
-                text = question,
-                units="pix",
-                bold = q_n == active_question,
-                pos=(0, y_pos),
-                wrapWidth= win_width * 0.5,
-                height= y_spacing / 3,
-                anchorHoriz="right",
-                alignText="right"
-            ))
-            responses[q_n] = default_response
-
-
+        questionnaire.reset()
 
         # questionnaire interaction loop
         n_flips = 0
         while True:
             self._handle_controller_presses(exp_win)
             new_key_pressed = [k[0] for k in self._new_key_pressed]
-            if "u" in new_key_pressed and active_question > 0:
-                active_question -= 1
-            elif "d" in new_key_pressed and active_question < len(questions)-1:
-                active_question += 1
-            elif "r" in new_key_pressed and responses[active_question] < n_pts - 1:
-                responses[active_question] += 1
-            elif "l" in new_key_pressed and responses[active_question] > 0:
-                responses[active_question] -= 1
-            elif "a" in new_key_pressed:
-                for (key, question, n_pts), value in zip(questions, responses):
+            changed = questionnaire.handle_keys(new_key_pressed)
+            if changed == "a":
+                for (key, question, n_pts), value in zip(questionnaire.questions, questionnaire.responses):
                     self._log_event({
                         "trial_type": "questionnaire-answer",
                         "question": key,
                         "value": value
                     })
                 break
-            elif n_flips > 1:
+            elif not changed and n_flips > 1:
                 time.sleep(.01)
                 continue
 
             if n_flips > 0: #avoid double log when first loading questionnaire
                 self._log_event({
                     "trial_type": "questionnaire-value-change",
-                    "question": questions[active_question][0],
-                    "value": responses[active_question]
+                    "question": questionnaire.questions[questionnaire.active_question][0],
+                    "value": questionnaire.responses[questionnaire.active_question]
                 })
 
             exp_win.logOnFlip(
                 level=logging.EXP,
-                msg="questions %s" % responses)
-            for q_n, (txt, line, bullet_q) in enumerate(zip(texts, lines, bullets)):
-                #txt.bold = q_n == active_question
-                txt._pygletTextObj.set_style('bold', q_n == active_question)
-                line.lineColor = (0, -1, -1) if q_n == active_question else (-1, -1, -1)
-                for bullet_n, bullet in enumerate(bullet_q):
-                    bullet.fillColor = (1, 1, 1) if responses[q_n] == bullet_n else (-1, -1, -1)
-
-            for stim in lines + sum(bullets, []) + texts + legends:
-                stim.draw(exp_win)
+                msg="questions %s" % questionnaire.responses)
+            questionnaire.draw(exp_win)
             yield True
             n_flips += 1
-
+        questionnaire.log_draw_stats(self.name)
 
     def _save(self):
         out_fname = self._generate_unique_filename("events", "tsv")
-        other_events = pandas.DataFrame(self._events)
+        other_events = self._events.to_dataframe()
         events_df = self.trials.saveAsWideText(out_fname)
         if isinstance(events_df, pandas.DataFrame):
             events_df = pandas.concat([events_df, other_events])
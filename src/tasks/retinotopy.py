@@ -41,6 +41,42 @@ class Retinotopy(Task):
 
 
 
+    def _aperture_file(self):
+        if self.condition in ['RETCW', 'RETCCW', 'RETWEDGES']:
+            aperture_file = 'apertures_wedge_newtr.npz'
+        elif self.condition in ['RETEXP', 'RETCON', 'RETRINGS']:
+            aperture_file = '/apertures_ring.npz'
+        elif self.condition == 'RETBAR':
+            self.ncycles = 8
+            aperture_file =  'apertures_bars.npz'
+        return f"data/retinotopy/{aperture_file}"
+
+    def _set_timing(self):
+        self.initial_wait = 16 # if self.condition == 'RETBAR' else 22
+        self.middle_blank = 12 if self.condition in ['RETRINGS', 'RETWEDGES', 'RETBAR'] else 0
+        self.duration = (
+            32 * self.ncycles * (1 + (self.condition in ['RETRINGS', 'RETWEDGES']))
+            + self.initial_wait * 2
+            + self.middle_blank)
+
+    def _plan(self):
+        aperture_file = self._aperture_file()
+        self._set_timing()
+        # images and apertures are converted to float32 when loaded
+        memory = sum(
+            utils.npz_array_size(path, key) * 4
+            for path, key in [(self._images_file, 'images'), (aperture_file, 'apertures')])
+        return {
+            "duration": self.duration,
+            "stimuli": ["data/retinotopy/grid.npz", self._images_file, aperture_file],
+            "memory": memory,
+        }
+
+    def _preload(self):
+        self._grid = np.load("data/retinotopy/grid.npz")['grid']
+        self._images = np.load(self._images_file)['images'].astype(np.float32)/255.
+        self._apertures = np.load(self._aperture_file())['apertures'].astype(np.float32)/128.-1
+
     def _setup(self, exp_win):
         self.fixation_dot = visual.Circle(
             exp_win,
@@ -50,12 +86,11 @@ class Retinotopy(Task):
         )
 
 
-        grid = np.load("data/retinotopy/grid.npz")['grid']
         self.grid = visual.ImageStim(
             exp_win,
             name='grid',
             image=np.ones((1,1,3)),
-            mask=grid/128.-1,
+            mask=self._grid/128.-1,
             size=10,
             units='deg'
         )
@@ -67,24 +102,8 @@ class Retinotopy(Task):
             units='deg',
             flipVert=True)
 
-        self._images = np.load(self._images_file)['images'].astype(np.float32)/255.
-
-        if self.condition in ['RETCW', 'RETCCW', 'RETWEDGES']:
-            aperture_file = 'apertures_wedge_newtr.npz'
-        elif self.condition in ['RETEXP', 'RETCON', 'RETRINGS']:
-            aperture_file = '/apertures_ring.npz'
-        elif self.condition == 'RETBAR':
-            self.ncycles = 8
-            aperture_file =  'apertures_bars.npz'
-        self._apertures = np.load(f"data/retinotopy/{aperture_file}")['apertures'].astype(np.float32)/128.-1
-
         self.cycle_length = 21*config.TR # a bit less than 32s for TR=1.49
-        self.initial_wait = 16 # if self.condition == 'RETBAR' else 22
-        self.middle_blank = 12 if self.condition in ['RETRINGS', 'RETWEDGES', 'RETBAR'] else 0
-        self.duration = (
-            32 * self.ncycles * (1 + (self.condition in ['RETRINGS', 'RETWEDGES']))
-            + self.initial_wait * 2
-            + self.middle_blank)
+        self._set_timing()
 
         # draw random order with different successive stimuli
         self._images_random = np.random.randint(0, self._images.shape[-1], size=(8*32*self._images_fps)) #max nframe in CW conditions
@@ -200,6 +219,9 @@ class Retinotopy(Task):
 
         self._cycle_start = None
         self.reset_img()
+        # logged every stimulus frame
+        log_bar_flip = self._event_writer('condition', 'image_idx', 'aperture')
+        log_flip = self._event_writer('trial_type', 'condition', 'image_idx', 'aperture')
 
         yield True
         # wait until it's almost time to render first frame
@@ -233,8 +255,8 @@ class Retinotopy(Task):
                     self.img.mask = self._apertures[..., start_idx+frame]
 
                     exp_win.callOnFlip(
-                        self._log_event,
-                        {'condition': self.condition, 'image_idx': image_idx, 'aperture': frame},
+                        self._log_values, log_bar_flip,
+                        self.condition, image_idx, frame,
                         clock='flip'
                     )
 
@@ -276,8 +298,8 @@ class Retinotopy(Task):
                     self.img.mask = self._apertures[..., frame]
 
                     exp_win.callOnFlip(
-                        self._log_event,
-                        {'trial_type': 'flip','condition': self.condition, 'image_idx': image_idx, 'aperture': frame},
+                        self._log_values, log_flip,
+                        'flip', self.condition, image_idx, frame,
                         clock='flip'
                     )
 
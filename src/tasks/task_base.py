@@ -4,7 +4,8 @@ import time
 import pandas
 from psychopy import logging, visual, core, event
 
-from ..shared import fmri, meg, config
+from ..shared import fmri, meg, config, frametiming
+from ..shared.events import EventBuffer, JOURNAL_EXT
 
 
 class Task(object):
@@ -12,6 +13,12 @@ class Task(object):
     DEFAULT_INSTRUCTION = ""
     PROGRESS_BAR_FORMAT = '{l_bar}{bar}{r_bar}'
 
+    # dtype of the event columns known in advance, others are typed on first use
+    EVENT_SCHEMA = {"onset": float, "sample": float}
+
+    _frame_timer = None
+    _preloaded = False
+
     def __init__(self, name, instruction=None, use_eyetracking=False, et_calibrate=True):
         self.name = name
         self.use_eyetracking = use_eyetracking
@@ -22,6 +29,17 @@ class Task(object):
             self.instruction = instruction
         self._task_completed = False
 
+    # set by the exp_win timeOnFlip callback, each flip is also recorded for frame timing
+    @property
+    def _exp_win_last_flip_time(self):
+        return self.__dict__.get('_exp_win_last_flip_time_value')
+
+    @_exp_win_last_flip_time.setter
+    def _exp_win_last_flip_time(self, flip_time):
+        self.__dict__['_exp_win_last_flip_time_value'] = flip_time
+        if flip_time is not None and self._frame_timer is not None:
+            self._frame_timer.record(flip_time)
+
     # setup large files for accurate start with other recordings (scanner, biopac...)
     def setup(
         self,
@@ -35,13 +53,17 @@ class Task(object):
         self.output_fname_base = output_fname_base
         self.use_fmri = use_fmri
         self.use_meg = use_meg
-        self._events = []
+        # events are journaled as they come, to be recovered if the task never saves
+        self._events = EventBuffer(
+            self.EVENT_SCHEMA,
+            journal_path=self._generate_unique_filename("events", JOURNAL_EXT))
+        self._frame_timer = frametiming.FrameTimer()
 
         self._exp_win_first_flip_time = None
         self._exp_win_last_flip_time = None
         self._ctl_win_last_flip_time = None
 
-
+        self.preload()
         self._setup(exp_win)
         # initialize a progress bar if we know the duration of the task
         self.progress_bar = (
@@ -55,6 +77,42 @@ class Task(object):
     def _setup(self, exp_win):
         pass
 
+    def preload(self):
+        """Load resources that do not need the GL context (files, decoding, arrays).
+
+        Can run in a worker thread while the previous task runs, otherwise it is
+        done at the start of setup.
+        """
+        if not self._preloaded:
+            self._preload()
+            self._preloaded = True
+
+    def _preload(self):
+        pass
+
+    def plan(self):
+        """Expected run duration and resources of the task, without loading anything.
+
+        `duration` is the run time in seconds (None if it depends on the subject),
+        `stimuli` the files loaded and `memory` the bytes held once loaded
+        (the stimuli size if not known better). `planned` is False for the
+        classes that do not implement `_plan`.
+        """
+        plan = {"duration": None, "stimuli": [], "memory": None,
+                "planned": type(self)._plan is not Task._plan}
+        plan.update(self._plan())
+        stimuli_bytes = sum(os.path.getsize(path) for path in plan["stimuli"] if os.path.exists(path))
+        plan.update(
+            name=self.name,
+            cls=self.__class__.__name__,
+            stimuli_bytes=stimuli_bytes,
+            memory=stimuli_bytes if plan["memory"] is None else plan["memory"],
+        )
+        return plan
+
+    def _plan(self):
+        return {}
+
     def _generate_unique_filename(self, suffix, ext="tsv"):
         fname = os.path.join(
             self.output_path, f"{self.output_fname_base}_{self.name}_{suffix}.{ext}"
@@ -75,6 +133,9 @@ class Task(object):
         return "%s : %s" % (self.__class__, self.name)
 
     def _flip_all_windows(self, exp_win, ctl_win=None, clearBuffer=True):
+        # the flip lateness is measured from this request
+        if self._frame_timer is not None and clearBuffer is not None:
+            self._frame_timer.request(core.getTime())
         if not ctl_win is None:
             ctl_win.timeOnFlip(self, '_ctl_win_last_flip_time')
             ctl_win.flip(clearBuffer=clearBuffer)
@@ -84,12 +145,21 @@ class Task(object):
             # set callback for next flip, to be the first callback for other callbacks to use
             exp_win.timeOnFlip(self, '_exp_win_last_flip_time')
 
+    def _disarm_flip_time(self, exp_win):
+        """Remove the callback armed by the last flip, not to time the flips after the task."""
+        exp_win._toCall = [
+            call for call in exp_win._toCall
+            if not (call["function"] == exp_win._assignFlipTime and call["args"][0] is self)]
+
     def instructions(self, exp_win, ctl_win):
         if hasattr(self, "_instructions"):
-            for clearBuffer in self._instructions(exp_win, ctl_win):
+            instructions_gen = self._instructions(exp_win, ctl_win)
+            for clearBuffer in instructions_gen:
                 yield
                 if clearBuffer is not None:
+                    self._frame_timer.step = frametiming.generator_step(instructions_gen)
                     self._flip_all_windows(exp_win, ctl_win, clearBuffer)
+        self._frame_timer.step = None
         # 2 flips to clear screen
         for i in range(2):
             yield
@@ -106,10 +176,13 @@ class Task(object):
             self.progress_bar.reset()
         flip_idx = 0
 
-        for clearBuffer in self._run(exp_win, ctl_win):
+        run_gen = self._run(exp_win, ctl_win)
+        for clearBuffer in run_gen:
             # yield first to allow external draw before flip
             yield
             if clearBuffer is not None:
+                # the step that prepared this frame, reported if the flip is late
+                self._frame_timer.step = frametiming.generator_step(run_gen)
                 self._flip_all_windows(exp_win, ctl_win, clearBuffer)
             # increment the progress bar depending on task flip rate
             if self.progress_bar:
@@ -120,16 +193,20 @@ class Task(object):
 
     def stop(self, exp_win, ctl_win):
         if hasattr(self, "_stop"):
-            for clearBuffer in self._stop(exp_win, ctl_win):
+            stop_gen = self._stop(exp_win, ctl_win)
+            for clearBuffer in stop_gen:
                 yield
                 if clearBuffer is not None:
+                    self._frame_timer.step = frametiming.generator_step(stop_gen)
                     self._flip_all_windows(exp_win, ctl_win, clearBuffer)
+        self._frame_timer.step = None
         if self.progress_bar:
             self.progress_bar.clear()
             self.progress_bar.close()
         # 2 flips to clear screen and backbuffer
         for i in range(2):
             self._flip_all_windows(exp_win, ctl_win, True)
+        self._disarm_flip_time(exp_win)
 
     def restart(self):
         if hasattr(self, "_restart"):
@@ -140,9 +217,22 @@ class Task(object):
             onset = self.task_timer.getTime()
         elif clock == 'flip':
             onset = self._exp_win_last_flip_time - self._exp_win_first_flip_time
-        event.update({"onset": onset, "sample": time.monotonic()})
+        event["onset"] = onset
+        event["sample"] = time.monotonic()
         self._events.append(event)
 
+    def _event_writer(self, *keys):
+        """Write function of the events with these keys, to log frequent events with `_log_values`."""
+        return self._events.writer(keys + ("onset", "sample"))
+
+    def _log_values(self, write, *values, clock='task'):
+        """Same as `_log_event`, from the event values in the order of the `write` keys, without a dict."""
+        if clock == 'task':
+            onset = self.task_timer.getTime()
+        elif clock == 'flip':
+            onset = self._exp_win_last_flip_time - self._exp_win_first_flip_time
+        write(*values, onset, time.monotonic())
+
     def _save(self):
         # to be overriden
         # return False if events need not be saved
@@ -154,8 +244,22 @@ class Task(object):
         save_events = self._save()
         if save_events is None and len(self._events):
             fname = self._generate_unique_filename("events", "tsv")
-            df = pandas.DataFrame(self._events)
+            df = self._events.to_dataframe()
             df.to_csv(fname, sep="\t", index=False)
+        self._events.close_journal(remove=True)
+        self._save_frame_timing()
+
+    def _save_frame_timing(self):
+        if self._frame_timer is None or not self._frame_timer.n_flips:
+            return
+        summary = self._frame_timer.save(
+            self._generate_unique_filename("frametiming", "tsv"),
+            self._exp_win_first_flip_time)
+        logging.exp(
+            "%s frame timing: %d flips, %d late, %d dropped frames, flip latency p50 %.2fms, p99 %.2fms, max %.2fms"
+            % (self.name, summary["n_flips"], summary["n_late_flips"], summary["n_dropped_frames"],
+               summary.get("p50_latency", 0) * 1e3, summary.get("p99_latency", 0) * 1e3,
+               summary["max_latency"] * 1e3))
 
 
 class Pause(Task):
@@ -166,6 +270,10 @@ class Pause(Task):
         super().__init__(**kwargs)
         self.text = text
 
+    def _plan(self):
+        # until the wait key is pressed
+        return {"duration": None}
+
     def _setup(self, exp_win):
         self.use_fmri = False
         self.use_eyetracking = False
@@ -206,6 +314,9 @@ Do not think about something in particular, let your mind wander..."""
         self.duration = duration
         self.symbol = symbol
 
+    def _plan(self):
+        return {"duration": self.duration}
+
     def _instructions(self, exp_win, ctl_win):
         screen_text = visual.TextStim(
             exp_win,
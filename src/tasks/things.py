@@ -2,6 +2,7 @@ import os, sys, time
 from psychopy import visual, core, data, logging, event
 from .task_base import Task
 import numpy as np
+from PIL import Image
 from colorama import Fore
 
 from ..shared import config, utils
@@ -29,6 +30,27 @@ Press the button when you see an unrecognizable object that was generated."""
         else:
             raise ValueError("Cannot find the listed images in %s " % images_path)
 
+    def _plan(self):
+        image_paths = [os.path.join(self.images_path, trial["image_path"]) for trial in self.design]
+        memory = 0
+        for path in image_paths:
+            # header only, decoded images take 4 bytes per pixel
+            with Image.open(path) as image:
+                memory += image.width * image.height * 4
+        return {
+            "duration": float(self.design[-1]["onset"]) + RESPONSE_TIME + FINAL_WAIT,
+            "stimuli": image_paths,
+            "memory": memory,
+        }
+
+    def _preload(self):
+        # decode all images, textures are created in _setup
+        self._images = []
+        for trial in self.design:
+            image = Image.open(os.path.join(self.images_path, trial["image_path"]))
+            image.load()
+            self._images.append(image)
+
     def _setup(self, exp_win):
         self.fixation_cross = visual.ImageStim(
             exp_win,
@@ -39,9 +61,9 @@ Press the button when you see an unrecognizable object that was generated."""
 
         # preload all images
         self._stimuli = []
-        for trial in self.design:
+        for image in self._images:
             self._stimuli.append(visual.ImageStim(
-                exp_win, os.path.join(self.images_path, trial["image_path"]),
+                exp_win, image,
                 size=10,
                 units='deg',
             ))
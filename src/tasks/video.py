@@ -52,6 +52,17 @@ and fixate the dot whenever it appears."""
                 screen_text.draw(ctl_win)
             yield True
 
+    def _plan(self):
+        # probe the header only, the movie is streamed when played
+        from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+        infos = ffmpeg_parse_infos(self.filepath)
+        width, height = infos["video_size"]
+        duration = infos["duration"]
+        if self._inmovie_fixations:
+            # gaze validation after the movie: text, start cue and 9 markers
+            duration += 2 + 1 + 9 * 1.5
+        return {"duration": duration, "stimuli": [self.filepath], "memory": width * height * 3}
+
     def _setup(self, exp_win):
 
         if self._startend_fixduration > 0 or self._inmovie_fixations:
@@ -265,6 +276,10 @@ class VideoAudioCheckLoop(SingleVideo):
 Make yourself comfortable.
 We will play your personalized video so that you can ensure you can see the full screen and that the image is sharp."""
 
+    def _plan(self):
+        # loops until skipped by the operator
+        return dict(super()._plan(), duration=None)
+
     def _setup(self, exp_win):
         super()._setup(exp_win)
         # set infinite loop for setup, need to be skipped
@@ -6,6 +6,7 @@ from psychopy import visual, core, data, logging, event, sound, constants
 from .task_base import Task
 
 from ..shared import config, utils
+from ..shared.questionnaire import LikertQuestionnaire
 from PIL import Image
 
 import retro
@@ -228,6 +229,10 @@ class VideoGame(VideoGameBase):
         self.key_set = key_set
         self._completed = False
 
+    def _plan(self):
+        # without max duration, the run lasts as long as the game
+        return {"duration": self.max_duration or None}
+
     def _instructions(self, exp_win, ctl_win):
 
         instruction = self.instruction.format(
@@ -273,6 +278,17 @@ class VideoGame(VideoGameBase):
 
         super()._setup(exp_win)
         self._set_recording_file()
+        self._setup_ratings(exp_win)
+
+    def _setup_ratings(self, exp_win):
+        # rating stimuli are all built before the run, never between levels
+        self._questionnaires = {}
+        if self.post_run_ratings:
+            self._get_questionnaire(exp_win, self.post_run_ratings)
+        self._rating_scales = [
+            self._likert_scale(exp_win, question, n_pts)
+            for question, n_pts in self.post_level_ratings or []]
+        self._ratings_thanks = visual.TextStim(exp_win, "Thanks for your answers", pos=(0, 0))
 
     def _set_recording_file(self):
         nnn = 0
@@ -424,128 +440,39 @@ class VideoGame(VideoGameBase):
             ctl_win.setColor([0] * 3, colorSpace='rgb255')
 
     def _run_ratings(self, exp_win, ctl_win):
-        for question, n_pts in self.post_level_ratings:
-            yield from self._likert_scale_answer(exp_win, ctl_win, question, n_pts)
+        for scale, (question, n_pts) in zip(self._rating_scales, self.post_level_ratings):
+            yield from self._likert_scale_answer(exp_win, ctl_win, scale, question, n_pts)
 
-        text = visual.TextStim(exp_win, "Thanks for your answers", pos=(0, 0))
         for i in range(config.FRAME_RATE):
-            text.draw(exp_win)
+            self._ratings_thanks.draw(exp_win)
             yield i < 3
         # clear screen
         for i in range(2):
             yield True
 
+    def _get_questionnaire(self, exp_win, questions):
+        # questionnaires are built in _setup and reused across levels
+        key = tuple(questions)
+        if key not in self._questionnaires:
+            self._questionnaires[key] = LikertQuestionnaire(
+                exp_win, questions, legends_y_ratio=1.1)
+        return self._questionnaires[key]
+
     def _questionnaire(self, exp_win, ctl_win, questions):
         if questions is None:
             return
+        questionnaire = self._get_questionnaire(exp_win, questions)
         exp_win.setColor([0] * 3, colorSpace='rgb')
-        lines = []
-        bullets = []
-        responses = []
-        texts = []
-        legends = []
-        y_spacing = 80
-        win_width = exp_win.size[0]
-        scales_block_x = win_width * 0.25
-        scales_block_y = len(questions) // 2 * y_spacing
-        extent = win_width * 0.2
-
-        # add legends to Likert scale
-        legends.append(visual.TextStim(
-            exp_win,
-            text = 'Disagree',
-            units="pix",
-            pos=(scales_block_x - extent*0.75, scales_block_y*1.1),
-            wrapWidth= win_width * 0.5,
-            height= y_spacing / 3,
-            anchorHoriz="right",
-            alignText="right",
-            bold=True
-        ))
-        legends.append(visual.TextStim(
-            exp_win,
-            text = 'Agree',
-            units="pix",
-            pos=(scales_block_x + extent*1.15, scales_block_y*1.1),
-            wrapWidth= win_width * 0.5,
-            height= y_spacing / 3,
-            anchorHoriz="right",
-            alignText="right",
-            bold=True
-        ))
-
-
-        active_question = 0
-
-        # create all stimuli
-        #all_questions_text = ""
-        for q_n, (key, question, n_pts) in enumerate(questions):
-            default_response = n_pts // 2
-            responses.append(default_response)
-            x_spacing = extent * 2 / (n_pts - 1)
-            #all_questions_text += question + "\n\n"
-
-            y_pos = scales_block_y - q_n * y_spacing
-
-            lines.append(
-                visual.Line(
-                    exp_win,
-                    (scales_block_x - extent, y_pos),
-                    (scales_block_x + extent, y_pos),
-                    units="pix",
-                    lineWidth=6,
-                    autoLog=False,
-                    lineColor=(0, -1, -1) if q_n == 0 else (-1, -1, -1),
-                )
-            )
-            bullets.append(
-                [
-                    visual.Circle(
-                        exp_win,
-                        units="pix",
-                        radius=10,
-                        pos=(
-                            scales_block_x - extent + i * x_spacing,
-                            y_pos,
-                        ),
-                        fillColor= (1, 1, 1) if default_response == i else (-1, -1, -1),
-                        lineColor=(-1, -1, -1),
-                        lineWidth=10,
-                        autoLog=False,
-                    )
-                    for i in range(n_pts)
-                ]
-            )
-            texts.append(visual.TextStim(
-                exp_win,
-                text = question,
-                units="pix",
-                bold = q_n == active_question,
-                pos=(0, y_pos),
-                wrapWidth= win_width * 0.5,
-                height= y_spacing / 3,
-                anchorHoriz="right",
-                alignText="right"
-            ))
-            responses[q_n] = default_response
-
-
+        questionnaire.reset()
 
         # questionnaire interaction loop
         n_flips = 0
         while True:
             self._handle_controller_presses(exp_win)
             new_key_pressed = [k[0] for k in self._new_key_pressed]
-            if "u" in new_key_pressed and active_question > 0:
-                active_question -= 1
-            elif "d" in new_key_pressed and active_question < len(questions)-1:
-                active_question += 1
-            elif "r" in new_key_pressed and responses[active_question] < n_pts - 1:
-                responses[active_question] += 1
-            elif "l" in new_key_pressed and responses[active_question] > 0:
-                responses[active_question] -= 1
-            elif "a" in new_key_pressed:
-                for (key, question, n_pts), value in zip(questions, responses):
+            changed = questionnaire.handle_keys(new_key_pressed)
+            if changed == "a":
+                for (key, question, n_pts), value in zip(questionnaire.questions, questionnaire.responses):
                     self._log_event({
                         "trial_type": "questionnaire-answer",
                         "game": self.game_name,
@@ -555,7 +482,7 @@ class VideoGame(VideoGameBase):
                         "value": value
                     })
                 break
-            elif n_flips > 1:
+            elif not changed and n_flips > 1:
                 time.sleep(.01)
                 continue
 
@@ -565,31 +492,20 @@ class VideoGame(VideoGameBase):
                     "game": self.game_name,
                     "level": self.state_name,
                     "stim_file": self.movie_path,
-                    "question": questions[active_question][0],
-                    "value": responses[active_question]
+                    "question": questionnaire.questions[questionnaire.active_question][0],
+                    "value": questionnaire.responses[questionnaire.active_question]
                 })
 
             exp_win.logOnFlip(
                 level=logging.EXP,
-                msg="level ratings %s" % responses)
-            for q_n, (txt, line, bullet_q) in enumerate(zip(texts, lines, bullets)):
-                #txt.bold = q_n == active_question
-                txt._pygletTextObj.set_style('bold', q_n == active_question)
-                line.lineColor = (0, -1, -1) if q_n == active_question else (-1, -1, -1)
-                for bullet_n, bullet in enumerate(bullet_q):
-                    bullet.fillColor = (1, 1, 1) if responses[q_n] == bullet_n else (-1, -1, -1)
-
-            for stim in lines + sum(bullets, []) + texts + legends:
-                stim.draw(exp_win)
+                msg="level ratings %s" % questionnaire.responses)
+            questionnaire.draw(exp_win)
             yield True
             n_flips += 1
+        questionnaire.log_draw_stats(self.name)
 
-    def _likert_scale_answer(
-        self, exp_win, ctl_win, question, n_pts=7, extent=0.6, autoLog=False
-    ):
+    def _likert_scale(self, exp_win, question, n_pts=7, extent=0.6):
         extent *= config.EXP_WINDOW["size"][0]
-        value = n_pts // 2
-        answered = False
         text = visual.TextStim(exp_win, question, pos=(0, 0.5))
         line = visual.Line(
             exp_win,
@@ -613,6 +529,14 @@ class VideoGame(VideoGameBase):
             )
             for i in range(n_pts)
         ]
+        return text, line, circles
+
+    def _likert_scale_answer(self, exp_win, ctl_win, scale, question, n_pts=7):
+        text, line, circles = scale
+        value = n_pts // 2
+        answered = False
+        for c in circles:
+            c.fillColor = (-1, -1, -1)
         circles[value].fillColor = (1, 1, 1)
         frame = 0
         while not answered:
@@ -673,6 +597,13 @@ class VideoGameMultiLevel(VideoGame):
             state_name=self._state_names[0], scenario=self._scenarii[0], **kwargs
         )
 
+    def _setup_ratings(self, exp_win):
+        # post-level ratings are a questionnaire, as the post-run ones
+        self._questionnaires = {}
+        for questions in (self.post_level_ratings, self.post_run_ratings):
+            if questions:
+                self._get_questionnaire(exp_win, questions)
+
     def _run(self, exp_win, ctl_win):
 
         #exp_win.waitBlanking = False
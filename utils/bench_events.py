@@ -0,0 +1,115 @@
+# Benchmark of the task events store, as used by the retinotopy flips.
+#
+# Times the per event cost (mean, p99.9 and max latency, including the garbage
+# collections it triggers), the memory retained per event and the DataFrame
+# conversion of a list of dicts (the former Task._log_event), of
+# EventBuffer.append and of an EventBuffer writer, and checks that they give the
+# same DataFrame. Then times the writer at a paced 2kHz rate with and without
+# the journal thread, and checks the journal reads back as the same events.
+#
+# run from the repository root:
+#   python -m utils.bench_events
+
+import gc, os, tempfile, time, tracemalloc
+import numpy as np
+import pandas
+
+from src.shared.events import EventBuffer, JOURNAL_EXT, read_journal
+
+# retinotopy-like flip events: a few hours of runs at 60Hz
+N_EVENTS = 500000
+# journal cost at a paced event rate
+N_PACED_EVENTS = 4000
+PACED_INTERVAL = .0005
+
+
+# former Task._log_event: a dict per event in a list
+def list_append(events, image_idx, aperture, onset, sample):
+    event = {'trial_type': 'flip', 'condition': 'RETBAR', 'image_idx': image_idx, 'aperture': aperture}
+    event.update({"onset": onset, "sample": sample})
+    events.append(event)
+
+
+# Task._log_event, still used for infrequent events
+def buffer_append(events, image_idx, aperture, onset, sample):
+    event = {'trial_type': 'flip', 'condition': 'RETBAR', 'image_idx': image_idx, 'aperture': aperture}
+    event.update({"onset": onset, "sample": sample})
+    events.append(event)
+
+
+# Task._log_values, as the retinotopy flips
+FLIP_KEYS = ('trial_type', 'condition', 'image_idx', 'aperture', 'onset', 'sample')
+
+
+def make_writer(journal_path=None):
+    return EventBuffer({'onset': float, 'sample': float}, journal_path).writer(FLIP_KEYS)
+
+
+def writer_append(write, image_idx, aperture, onset, sample):
+    write('flip', 'RETBAR', image_idx, aperture, onset, sample)
+
+
+def bench(make_store, append, to_dataframe):
+    # per call latency, including the garbage collections triggered by the store
+    store = make_store()
+    latencies = np.empty(N_EVENTS)
+    gc.collect()
+    for i in range(N_EVENTS):
+        start = time.perf_counter()
+        append(store, i % 30, i % 480, i * .016, i * 1.)
+        latencies[i] = time.perf_counter() - start
+    start = time.perf_counter()
+    df = to_dataframe(store)
+    df_duration = time.perf_counter() - start
+    del store
+    # memory retained by the store, on a second run
+    tracemalloc.start()
+    store = make_store()
+    for i in range(N_EVENTS):
+        append(store, i % 30, i % 480, i * .016, i * 1.)
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return latencies * 1e9, retained / N_EVENTS, df_duration, df
+
+
+def bench_stores():
+    results = {
+        'list of dicts': bench(list, list_append, pandas.DataFrame),
+        'buffer append': bench(
+            lambda: EventBuffer({'onset': float, 'sample': float}), buffer_append, EventBuffer.to_dataframe),
+        'buffer writer': bench(make_writer, writer_append, lambda write: write.__self__._buffer.to_dataframe()),
+    }
+    for name, (latencies, retained, df_duration, df) in results.items():
+        print(
+            f"{name:>14}: mean {latencies.mean():.0f}ns, p99.9 {np.percentile(latencies, 99.9):.0f}ns, "
+            f"max {latencies.max() / 1e6:.2f}ms, total {latencies.sum() / 1e9:.3f}s, "
+            f"retained {retained:.0f}B/event, to DataFrame {df_duration * 1e3:.1f}ms")
+    pandas.testing.assert_frame_equal(results['list of dicts'][3], results['buffer append'][3])
+    pandas.testing.assert_frame_equal(results['list of dicts'][3], results['buffer writer'][3])
+
+
+def bench_journal():
+    # the writer thread competing for the GIL
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for journal_path in (None, os.path.join(tmp_dir, "bench_events." + JOURNAL_EXT)):
+            write = make_writer(journal_path)
+            latencies = np.empty(N_PACED_EVENTS)
+            next_event = time.perf_counter()
+            for i in range(len(latencies)):
+                next_event += PACED_INTERVAL
+                while time.perf_counter() < next_event:
+                    time.sleep(0)
+                start = time.perf_counter()
+                writer_append(write, i % 30, i % 480, i * .016, i * 1.)
+                latencies[i] = (time.perf_counter() - start) * 1e9
+            write.__self__._buffer.close_journal()
+            if journal_path:
+                pandas.testing.assert_frame_equal(read_journal(journal_path), write.__self__._buffer.to_dataframe())
+            print(
+                f"{'journal' if journal_path else 'no journal':>14}: mean {latencies.mean():.0f}ns, "
+                f"p99.9 {np.percentile(latencies, 99.9):.0f}ns, max {latencies.max():.0f}ns")
+
+
+if __name__ == "__main__":
+    bench_stores()
+    bench_journal()
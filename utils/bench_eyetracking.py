@@ -0,0 +1,462 @@
+# Benchmarks of the eyetracker client, without the eyetracker.
+#
+# listener: a publisher process sends Pupil-like pupil and gaze data at
+# `--rate` Hz each on a local PUB socket, timestamped with time.monotonic() as
+# Pupil does on the same computer. The listener either drains the socket in
+# batches into sample rings (as EyeTrackerClient does), or receives one message
+# at a time under a lock (`--mode recv`, the former client). A reader thread
+# gets the latest gaze at the frame rate, after some python work holding the
+# GIL, as the render loop does.
+# Reports the drop rate, the delivery latency, the CPU time of the listener
+# thread and the cost of the reader calls. With `--backlog`, the listener only
+# starts once all the messages are queued, to measure the cost of receiving and
+# decoding them without the cost of waking up for each one.
+#
+# client: runs EyeTrackerClient against the Pupil Capture simulator
+# (src/shared/pupil_sim.py), with the same reader thread. Reports the drop rate
+# of the published pupil and gaze, their end-to-end latency from the simulated
+# capture, and the CPU time of the listener thread, sampled from its clock.
+#
+# validation: times the gaze assignment and quality control of a synthetic
+# validation against the former per-sample implementations, checks that both
+# give the same results, and fails if the validation takes longer than
+# `--max-qc-time`. The gaze list can span several validations, as in a session.
+#
+# run from the repository root:
+#   python -m utils.bench_eyetracking listener --rate 1000 --duration 10
+#   python -m utils.bench_eyetracking listener --rate 1000 --duration 10 --backlog
+#   python -m utils.bench_eyetracking client --rate 250 --jitter 1 --dropout-rate .5
+#   python -m utils.bench_eyetracking validation
+
+import argparse, contextlib, io, multiprocessing, tempfile, threading, time
+import numpy as np
+import msgpack
+import zmq
+
+from src.shared import eyesamples, zmq_tools
+
+# ms, validation of 9 markers, participant waiting
+QC_TIME_BUDGET = 100.
+
+
+def pupil_datum(timestamp, rng):
+    return {
+        "id": 0, "topic": "pupil.0.2d", "method": "2d c++",
+        "norm_pos": [0.5 + rng.normal(0, .05), 0.5 + rng.normal(0, .05)],
+        "diameter": 40 + rng.normal(0, 2),
+        "confidence": min(1., rng.uniform(.6, 1.1)),
+        "timestamp": timestamp,
+        "ellipse": {"center": [320., 240.], "axes": [40., 42.], "angle": 10.},
+        "location": [320., 240.], "model_confidence": 1.,
+    }
+
+
+def gaze_datum(pupil):
+    return {
+        "topic": "gaze.2d.0.", "norm_pos": pupil["norm_pos"], "confidence": pupil["confidence"],
+        "timestamp": pupil["timestamp"], "base_data": [pupil],
+    }
+
+
+def publish(conn, rate, duration):
+    """Publisher process: sends its port, waits for the subscriber, then publishes."""
+    ctx = zmq.Context()
+    socket = ctx.socket(zmq.PUB)
+    socket.set_hwm(0)
+    conn.send(socket.bind_to_random_port("tcp://127.0.0.1"))
+    conn.recv()
+    rng = np.random.default_rng(0)
+    period = 1. / rate
+    cpu = time.process_time()
+    start = time.monotonic()
+    n = 0
+    while n < rate * duration:
+        delay = start + n * period - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        pupil = pupil_datum(time.monotonic(), rng)
+        socket.send_multipart((b"pupil.0.2d", msgpack.dumps(pupil)))
+        socket.send_multipart((b"gaze.2d.0.", msgpack.dumps(gaze_datum(pupil))))
+        n += 1
+    conn.send({"sent": 2 * n, "publish_time": time.monotonic() - start})
+    socket.close(linger=1000)
+    ctx.term()
+
+
+def listen_drain(socket, stop, stats):
+    pupil_samples = eyesamples.SampleRing()
+    gaze_samples = eyesamples.SampleRing()
+    stats["get_gaze"] = gaze_samples.latest
+    decode_gaze = eyesamples.gaze_decoder()
+    latencies, batch_sizes = [], []
+    cpu = time.thread_time()
+    while not stop.is_set():
+        messages = eyesamples.drain(socket)
+        if not messages:
+            continue
+        # as EyeTrackerClient._dispatch without callbacks
+        pupils, gazes = [], []
+        for topic, payload in messages:
+            if topic.startswith(b"pupil"):
+                pupils.append(msgpack.loads(payload))
+            elif topic.startswith(b"gaze"):
+                gazes.append(decode_gaze(payload))
+        if pupils:
+            pupil_samples.extend(pupils)
+        if gazes:
+            gaze_samples.extend(gazes)
+        now = time.monotonic()
+        latencies.extend(now - datum["timestamp"] for datum in pupils + gazes)
+        batch_sizes.append(len(messages))
+    stats["cpu"] = time.thread_time() - cpu
+    stats["received"] = pupil_samples.n_samples + gaze_samples.n_samples
+    stats["latencies"] = np.asarray(latencies)
+    stats["batch_sizes"] = np.asarray(batch_sizes)
+
+
+def listen_recv(socket, stop, stats):
+    monitor = zmq_tools.Msg_Receiver.__new__(zmq_tools.Msg_Receiver)
+    monitor.socket = socket
+    lock = threading.Lock()
+    latest = {}
+
+    def get_gaze():
+        if lock.acquire(False):
+            try:
+                return latest.get("gaze")
+            finally:
+                lock.release()
+
+    stats["get_gaze"] = get_gaze
+    latencies = []
+    cpu = time.thread_time()
+    while not stop.is_set():
+        # the former client blocked in recv, unable to stop
+        if not socket.poll(eyesamples.DRAIN_POLL_TIMEOUT):
+            continue
+        topic, payload = monitor.recv()
+        with lock:
+            latest["gaze" if topic.startswith("gaze") else "pupil"] = payload
+        latencies.append(time.monotonic() - payload["timestamp"])
+    stats["cpu"] = time.thread_time() - cpu
+    stats["received"] = len(latencies)
+    stats["latencies"] = np.asarray(latencies)
+    stats["batch_sizes"] = np.ones(1)
+
+
+def read_gaze(stats, stop, frame_rate, render_load):
+    """Get the latest gaze every frame, after `render_load` s of python work holding the GIL."""
+    call_times = []
+    misses = 0
+    period = 1. / frame_rate
+    next_frame = time.monotonic()
+    while not stop.is_set():
+        render_end = time.perf_counter() + render_load
+        while time.perf_counter() < render_end:
+            pass
+        get_gaze = stats.get("get_gaze")
+        if get_gaze:
+            t = time.perf_counter()
+            gaze = get_gaze()
+            call_times.append(time.perf_counter() - t)
+            misses += gaze is None
+        next_frame += period
+        time.sleep(max(next_frame - time.monotonic(), 0))
+    stats["read_times"] = np.asarray(call_times)
+    stats["read_misses"] = misses
+
+
+def bench_listener(args):
+    conn, child_conn = multiprocessing.Pipe()
+    publisher = multiprocessing.Process(target=publish, args=(child_conn, args.rate, args.duration))
+    publisher.start()
+    ctx = zmq.Context()
+    sub = ctx.socket(zmq.SUB)
+    sub.set_hwm(0)
+    sub.connect(f"tcp://127.0.0.1:{conn.recv()}")
+    for topic in ("pupil", "gaze"):
+        sub.subscribe(topic)
+    # let the subscription reach the publisher
+    time.sleep(.5)
+
+    stop = threading.Event()
+    stats = {}
+    listen = listen_drain if args.mode == "drain" else listen_recv
+    threads = [
+        threading.Thread(target=listen, args=(sub, stop, stats), name="listener"),
+        threading.Thread(target=read_gaze, args=(stats, stop, args.frame_rate, args.render_load / 1e3), name="reader"),
+    ]
+    if not args.backlog:
+        for thread in threads:
+            thread.start()
+    conn.send("start")
+    counts = conn.recv()
+    publisher.join()
+    if args.backlog:
+        # let the last messages reach the subscriber
+        time.sleep(.5)
+        for thread in threads:
+            thread.start()
+    # let the listener catch up
+    time.sleep(.5)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    latencies = stats["latencies"] * 1e3
+    read_times = stats["read_times"] * 1e6
+    print(f"mode {args.mode}: {counts['sent']} messages sent in {counts['publish_time']:.2f}s "
+          f"({counts['sent'] / counts['publish_time']:.0f}/s)")
+    print(f"received {stats['received']}, dropped {1 - stats['received'] / counts['sent']:.2%}, "
+          f"mean batch {stats['batch_sizes'].mean():.1f} messages")
+    if len(latencies) and not args.backlog:
+        print(f"latency p50 {np.percentile(latencies, 50):.3f}ms p99 {np.percentile(latencies, 99):.3f}ms "
+              f"max {latencies.max():.3f}ms")
+    print(f"listener cpu {stats['cpu']:.3f}s ({stats['cpu'] / max(stats['received'], 1) * 1e6:.1f}us per message)")
+    if len(read_times):
+        print(f"get_gaze p50 {np.percentile(read_times, 50):.1f}us p99 {np.percentile(read_times, 99):.1f}us, "
+              f"{stats['read_misses']} of {len(read_times)} calls without gaze")
+    sub.close()
+    ctx.term()
+
+
+def bench_client(args):
+    from src.shared import eyetracking
+
+    simulator_args = [
+        "--rate", str(args.rate), "--latency", str(args.latency), "--jitter", str(args.jitter),
+        "--dropout-rate", str(args.dropout_rate), "--seed", "0"]
+    with tempfile.TemporaryDirectory() as output_path:
+        client = eyetracking.EyeTrackerClient(
+            output_path, "bench", simulate=True, simulator_args=simulator_args)
+        client.start()
+        ctx = zmq.Context()
+        req = ctx.socket(zmq.REQ)
+        req.connect(f"tcp://localhost:{eyetracking.PUPIL_REMOTE_PORT}")
+
+        def counts():
+            req.send_string("STATS")
+            return msgpack.loads(req.recv()), client.pupil_samples.n_samples + client.gaze_samples.n_samples
+
+        # the counts are compared while the simulator does not publish
+        def stop_capture():
+            client.stop_capture()
+            time.sleep(.5)
+
+        latencies = []
+        cpu_clock = time.pthread_getcpuclockid(client.ident)
+        stop_capture()
+        published, received = counts()
+        client.set_pupil_cb(lambda pupil: latencies.append(time.monotonic() - pupil["timestamp"]))
+        cpu = time.clock_gettime(cpu_clock)
+
+        stop = threading.Event()
+        stats = {"get_gaze": client.get_gaze}
+        reader = threading.Thread(
+            target=read_gaze, args=(stats, stop, args.frame_rate, args.render_load / 1e3), name="reader")
+        reader.start()
+        client.start_capture()
+        time.sleep(args.duration)
+        stop_capture()
+        stop.set()
+        reader.join()
+
+        cpu = time.clock_gettime(cpu_clock) - cpu
+        client.unset_pupil_cb()
+        end_published, end_received = counts()
+        received = end_received - received
+        published = {key: end_published[key] - published[key] for key in published}
+        req.close()
+        ctx.term()
+        client.join(5)
+
+    sent = published["pupil"] + published["gaze"]
+    latencies = np.asarray(latencies) * 1e3
+    read_times = stats["read_times"] * 1e6
+    frames = published["pupil"] + published["dropped_frames"]
+    print(f"simulator: {published['pupil']} pupil, {published['gaze']} gaze, {published['fixations']} fixations "
+          f"published in {args.duration:.0f}s, {published['dropped_frames'] / max(frames, 1):.2%} frames dropped out")
+    print(f"received {received} pupil and gaze, dropped {1 - received / max(sent, 1):.2%}")
+    if len(latencies):
+        print(f"pupil latency p50 {np.percentile(latencies, 50):.3f}ms p99 {np.percentile(latencies, 99):.3f}ms "
+              f"max {latencies.max():.3f}ms")
+    print(f"listener cpu {cpu:.3f}s ({cpu / args.duration:.1%} of a core, "
+          f"{cpu / max(received, 1) * 1e6:.1f}us per message)")
+    if len(read_times):
+        print(f"get_gaze p50 {np.percentile(read_times, 50):.1f}us p99 {np.percentile(read_times, 99):.1f}us, "
+              f"{stats['read_misses']} of {len(read_times)} calls without gaze")
+
+
+def validation_data(rng, markers, marker_frames=120, lead_in=20, frame_rate=60., gaze_rate=250., onset=0.):
+    """Refs and gaze of a validation, as recorded by EyetrackerCalibration_targets."""
+    ref_list, gaze_list = [], []
+    marker_duration = marker_frames / frame_rate
+    for i, marker in enumerate(markers[rng.permutation(len(markers))]):
+        start = onset + i * marker_duration
+        norm_pos = 0.5 + (marker - 0.5) * 0.85
+        for f in range(lead_in + 1, marker_frames):
+            ref_list.append({
+                "norm_pos": norm_pos.tolist(),
+                "screen_pos": (norm_pos * (1280, 1024)).tolist(),
+                "timestamp": start + f / frame_rate,
+            })
+        n_gaze = int(marker_duration * gaze_rate)
+        times = start + np.arange(n_gaze) / gaze_rate
+        gaze_pos = norm_pos + rng.normal(0, .01, (n_gaze, 2))
+        confidences = np.minimum(rng.uniform(.5, 1.1, n_gaze), 1.)
+        gaze_list.extend(
+            {"timestamp": t, "norm_pos": p.tolist(), "confidence": c}
+            for t, p, c in zip(times.tolist(), gaze_pos, confidences.tolist()))
+    return ref_list, gaze_list
+
+
+def legacy_marker_dictionary(ref_list):
+    """Former get_marker_dictionary, scanning the positions already seen."""
+    position_list = []
+    markers_dict = {}
+    count = 0
+    for m in ref_list:
+        if not (m['norm_pos']) in position_list:
+            markers_dict[count] = {
+                'norm_pos': m['norm_pos'], 'screen_pos': m['screen_pos'],
+                'onset': m['timestamp'], 'offset': -1.0,
+            }
+            count += 1
+            position_list.append(m['norm_pos'])
+        elif m['timestamp'] > markers_dict[count-1]['offset']:
+            markers_dict[count-1]['offset'] = m['timestamp']
+    return markers_dict
+
+
+def legacy_assign_gaze(gaze_list, markers_dict):
+    """Former assign_gaze_to_markers, walking the gaze list."""
+    i = 0
+    for count in range(len(markers_dict.keys())):
+        marker = markers_dict[count]
+        gaze_data = {'timestamps': [], 'norm_pos': [], 'confidence': []}
+        while i < len(gaze_list) and gaze_list[i]['timestamp'] < marker['onset']:
+            i += 1
+        while i < len(gaze_list) and gaze_list[i]['timestamp'] < marker['offset']:
+            gaze = gaze_list[i]
+            gaze_data['timestamps'].append(gaze['timestamp'])
+            gaze_data['norm_pos'].append(gaze['norm_pos'])
+            gaze_data['confidence'].append(gaze['confidence'])
+            i += 1
+        markers_dict[count]['gaze_data'] = gaze_data
+    return markers_dict
+
+
+def legacy_distances(markers_dict, conf_thresh):
+    """Distances of the former gaze_qc_per_marker, one pdist per gaze sample."""
+    from scipy.spatial.distance import pdist
+    dist_in_pix = 4164
+    all_distances = []
+    for count in range(len(markers_dict.keys())):
+        m = markers_dict[count]
+        m_vecpos = np.concatenate(((np.array(m['norm_pos']) - 0.5)*(1280, 1024), np.array([dist_in_pix])), axis=0)
+        g_conf = np.array(m['gaze_data']['confidence'])
+        g_filter = g_conf > conf_thresh
+        g_pos = np.array(m['gaze_data']['norm_pos'])[g_filter]
+        gaze = (g_pos - 0.5)*(1280, 1024)
+        gaze_vecpos = np.concatenate((gaze, np.repeat(dist_in_pix, len(gaze)).reshape((-1, 1))), axis=1)
+        distances = []
+        for gz_vec in gaze_vecpos:
+            vectors = np.stack((m_vecpos, gz_vec), axis=0)
+            distance = np.rad2deg(np.arccos(1.0 - pdist(vectors, metric='cosine')))
+            distances.append(distance[0])
+        all_distances.append(np.array(distances))
+    return all_distances
+
+
+def bench_validation(args):
+    from src.shared import eyetracking
+
+    # the quality control does not use the connection to pupil
+    client = eyetracking.EyeTrackerClient.__new__(eyetracking.EyeTrackerClient)
+    rng = np.random.default_rng(0)
+    # gaze of the previous validations of the session precede the one validated
+    gaze_list = []
+    for i in range(args.n_validations):
+        ref_list, validation_gaze = validation_data(rng, eyetracking.MARKER_POSITIONS_9, onset=i * 60.)
+        gaze_list.extend(validation_gaze)
+    frames_per_marker = 120 - 20
+
+    def timed(fn, *fn_args, **kwargs):
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = fn(*fn_args, **kwargs)
+            times.append(time.perf_counter() - start)
+        return np.median(times) * 1e3, result
+
+    def legacy_assign():
+        return legacy_assign_gaze(gaze_list, legacy_marker_dictionary(ref_list))
+
+    def assign():
+        return client.assign_gaze_to_markers(gaze_list, client.get_marker_dictionary(ref_list))
+
+    # gaze as kept by the client sample rings
+    gaze_samples = np.array([eyesamples.to_sample(g) for g in gaze_list], dtype=eyesamples.SAMPLE_DTYPE)
+
+    def assign_samples():
+        return client.assign_gaze_to_markers(gaze_samples, client.get_marker_dictionary(ref_list))
+
+    legacy_assign_time, legacy_markers = timed(legacy_assign)
+    samples_assign_time, samples_markers = timed(assign_samples)
+    assign_time, markers_dict = timed(assign)
+    for count, marker in legacy_markers.items():
+        for key in ('timestamps', 'norm_pos', 'confidence'):
+            expected = np.reshape(marker['gaze_data'][key], (-1, 2) if key == 'norm_pos' else -1)
+            np.testing.assert_array_equal(markers_dict[count]['gaze_data'][key], expected)
+            np.testing.assert_array_equal(samples_markers[count]['gaze_data'][key], expected)
+
+    legacy_time, legacy = timed(legacy_distances, legacy_markers, .8)
+    no_ci_time, (markers_dict, _) = timed(client.gaze_qc_per_marker, markers_dict, frames_per_marker, n_bootstrap=0)
+    qc_time, _ = timed(client.gaze_qc_per_marker, markers_dict, frames_per_marker)
+    for count, distances in enumerate(legacy):
+        np.testing.assert_allclose(
+            markers_dict[count]['gaze_data']['distances']['distances'], distances, atol=1e-6)
+    validate_time, _ = timed(client.validate, gaze_list, ref_list, frames_per_marker)
+
+    print(f"{len(gaze_list)} gaze, {len(ref_list)} refs of {len(markers_dict)} markers, median of {args.repeats} runs")
+    print(f"gaze assignment: former {legacy_assign_time:.1f}ms, searchsorted {assign_time:.1f}ms, "
+          f"on a sample array {samples_assign_time:.2f}ms")
+    print(f"distances: former per-sample {legacy_time:.1f}ms, vectorized {no_ci_time:.1f}ms, "
+          f"with {eyetracking.QC_BOOTSTRAP_SAMPLES} bootstrap resamples {qc_time:.1f}ms")
+    print(f"validate: {validate_time:.1f}ms")
+    if validate_time > args.max_qc_time:
+        raise SystemExit(f"validation took {validate_time:.1f}ms > {args.max_qc_time}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the eyetracker client")
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+    listener = subparsers.add_parser("listener", help="listener against a synthetic publisher")
+    listener.add_argument("--rate", type=float, default=1000., help="pupil and gaze rate (Hz each)")
+    listener.add_argument("--duration", type=float, default=10., help="publishing duration (s)")
+    listener.add_argument("--mode", choices=("drain", "recv"), default="drain")
+    listener.add_argument("--frame-rate", type=float, default=60., help="rate of the gaze reader (Hz)")
+    listener.add_argument("--render-load", type=float, default=8., help="python work of the reader per frame (ms)")
+    listener.add_argument("--backlog", action="store_true", help="start the listener once all the messages are queued")
+    listener.set_defaults(run=bench_listener)
+    client = subparsers.add_parser("client", help="eyetracking client against the pupil capture simulator")
+    client.add_argument("--rate", type=float, default=250., help="eye camera frame rate (Hz)")
+    client.add_argument("--latency", type=float, default=0., help="simulated processing latency (ms)")
+    client.add_argument("--jitter", type=float, default=1., help="std of the simulated latency jitter (ms)")
+    client.add_argument("--dropout-rate", type=float, default=0., help="simulated frame dropouts per second")
+    client.add_argument("--duration", type=float, default=10., help="capture duration (s)")
+    client.add_argument("--frame-rate", type=float, default=60., help="rate of the gaze reader (Hz)")
+    client.add_argument("--render-load", type=float, default=8., help="python work of the reader per frame (ms)")
+    client.set_defaults(run=bench_client)
+    validation = subparsers.add_parser("validation", help="quality control of a validation")
+    validation.add_argument("--repeats", type=int, default=20)
+    validation.add_argument("--n-validations", type=int, default=1, help="validations in the gaze list")
+    validation.add_argument("--max-qc-time", type=float, default=QC_TIME_BUDGET, help="fail above this time (ms)")
+    validation.set_defaults(run=bench_validation)
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
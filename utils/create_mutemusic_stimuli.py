@@ -0,0 +1,168 @@
+# Render the silenced mutemusic stimuli and the per subject playlists from a spec.
+#
+# The spec is a tsv with one row per track of a playlist:
+#   subject  playlist  Groupe  category  source  start  total_duration  silence_onset  silence_duration
+# `start` and `total_duration` select the excerpt of the source track (seconds),
+# `silence_onset` is relative to the excerpt start. An optional `output` column
+# overrides the default `<stimuli>/<category>/<source name>_silenced.wav`.
+# Playlists missing from a subject `<sub>_Playlist_order.tsv` are appended to
+# it in spec order, not done.
+#
+# run from the repository root:
+#   python -m utils.create_mutemusic_stimuli spec.tsv -j 8
+
+import os, json, hashlib, wave
+import numpy as np
+import pandas
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.shared import audio
+
+FADE_DURATION = .05
+RENDER_VERSION = 1
+STIMULI_PATH = audio.MUTEMUSIC_STIMULI_PATH
+PLAYLISTS_PATH = os.path.join('data', 'mutemusic')
+RENDER_CACHE = os.path.join('data', 'mutemusic', 'stimuli_cache.json')
+
+PLAYLIST_COLUMNS = ['Groupe', 'category', 'title', 'path', 'silence_duration', 'total_duration', 'onset']
+
+
+def envelope(frames, n_frames, silence_start, silence_stop, fade_frames):
+    """Gain of each frame index: short raised-cosine fades around the excerpt and the silence."""
+    gain = np.ones(len(frames))
+    # distance (in frames) to each edge, counted towards the sound side of the edge
+    for distance in (
+        frames,                          # excerpt start
+        n_frames - 1 - frames,           # excerpt end
+        silence_start - 1 - frames,      # silence start
+        frames - silence_stop,           # silence end
+    ):
+        ramp = (distance >= 0) & (distance < fade_frames)
+        gain[ramp] *= .5 - .5 * np.cos(np.pi * distance[ramp] / fade_frames)
+    gain[(frames >= silence_start) & (frames < silence_stop)] = 0
+    return gain
+
+
+def render(source, output, start, total_duration, silence_onset, silence_duration,
+           fade_duration=FADE_DURATION, chunk_frames=audio.CHUNK_FRAMES):
+    """Write the silenced excerpt of a source wav, streamed by chunks."""
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    tmp_path = output + '.tmp'
+    with wave.open(source, 'rb') as src, wave.open(tmp_path, 'wb') as dst:
+        dst.setparams(src.getparams())
+        rate, sampwidth, nchannels = src.getframerate(), src.getsampwidth(), src.getnchannels()
+        start_frame = int(round(start * rate))
+        n_frames = min(int(round(total_duration * rate)), src.getnframes() - start_frame)
+        if n_frames <= 0:
+            raise ValueError(f"{source}: excerpt starts after the end of the track")
+        silence_start = int(round(silence_onset * rate))
+        silence_stop = silence_start + int(round(silence_duration * rate))
+        fade_frames = max(int(round(fade_duration * rate)), 1)
+
+        src.setpos(start_frame)
+        position = 0
+        while position < n_frames:
+            raw = src.readframes(min(chunk_frames, n_frames - position))
+            if not raw:
+                break
+            samples = audio._frames_to_array(raw, sampwidth, nchannels)
+            frames = np.arange(position, position + len(samples))
+            gain = envelope(frames, n_frames, silence_start, silence_stop, fade_frames)
+            dst.writeframes(audio._array_to_frames(np.rint(samples * gain[:, None]), sampwidth))
+            position += len(samples)
+    os.replace(tmp_path, output)
+    return output
+
+
+def render_key(source_sha1, track):
+    params = [RENDER_VERSION, FADE_DURATION, source_sha1] + [
+        float(track[k]) for k in ('start', 'total_duration', 'silence_onset', 'silence_duration')]
+    return hashlib.sha1(json.dumps(params).encode()).hexdigest()
+
+
+def output_path(track, stimuli_path):
+    if isinstance(track.get('output'), str):
+        return track['output']
+    name = os.path.splitext(os.path.basename(track['source']))[0]
+    return os.path.join(stimuli_path, track['category'], f"{name}_silenced.wav")
+
+
+def build(spec, stimuli_path=STIMULI_PATH, playlists_path=PLAYLISTS_PATH, cache_path=RENDER_CACHE, jobs=None):
+    """Render the stimuli of a spec that changed, then write the playlists and their order tsv."""
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+
+    # hash each source once, then the render key covers source content and parameters
+    source_hashes = {source: audio.file_hash(source) for source in spec['source'].unique()}
+    spec = spec.assign(path=[output_path(track, stimuli_path) for _, track in spec.iterrows()])
+    spec['render_key'] = [render_key(source_hashes[track['source']], track) for _, track in spec.iterrows()]
+
+    renders = spec.drop_duplicates(['path', 'render_key'])
+    conflicts = renders['path'][renders['path'].duplicated()]
+    if len(conflicts):
+        raise ValueError(f"different silences rendered to the same file: {sorted(set(conflicts))}")
+
+    todo = renders[[
+        cache.get(track['path']) != track['render_key'] or not os.path.exists(track['path'])
+        for _, track in renders.iterrows()]]
+    if len(todo):
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(
+                    render, track['source'], track['path'], track['start'], track['total_duration'],
+                    track['silence_onset'], track['silence_duration']): track
+                for _, track in todo.iterrows()}
+            for future in as_completed(futures):
+                track = futures[future]
+                future.result()
+                cache[track['path']] = track['render_key']
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=1)
+        os.replace(tmp_path, cache_path)
+
+    for (subject, playlist_n), tracks in spec.groupby(['subject', 'playlist'], sort=False):
+        sub = f"Sub-{int(subject):02d}" if str(subject).isdigit() else subject
+        os.makedirs(os.path.join(playlists_path, sub), exist_ok=True)
+        tracks = tracks.assign(
+            title=tracks['path'].map(os.path.basename),
+            total_duration=[
+                audio.get_wav_info(path)['duration'] for path in tracks['path']],
+            onset=None)
+        tracks[PLAYLIST_COLUMNS].to_csv(
+            os.path.join(playlists_path, sub, f"{sub}_Playlist_{playlist_n}.tsv"),
+            sep='\t', index=False)
+
+    # the order the session runs the playlists in, existing orders are kept
+    for subject, playlists in spec.groupby('subject', sort=False)['playlist']:
+        sub = f"Sub-{int(subject):02d}" if str(subject).isdigit() else subject
+        order_path = os.path.join(playlists_path, sub, f"{sub}_Playlist_order.tsv")
+        order = pandas.DataFrame(columns=['playlist', 'done'])
+        if os.path.exists(order_path):
+            order = pandas.read_csv(order_path, sep=' ')
+        new = [n for n in playlists.unique() if str(n) not in set(order['playlist'].astype(str))]
+        order = pandas.concat([order, pandas.DataFrame({'playlist': new, 'done': 0})], ignore_index=True)
+        # space separated, as the session reads it
+        order.to_csv(order_path, sep=' ', index=False)
+    return todo
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="render the silenced mutemusic stimuli and playlists from a spec",
+    )
+    parser.add_argument("spec", help="tsv spec of the playlists")
+    parser.add_argument("--stimuli", default=STIMULI_PATH, help="output stimuli folder")
+    parser.add_argument("--playlists", default=PLAYLISTS_PATH, help="output folder of subjects playlists")
+    parser.add_argument("--cache", default=RENDER_CACHE, help="render cache json file")
+    parser.add_argument("--jobs", "-j", type=int, default=None, help="number of processes")
+    parsed = parser.parse_args()
+
+    spec = pandas.read_table(parsed.spec, sep='\t')
+    rendered = build(spec, parsed.stimuli, parsed.playlists, parsed.cache, parsed.jobs)
+    print(f"{len(rendered)} stimuli rendered, {len(spec.groupby(['subject', 'playlist']))} playlists written")